@@ -10,8 +10,19 @@
 # limitations under the License.
 
 
-from utils import _doublequote, if_else, find_executable
+from utils import _doublequote, if_else, find_executable, json_encoder, set_json_encoder, \
+                    JSON_STDLIB, JSON_SIMPLEJSON, JSON_UJSON
 from apnsexceptions import *
 from connection import *
 from notifications import *
 from feedback import *
+from pool import *
+from asyncwrapper import *
+from template import *
+from tokens import *
+from suppression import *
+from dispatcher import *
+from pacing import *
+from scheduler import *
+from spool import *
+from processpool import *
@@ -0,0 +1,301 @@
+# Copyright 2009 Max Klymyshyn, Sonettic
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#    http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import ssl
+import errno
+import socket
+import asyncore
+import datetime
+import collections
+
+from apnsexceptions import *
+from connection import _sslWrap
+from feedback import APNSFeedbackParser
+import notifications
+
+class APNSAsyncConnection(asyncore.dispatcher):
+    """
+    Non-blocking SSL connection driven by asyncore loop. Many
+    connections may share one loop by passing the same map.
+    """
+
+    apnsHost = None
+    apnsSandboxHost = None
+    apnsPort = None
+
+    certificate = None
+    sandbox = True
+    handshaked = False
+
+    def __init__(self, certificate = None, sandbox = True, map = None):
+        asyncore.dispatcher.__init__(self, map = map)
+        self.certificate = certificate
+        self.sandbox = sandbox
+        self.handshaked = False
+
+    def _host(self):
+        if self.sandbox != True:
+            return self.apnsHost
+        return self.apnsSandboxHost
+
+    def start(self):
+        """
+        Start non-blocking connection to the APNS server.
+        Data will be transferred by asyncore.loop()
+        """
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.connect((self._host(), self.apnsPort))
+        return self
+
+    def handle_connect(self):
+        self.socket = _sslWrap(self.socket, self.certificate, self._host(), \
+                            do_handshake_on_connect = False)
+        self._handshake()
+
+    def _handshake(self):
+        try:
+            self.socket.do_handshake()
+        except ssl.SSLError, e:
+            if e.args[0] in (ssl.SSL_ERROR_WANT_READ, ssl.SSL_ERROR_WANT_WRITE):
+                return
+            raise
+        self.handshaked = True
+        self.handle_handshake()
+
+    def _recv(self, blockSize):
+        """
+        Read block of data. Return empty string if there is no data
+        available and None if connection is closed.
+        """
+        try:
+            data = self.socket.recv(blockSize)
+        except ssl.SSLError, e:
+            if e.args[0] in (ssl.SSL_ERROR_WANT_READ, ssl.SSL_ERROR_WANT_WRITE):
+                return ''
+            raise
+        except socket.error, e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return ''
+            raise
+        if not data:
+            return None
+        return data
+
+    def _send(self, data):
+        """
+        Write data and return number of bytes written.
+        """
+        try:
+            return self.socket.send(data)
+        except ssl.SSLError, e:
+            if e.args[0] in (ssl.SSL_ERROR_WANT_READ, ssl.SSL_ERROR_WANT_WRITE):
+                return 0
+            raise
+        except socket.error, e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return 0
+            raise
+
+    def handle_read(self):
+        if not self.handshaked:
+            self._handshake()
+            return
+        self.handle_ssl_read()
+
+    def handle_write(self):
+        if not self.handshaked:
+            self._handshake()
+            return
+        self.handle_ssl_write()
+
+    def handle_handshake(self):
+        pass
+
+    def handle_ssl_read(self):
+        pass
+
+    def handle_ssl_write(self):
+        pass
+
+
+class AsyncAPNSNotificationWrapper(APNSAsyncConnection):
+    """
+    Non-blocking version of APNSNotificationWrapper. Notifications are
+    encoded by APNSNotification.payload() and queued to the bounded
+    queue. .send() returns False if queue is full, so caller should
+    wait while asyncore loop drains it (see .full() and onDrain).
+
+    Callback passed to .send() will be called with notification and
+    None when frame is written to the socket or with an exception
+    if connection failed.
+    """
+
+    apnsHost = 'gateway.push.apple.com'
+    apnsSandboxHost = 'gateway.sandbox.push.apple.com'
+    apnsPort = 2195
+
+    queueSize = 1000
+    bufferSize = 16384
+    framesSent = 0
+    onDrain = None
+
+    def __init__(self, certificate = None, sandbox = True, queue_size = 1000, \
+                    buffer_size = 16384, map = None, on_drain = None):
+        APNSAsyncConnection.__init__(self, certificate, sandbox, map)
+        self.queueSize = queue_size
+        self.bufferSize = buffer_size
+        self.onDrain = on_drain
+        self.framesSent = 0
+        self.lastError = None
+        self._queue = collections.deque()
+        self._buffer = ''
+        self._pending = collections.deque()
+
+    def full(self):
+        return len(self._queue) >= self.queueSize
+
+    def send(self, notification, callback = None):
+        """
+        Queue notification to send. Return False if queue is full.
+        """
+        if not isinstance(notification, notifications.APNSNotification):
+            raise APNSTypeError, "Unexpected argument type. Argument should be an instance of APNSNotification object"
+        if self.full():
+            return False
+        self._queue.append((notification, notification.payload(), callback))
+        return True
+
+    def writable(self):
+        if not self.connected or not self.handshaked:
+            return True
+        return len(self._buffer) > 0 or len(self._queue) > 0
+
+    def _fill(self):
+        """
+        Move queued frames to the write buffer until it reach bufferSize.
+        """
+        frames = []
+        size = len(self._buffer)
+        queue = self._queue
+        wasFull = self.full()
+
+        while queue and size < self.bufferSize:
+            notification, frame, callback = queue.popleft()
+            frames.append(frame)
+            size += len(frame)
+            self._pending.append((size, notification, callback))
+
+        if frames:
+            self._buffer = self._buffer + "".join(frames)
+
+        if wasFull and not self.full() and self.onDrain:
+            self.onDrain(self)
+
+    def handle_ssl_write(self):
+        self._fill()
+        if not self._buffer:
+            return
+
+        sent = self._send(self._buffer)
+        if sent == 0:
+            return
+        self._buffer = self._buffer[sent:]
+
+        # notify about frames which are completely written
+        pending = self._pending
+        while pending and pending[0][0] <= sent:
+            end, notification, callback = pending.popleft()
+            self.framesSent += 1
+            if callback:
+                callback(notification, None)
+        # shift offsets of frames which rest in the buffer
+        for i in xrange(len(pending)):
+            end, notification, callback = pending[i]
+            pending[i] = (end - sent, notification, callback)
+
+    def handle_ssl_read(self):
+        data = self._recv(6)
+        if data == None:
+            self.handle_close()
+        elif data:
+            # APNS server sends only error-response right before disconnect
+            self.lastError = data
+
+    def handle_close(self):
+        self.close()
+        error = APNSConnectionError("Connection to the APNS server is closed")
+        while self._pending:
+            end, notification, callback = self._pending.popleft()
+            if callback:
+                callback(notification, error)
+        while self._queue:
+            notification, frame, callback = self._queue.popleft()
+            if callback:
+                callback(notification, error)
+        self._buffer = ''
+
+
+class AsyncAPNSFeedbackWrapper(APNSAsyncConnection):
+    """
+    Non-blocking version of APNSFeedbackWrapper. Received tuples
+    ( datetime, deviceToken ) are collected to .feedbacks and passed
+    to the callback one by one. onDone callback is called when
+    the server closes connection.
+    """
+
+    apnsHost = 'feedback.push.apple.com'
+    apnsSandboxHost = 'feedback.sandbox.push.apple.com'
+    apnsPort = 2196
+
+    blockSize = 1024
+
+    def __init__(self, certificate = None, sandbox = True, callback = None, \
+                    on_done = None, map = None):
+        APNSAsyncConnection.__init__(self, certificate, sandbox, map)
+        self.callback = callback
+        self.onDone = on_done
+        self.feedbacks = []
+        self.done = False
+        self._parser = APNSFeedbackParser()
+
+    def __iter__(self):
+        return iter(self.feedbacks)
+
+    def tuples(self):
+        return self.feedbacks
+
+    def writable(self):
+        return not self.connected or not self.handshaked
+
+    def _parse(self, data):
+        for feedbackTime, deviceToken in self._parser.feed(data):
+            item = (datetime.datetime.fromtimestamp(feedbackTime), deviceToken)
+            self.feedbacks.append(item)
+            if self.callback:
+                self.callback(item)
+
+    def handle_ssl_read(self):
+        data = self._recv(self.blockSize)
+        while data:
+            self._parse(data)
+            # SSL layer may have decrypted data which select() can't see
+            if not self.socket.pending():
+                return
+            data = self._recv(self.blockSize)
+        if data == None:
+            self.handle_close()
+
+    def handle_close(self):
+        self.close()
+        if not self.done:
+            self.done = True
+            if self.onDone:
+                self.onDone(self)
@@ -12,12 +12,124 @@
 
 import ssl
 import os
+import time
+import errno
 import socket
+import select
+import threading
 import subprocess
 
 from apnsexceptions import *
 from utils import *
 
+# process-wide cache of SSL contexts: (path, mtime of certificate) -> SSLContext
+_SSL_CONTEXTS = {}
+# sessions of last connections: (path, mtime, host, port) -> SSLSession
+_SSL_SESSIONS = {}
+_SSL_LOCK = threading.Lock()
+
+# session resumption is available only if SSLSocket has session attribute
+SSL_SESSION_RESUMPTION = hasattr(ssl, 'SSLSocket') and hasattr(ssl.SSLSocket, 'session')
+
+# gateway certificate is verified by CA certificates of this file
+# or by the default CA store if it's None, see set_ssl_verification()
+_SSL_VERIFY = True
+_SSL_CA_FILE = None
+
+def set_ssl_verification(verify = True, ca_file = None):
+    """
+    Set whether certificate and host name of the APNS servers are
+    verified and file with CA certificates used instead of the default
+    CA store. Applies to connections opened after the call.
+    """
+    global _SSL_VERIFY, _SSL_CA_FILE
+    _SSL_LOCK.acquire()
+    try:
+        _SSL_VERIFY = verify
+        _SSL_CA_FILE = ca_file
+        _SSL_CONTEXTS.clear()
+        _SSL_SESSIONS.clear()
+    finally:
+        _SSL_LOCK.release()
+
+def _certificateKey(certificate):
+    path = os.path.abspath(certificate)
+    return (path, os.stat(path).st_mtime)
+
+def _sslContext(certificate):
+    """
+    Return shared SSLContext with loaded certificate. Context is
+    created once per certificate file and recreated when the file is
+    modified. Return None if ssl module doesn't support SSLContext.
+    """
+    if not hasattr(ssl, 'SSLContext'):
+        return None
+    
+    key = _certificateKey(certificate)
+    _SSL_LOCK.acquire()
+    try:
+        context = _SSL_CONTEXTS.get(key)
+        if context != None:
+            return context
+        
+        # TLS version is negotiated, old SSL versions are disabled
+        context = ssl.SSLContext(getattr(ssl, 'PROTOCOL_TLS', ssl.PROTOCOL_SSLv23))
+        context.options |= getattr(ssl, 'OP_NO_SSLv2', 0) | getattr(ssl, 'OP_NO_SSLv3', 0)
+        context.load_cert_chain(key[0])
+        
+        if _SSL_VERIFY:
+            context.verify_mode = ssl.CERT_REQUIRED
+            if _SSL_CA_FILE != None:
+                context.load_verify_locations(_SSL_CA_FILE)
+            else:
+                context.load_default_certs()
+            # host name is checked during handshake if it is sent by SNI
+            context.check_hostname = ssl.HAS_SNI
+        
+        # forget contexts of the previous versions of the file
+        for stale in [k for k in _SSL_CONTEXTS if k[0] == key[0]]:
+            del _SSL_CONTEXTS[stale]
+        _SSL_CONTEXTS[key] = context
+        return context
+    finally:
+        _SSL_LOCK.release()
+
+def _sslWrap(sock, certificate, host = None, **kwargs):
+    """
+    Wrap plain socket to the SSL socket with APNS certificate. Host is
+    the server name which is verified and sent by SNI.
+    """
+    context = _sslContext(certificate)
+    if context == None:
+        # old ssl module can verify certificate only by the CA file
+        if _SSL_VERIFY and _SSL_CA_FILE != None:
+            kwargs['cert_reqs'] = ssl.CERT_REQUIRED
+            kwargs['ca_certs'] = _SSL_CA_FILE
+        return ssl.wrap_socket(
+                    sock, 
+                    ssl_version = ssl.PROTOCOL_SSLv23, 
+                    certfile = certificate,
+                    **kwargs
+                )
+    if ssl.HAS_SNI:
+        kwargs['server_hostname'] = host
+    return context.wrap_socket(sock, **kwargs)
+
+def _sslSession(certificate, host, port, session = None):
+    """
+    Return saved SSL session for the host or save new one.
+    """
+    if not SSL_SESSION_RESUMPTION:
+        return None
+    key = _certificateKey(certificate) + (host, port)
+    _SSL_LOCK.acquire()
+    try:
+        if session != None:
+            _SSL_SESSIONS[key] = session
+        return _SSL_SESSIONS.get(key)
+    finally:
+        _SSL_LOCK.release()
+
 class APNSConnectionContext(object):
     certificate = None    
     def __init__(self, certificate = None):
@@ -30,12 +142,23 @@ class APNSConnectionContext(object):
         raise APNSNotImplementedMethod, "APNSConnectionContext.read method not implemented"
     def close(self):
         raise APNSNotImplementedMethod, "APNSConnectionContext.close method not implemented"
+    def writev(self, buffers):
+        data = "".join([isinstance(b, str) and b or memoryview(b).tobytes() for b in buffers])
+        self.write(data)
+        return len(data)
+    def alive(self):
+        return True
+    def readable(self, timeout = 0):
+        return False
 
     
 
 class OpenSSLCommandLine(APNSConnectionContext):
     """
-    This class execute and send data with openssl command line tool
+    This class execute and send data with openssl command line tool.
+    One "openssl s_client -quiet" process is started by connect() and
+    it is kept alive while connection is used: data is streamed to its
+    stdin and read from its stdout.
     """
     
     certificate = None
@@ -43,64 +166,109 @@ class OpenSSLCommandLine(APNSConnectionContext):
     port = None
     executable = None
     debug = False
+    process = None
+    
     def __init__(self, certificate = None, executable = None, debug = False):
         self.certificate = certificate
         self.executable = executable
         self.debug = debug
+        self.process = None
         
     def connect(self, host, port):
         self.host = host
         self.port = port
+        if self.process != None:
+            self.close()
+        self.process = self._command()
         
     def _command(self):
-        command = "%(executable)s s_client -ssl3 -cert %(cert)s -connect %(host)s:%(port)s" % \
+        command = "%(executable)s s_client -quiet -cert %(cert)s -connect %(host)s:%(port)s" % \
             {
             'executable' : self.executable,
             'cert' : self.certificate,
             'host' : self.host,
             'port' : self.port
             }
-
-        return subprocess.Popen(command.split(' '), shell=False, bufsize=256, \
-            stdin=subprocess.PIPE, stdout = subprocess.PIPE, stderr = subprocess.PIPE)                
-            
-    def write(self, data = None):
-        pipe = self._command()
-
-        std_in = pipe.stdin
-        std_in.write(data)
-        std_in.flush()        
-        std_in.close()
-
-        std_out = pipe.stdout        
+        
         if self.debug:
             print "-------------- SSL Debug Output --------------"
             print command
             print "----------------------------------------------"
-            print std_out.read()
-            std_out.close()
-        pipe.wait()        
+            stderr = None
+        else:
+            stderr = open(os.devnull, 'w')
+        
+        try:
+            return subprocess.Popen(command.split(' '), shell=False, bufsize=0, \
+                stdin=subprocess.PIPE, stdout = subprocess.PIPE, stderr = stderr)
+        finally:
+            if stderr != None:
+                stderr.close()
     
-    def read(self, blockSize = 1024):
-    	"""
-    	There is method to read data from feedback service.
-    	WARNING! It's not tested and doesn't work yet!
-    	"""
-        pipe = self._command()
-        std_out = pipe.stdout       
-
-        data = std_out.read()
-
-        #pipe.wait()
-        std_out.close()
-        return data
+    def _process(self):
+        # IOError is handled by wrappers like dropped socket connection
+        if self.process == None or self.process.poll() != None:
+            raise IOError(errno.EPIPE, "openssl s_client process for %s:%s isn't running" % \
+                (str(self.host), str(self.port)))
+        return self.process
             
+    def write(self, data = None):
+        if isinstance(data, (memoryview, bytearray)):
+            data = str(memoryview(data).tobytes())
+        std_in = self._process().stdin
+        std_in.write(data)
+        std_in.flush()
+    
+    def read(self, blockSize = 1024, timeout = None):
+        """
+        Read block of data from s_client output. Return empty string
+        when server closed connection and None if there is no data
+        during timeout seconds.
+        """
+        if self.process == None:
+            return ''
+        if timeout != None and not self.readable(timeout):
+            return None
+        return os.read(self.process.stdout.fileno(), blockSize)
+        
+    def readable(self, timeout = 0):
+        if self.process == None:
+            return False
+        try:
+            readable = select.select([self.process.stdout], [], [], timeout)[0]
+        except (select.error, ValueError):
+            return True
+        return len(readable) > 0
+        
+    def alive(self):
+        """
+        Check that s_client process is running and server didn't send
+        anything (APNS server sends only error-response before disconnect).
+        """
+        return self.process != None and self.process.poll() == None and not self.readable(0)
         
     def context(self):
         return self
         
     def close(self):
-        pass
+        """
+        Stop s_client process.
+        """
+        process = self.process
+        self.process = None
+        if process == None:
+            return
+        try:
+            process.stdin.close()
+        except (IOError, OSError):
+            pass
+        if process.poll() == None:
+            try:
+                process.terminate()
+            except OSError:
+                pass
+        process.wait()
+        process.stdout.close()
 
 class SSLModuleConnection(APNSConnectionContext):
     """
@@ -112,6 +280,9 @@ class SSLModuleConnection(APNSConnectionContext):
     certificate = None
     connectionContext = None
     
+    # small buffers are coalesced to blocks of this size
+    sendBufferSize = 16384
+    
     def __init__(self, certificate = None):
         self.socket = None
         self.connectionContext = None
@@ -121,15 +292,11 @@ class SSLModuleConnection(APNSConnectionContext):
         """
         Initialize SSL context.
         """
-        if self.connectionContext != None:
+        if self.socket != None:
             return self
-                            
+        
+        # socket is wrapped by connect() when server name is known
         self.socket = socket.socket()
-        self.connectionContext = ssl.wrap_socket(
-                    self.socket, 
-                    ssl_version = ssl.PROTOCOL_SSLv3, 
-                    certfile = self.certificate
-                )     
                 
         return self
 
@@ -138,34 +305,183 @@ class SSLModuleConnection(APNSConnectionContext):
         self.certificate = path
         return self
 
-    def read(self, blockSize = 1024):
+    def read(self, blockSize = 1024, timeout = None):
         """
-        Make connection to the host and port.
+        Read block of data. If timeout is set and there is no data
+        during timeout seconds return None.
         """
+        if timeout == None:
+            return self.connectionContext.read(blockSize)
     
-        return self.connectionContext.read(blockSize)
+        self.connectionContext.settimeout(timeout)
+        try:
+            try:
+                return self.connectionContext.read(blockSize)
+            except socket.timeout:
+                return None
+            except ssl.SSLError, e:
+                if 'timed out' in str(e):
+                    return None
+                raise
+        finally:
+            if self.connectionContext != None:
+                self.connectionContext.settimeout(None)
         
+    def _sendall(self, data):
+        """
+        Write whole buffer (string, bytearray or memoryview) without
+        copying it. Partial writes are continued from the offset and
+        write is repeated when SSL layer wants to wait for socket.
+        """
+        sslSocket = self.connectionContext
+        view = None
+        length = len(data)
+        offset = 0
+        
+        while offset < length:
+            if view == None:
+                # whole buffer is usually written by the first call
+                chunk = data
+            else:
+                chunk = view[offset:]
+
+            try:
+                sent = sslSocket.send(chunk)
+            except ssl.SSLError, e:
+                if e.args[0] == ssl.SSL_ERROR_WANT_READ:
+                    select.select([sslSocket], [], [])
+                    continue
+                if e.args[0] != ssl.SSL_ERROR_WANT_WRITE:
+                    raise
+                sent = 0
+            except socket.error, e:
+                if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                    raise
+                sent = 0
+                
+            if sent == 0:
+                select.select([], [sslSocket], [])
+            elif view == None and sent < length:
+                view = memoryview(data)
+            offset += sent
+            
     def write(self, data = None):
         """
-        Make connection to the host and port.
+        Write data to the connection.
         """
-    
-        self.connectionContext.write(data)
+        self._sendall(data)
+        
+    def writev(self, buffers):
+        """
+        Write sequence of buffers. Small buffers are joined to blocks
+        of about sendBufferSize bytes, so whole sequence is never copied
+        to one string. Buffers larger than it are written directly.
+        Return number of written bytes.
+        """
+        size = self.sendBufferSize
+        block = []
+        used = 0
+        written = 0
+        
+        for data in buffers:
+            length = len(data)
+            if length >= size:
+                if used > 0:
+                    self._sendall("".join(block))
+                    block = []
+                    written += used
+                    used = 0
+                self._sendall(data)
+                written += length
+                continue
+            if type(data) is not str:
+                data = memoryview(data).tobytes()
+            block.append(data)
+            used += length
+            if used >= size:
+                self._sendall("".join(block))
+                block = []
+                written += used
+                used = 0
                 
+        if used > 0:
+            self._sendall("".join(block))
+        return written + used
+        
     def connect(self, host, port):
         """
-        Make connection to the host and port.
+        Make connection to the host and port. Previous SSL session
+        is resumed if ssl module supports it.
         """
-    
-        self.connectionContext.connect((host, port))    
+        try:
+            self.connectionContext = _sslWrap(self.socket, self.certificate, host)
+            session = _sslSession(self.certificate, host, port)
+            if session != None:
+                self.connectionContext.session = session
+
+            self.connectionContext.connect((host, port))
+        except getattr(ssl, 'CertificateError', ()), e:
+            self._discard()
+            # it's ValueError, but callers expect connection errors
+            raise APNSConnectionError, "Certificate of %s isn't valid: %s" % (host, str(e))
+        except:
+            # half-connected SSL socket can't be connected again,
+            # next connect() will create fresh one
+            self._discard()
+            raise
+
+        if SSL_SESSION_RESUMPTION:
+            _sslSession(self.certificate, host, port, self.connectionContext.session)
+
+    def readable(self, timeout = 0):
+        """
+        Wait up to timeout seconds until data will be available to read.
+        """
+        if self.connectionContext == None:
+            return False
+        if self.connectionContext.pending():
+            return True
+        try:
+            readable = select.select([self.connectionContext], [], [], timeout)[0]
+        except (select.error, socket.error, ValueError):
+            return True
+        return len(readable) > 0
+
+    def alive(self):
+        """
+        Check connection health. APNS server never sends data except
+        error-response before disconnect, so readable socket means
+        connection is dropped or going to be dropped.
+        """
+        if self.connectionContext == None:
+            return False
+        return not self.readable(0)
 
     def close(self):
         """
         Close connection.
         """
-        self.connectionContext.close()
+        if self.connectionContext != None:
+            self.connectionContext.close()
         self.socket.close()    
         
+        # next call of context() will create fresh SSL socket
+        self.connectionContext = None
+        self.socket = None
+
+    def _discard(self):
+        """
+        Close sockets ignoring errors and forget them.
+        """
+        for sock in (self.connectionContext, self.socket):
+            if sock != None:
+                try:
+                    sock.close()
+                except (socket.error, IOError, OSError):
+                    pass
+        self.connectionContext = None
+        self.socket = None
+        
         
 class APNSConnection(APNSConnectionContext):
     """
@@ -174,6 +490,12 @@ class APNSConnection(APNSConnectionContext):
     
     debug = False
     connectionContext = None
+    connected = False
+    
+    # statistics of the connection usage
+    handshakes = 0
+    bytesSent = 0
+    lastActivity = None
     
     def __init__(self, certificate = None, 
                         ssl_command = "openssl",
@@ -182,6 +504,10 @@ class APNSConnection(APNSConnectionContext):
                         debug = False):
         self.connectionContext = None
         self.debug = debug
+        self.connected = False
+        self.handshakes = 0
+        self.bytesSent = 0
+        self.lastActivity = None
                 
         if not os.path.exists(str(certificate)):
             raise APNSCertificateNotFoundError, "Apple Push Notification Service Certificate file %s not found." % str(certificate)
@@ -212,6 +538,9 @@ class APNSConnection(APNSConnectionContext):
         Make connection to the host and port.
         """
         self.context().connect(host, port)
+        self.connected = True
+        self.handshakes += 1
+        self.lastActivity = time.time()
         return self
 
     def certificate(self, path):
@@ -220,9 +549,46 @@ class APNSConnection(APNSConnectionContext):
     
     def write(self, data = None):
         self.context().write(data)
+        self.bytesSent += len(data)
+        self.lastActivity = time.time()
         
-    def read(self, blockSize = 1024):
-        return self.context().read(blockSize)
+    def writev(self, buffers):
+        """
+        Write list of buffers (strings, bytearrays or memoryviews)
+        without joining them to one string.
+        """
+        self.bytesSent += self.context().writev(buffers)
+        self.lastActivity = time.time()
+        
+    def read(self, blockSize = 1024, timeout = None):
+        if timeout == None:
+            data = self.context().read(blockSize)
+        else:
+            data = self.context().read(blockSize, timeout)
+        self.lastActivity = time.time()
+        return data
+
+    def alive(self):
+        """
+        Return True if connection is opened and looks healthy.
+        """
+        return self.connected and self.context().alive()
+
+    def readable(self, timeout = 0):
+        """
+        Return True if data (e.g. error-response) can be read from
+        connection without blocking.
+        """
+        return self.connected and self.context().readable(timeout)
+
+    def idle(self):
+        """
+        Return number of seconds since last I/O operation or
+        None if connection was never used.
+        """
+        if self.lastActivity == None:
+            return None
+        return time.time() - self.lastActivity
                 
     def context(self):
         if not self.connectionContext:
@@ -233,5 +599,6 @@ class APNSConnection(APNSConnectionContext):
         """
         Close connection.
         """
+        self.connected = False
         self.context().close()
 
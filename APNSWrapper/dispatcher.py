@@ -0,0 +1,426 @@
+# Copyright 2009 Max Klymyshyn, Sonettic
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#    http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import time
+import socket
+import threading
+import collections
+
+from connection import *
+from apnsexceptions import *
+import notifications
+
+class APNSTenant(object):
+    """
+    State of one application (certificate) of APNSDispatcher: queue
+    of frames and warm connections. Connections in .idle are opened
+    and not used by any worker.
+    """
+
+    def __init__(self, name, certificate, sandbox = True):
+        self.name = name
+        self.certificate = certificate
+        self.sandbox = sandbox
+        self.frames = collections.deque()
+        self.idle = []
+        self.active = 0
+        self.scheduled = False
+        self.lastUsed = time.time()
+
+        self.framesSent = 0
+        self.bytesSent = 0
+        self.handshakes = 0
+        self.errors = 0
+        self.evictions = 0
+
+    def connections(self):
+        return len(self.idle) + self.active
+
+
+class APNSDispatcher(object):
+    """
+    Sender for many applications, each with its own certificate.
+    Notifications are routed by tenant name to the tenant queue and
+    sent through warm connections of the tenant:
+
+        dispatcher = APNSDispatcher(workers = 4)
+        dispatcher.register('app1', 'app1.pem')
+        dispatcher.append('app1', notification)
+
+    Worker threads are shared by all tenants. Tenants with queued
+    frames are served in round-robin order and worker takes at most
+    bufferSize bytes of frames from the tenant at once, so one big
+    campaign can't starve other tenants.
+
+    Each tenant uses up to connections_per_tenant connections and all
+    tenants together keep up to max_connections opened. When limit is
+    reached idle connection of the least recently used tenant is
+    closed. Connections idle more than idle_timeout or dropped by the
+    server are closed every health_check_interval seconds.
+    """
+
+    apnsHost = 'gateway.push.apple.com'
+    apnsSandboxHost = 'gateway.sandbox.push.apple.com'
+    apnsPort = 2195
+
+    workers = 4
+    connectionsPerTenant = 2
+    maxConnections = 64
+    bufferSize = 16384
+    queueSize = 10000
+    idleTimeout = 300
+    healthCheckInterval = 30
+    onError = None
+
+    # how long workers wait before they check state again
+    checkInterval = 1
+
+    def __init__(self, workers = 4, connections_per_tenant = 2, max_connections = 64, \
+                    buffer_size = 16384, queue_size = 10000, idle_timeout = 300, \
+                    health_check_interval = 30, force_ssl_command = False, debug_ssl = False, on_error = None):
+        if not isinstance(workers, int) or workers < 1:
+            raise APNSValueError, "Number of workers should be a positive number"
+        if connections_per_tenant < 1 or max_connections < connections_per_tenant:
+            raise APNSValueError, "max_connections should be not less than connections_per_tenant"
+
+        self.workers = workers
+        self.connectionsPerTenant = connections_per_tenant
+        self.maxConnections = max_connections
+        self.bufferSize = buffer_size
+        self.queueSize = queue_size
+        self.idleTimeout = idle_timeout
+        self.healthCheckInterval = health_check_interval
+        self.force_ssl_command = force_ssl_command
+        self.debug_ssl = debug_ssl
+        self.onError = on_error
+
+        self.tenants = {}
+        self.failed = []
+        self._ready = collections.deque()
+        self._threads = []
+        self._opened = 0
+        self._stopped = False
+        self._lastCheck = time.time()
+        self._lock = threading.Lock()
+        self._condition = threading.Condition(self._lock)
+
+    def _host(self, tenant):
+        if tenant.sandbox != True:
+            return self.apnsHost
+        return self.apnsSandboxHost
+
+    def register(self, name, certificate, sandbox = True):
+        """
+        Add tenant with its certificate. Registered tenant may be
+        changed only after its queue is sent.
+        """
+        if not os.path.exists(str(certificate)):
+            raise APNSCertificateNotFoundError, "Apple Push Notification Service Certificate file %s not found." % str(certificate)
+
+        self._lock.acquire()
+        try:
+            tenant = self.tenants.get(name)
+            if tenant != None and (len(tenant.frames) > 0 or tenant.active > 0):
+                raise APNSValueError, "Tenant %s has unsent notifications" % str(name)
+            if tenant != None:
+                self._closeIdle(tenant, len(tenant.idle))
+            self.tenants[name] = APNSTenant(name, certificate, sandbox)
+        finally:
+            self._lock.release()
+        return self
+
+    def start(self):
+        """
+        Start worker threads. It is called implicitly by first .append()
+        """
+        if len(self._threads) > 0:
+            return self
+        # producers may call the first .write() at once
+        self._lock.acquire()
+        try:
+            if len(self._threads) > 0:
+                return self
+            threads = []
+            for i in xrange(self.workers):
+                thread = threading.Thread(target = self._run)
+                thread.daemon = True
+                thread.start()
+                threads.append(thread)
+            self._threads = threads
+        finally:
+            self._lock.release()
+        return self
+
+    def write(self, name, frame):
+        """
+        Queue already encoded binary frame for the tenant. Blocks when
+        queue of the tenant is full.
+        """
+        self.start()
+        self._condition.acquire()
+        try:
+            tenant = self.tenants.get(name)
+            if tenant == None:
+                raise APNSValueError, "Unknown tenant %s" % str(name)
+            while len(tenant.frames) >= self.queueSize:
+                self._condition.wait()
+            tenant.frames.append(frame)
+            self._schedule(tenant)
+        finally:
+            self._condition.release()
+
+    def append(self, name, notification = None):
+        """
+        Queue APNSNotification to send with certificate of the tenant.
+        """
+        if not isinstance(notification, notifications.APNSNotification):
+            raise APNSTypeError, "Unexpected argument type. Argument should be an instance of APNSNotification object"
+        self.write(name, notification.payload())
+
+    def _schedule(self, tenant):
+        """
+        Put tenant to the end of round-robin queue if it has frames and
+        may use one more connection. Called with the lock held.
+        """
+        if tenant.scheduled or len(tenant.frames) == 0:
+            return
+        if len(tenant.idle) == 0 and tenant.active >= self.connectionsPerTenant:
+            return
+        tenant.scheduled = True
+        self._ready.append(tenant)
+        self._condition.notifyAll()
+
+    def _connection(self, tenant):
+        return APNSConnection(certificate = tenant.certificate, \
+                    force_ssl_command = self.force_ssl_command, debug = self.debug_ssl)
+
+    def _close(self, connection):
+        self._opened -= 1
+        try:
+            connection.close()
+        except (socket.error, IOError, OSError):
+            pass
+
+    def _closeIdle(self, tenant, count):
+        for i in xrange(min(count, len(tenant.idle))):
+            self._close(tenant.idle.pop(0))
+
+    def _evict(self):
+        """
+        Close idle connection of the least recently used tenant.
+        Return False if all opened connections are in use.
+        """
+        candidates = [t for t in self.tenants.itervalues() if len(t.idle) > 0]
+        if len(candidates) == 0:
+            return False
+        tenant = min(candidates, key = lambda t: t.lastUsed)
+        tenant.evictions += 1
+        self._closeIdle(tenant, 1)
+        return True
+
+    def _checkIdle(self):
+        """
+        Close dropped connections and connections which were idle
+        longer than idleTimeout.
+        """
+        now = time.time()
+        if now - self._lastCheck < self.healthCheckInterval:
+            return
+        self._lastCheck = now
+        for tenant in self.tenants.itervalues():
+            opened = []
+            for connection in tenant.idle:
+                idle = connection.idle()
+                expired = self.idleTimeout != None and idle != None and idle >= self.idleTimeout
+                if expired or not connection.alive():
+                    self._close(connection)
+                else:
+                    opened.append(connection)
+            tenant.idle = opened
+
+    def _take(self):
+        """
+        Wait for the next tenant and take its connection and frames
+        (up to bufferSize bytes). Return None when dispatcher is stopped.
+        Called with the lock held.
+        """
+        while True:
+            while len(self._ready) == 0:
+                if self._stopped:
+                    return None
+                self._checkIdle()
+                self._condition.wait(self.checkInterval)
+
+            tenant = self._ready.popleft()
+            tenant.scheduled = False
+
+            if len(tenant.idle) > 0:
+                connection = tenant.idle.pop()
+            elif self._opened < self.maxConnections or self._evict():
+                connection = self._connection(tenant)
+                self._opened += 1
+            else:
+                # all connections are busy, tenant waits for the next turn
+                self._ready.append(tenant)
+                tenant.scheduled = True
+                self._condition.wait(self.checkInterval)
+                continue
+
+            frames = []
+            size = 0
+            while len(tenant.frames) > 0 and size < self.bufferSize:
+                frame = tenant.frames.popleft()
+                frames.append(frame)
+                size += len(frame)
+
+            tenant.active += 1
+            tenant.lastUsed = time.time()
+            # queue of the tenant has free space now
+            self._condition.notifyAll()
+            # rest of frames may be sent by other connection of the tenant
+            self._schedule(tenant)
+            return tenant, connection, frames
+
+    def _release(self, tenant, connection):
+        """
+        Return connection of the tenant after write. Called with the lock held.
+        """
+        tenant.active -= 1
+        if connection.connected:
+            tenant.idle.append(connection)
+        else:
+            self._opened -= 1
+        self._schedule(tenant)
+        self._condition.notifyAll()
+
+    def _write(self, tenant, connection, frames):
+        handshakes = connection.handshakes
+        try:
+            if not connection.connected:
+                connection.connect(self._host(tenant), self.apnsPort)
+            connection.writev(frames)
+        except (socket.error, IOError, OSError):
+            if connection.connected:
+                connection.close()
+            if connection.handshakes != handshakes:
+                raise
+            # reused connection was dropped, try once again with new one
+            connection.connect(self._host(tenant), self.apnsPort)
+            connection.writev(frames)
+
+    def _run(self):
+        while True:
+            self._condition.acquire()
+            try:
+                taken = self._take()
+            finally:
+                self._condition.release()
+            if taken == None:
+                break
+
+            tenant, connection, frames = taken
+            handshakes = connection.handshakes
+            error = None
+            try:
+                try:
+                    self._write(tenant, connection, frames)
+                except Exception, e:
+                    # any error (e.g. failed certificate verification)
+                    # fails only these frames, worker keeps running
+                    error = e
+                    if connection.connected:
+                        connection.close()
+            finally:
+                # connection is always returned, so .join() doesn't wait for it
+                self._condition.acquire()
+                try:
+                    tenant.handshakes += connection.handshakes - handshakes
+                    if error == None:
+                        tenant.framesSent += len(frames)
+                        tenant.bytesSent += sum([len(f) for f in frames])
+                    else:
+                        tenant.errors += 1
+                    self._release(tenant, connection)
+                finally:
+                    self._condition.release()
+
+            if error != None:
+                self._error(tenant, frames, error)
+
+    def _error(self, tenant, frames, exception):
+        if self.onError:
+            self.onError(tenant.name, frames, exception)
+        else:
+            self._lock.acquire()
+            try:
+                self.failed.extend([(tenant.name, f) for f in frames])
+            finally:
+                self._lock.release()
+
+    def join(self):
+        """
+        Wait until all queued frames will be sent.
+        """
+        self._condition.acquire()
+        try:
+            while [t for t in self.tenants.itervalues() if len(t.frames) > 0 or t.active > 0]:
+                self._condition.wait(self.checkInterval)
+        finally:
+            self._condition.release()
+
+    def close(self):
+        """
+        Send queued frames, stop worker threads and close connections.
+        """
+        self.join()
+        self._condition.acquire()
+        try:
+            self._stopped = True
+            self._condition.notifyAll()
+        finally:
+            self._condition.release()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+        self._stopped = False
+
+        self._lock.acquire()
+        try:
+            for tenant in self.tenants.itervalues():
+                self._closeIdle(tenant, len(tenant.idle))
+        finally:
+            self._lock.release()
+
+    def statistics(self):
+        """
+        Return statistics of the dispatcher and of each tenant.
+        """
+        self._lock.acquire()
+        try:
+            tenants = {}
+            for name, t in self.tenants.iteritems():
+                tenants[name] = {
+                    'connections' : t.connections(),
+                    'handshakes' : t.handshakes,
+                    'frames' : t.framesSent,
+                    'bytes' : t.bytesSent,
+                    'errors' : t.errors,
+                    'evictions' : t.evictions,
+                    'backlog' : len(t.frames)
+                }
+            return {
+                'connections' : self._opened,
+                'frames' : sum([t['frames'] for t in tenants.itervalues()]),
+                'tenants' : tenants
+            }
+        finally:
+            self._lock.release()
@@ -9,16 +9,203 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import datetime
 import sys
+import array
+import socket
+import threading
 import struct
+import binascii
+import datetime
 
 from connection import *
+from apnsexceptions import *
+
+class APNSFeedbackParser(object):
+    """
+    Incremental parser of Feedback Service tuples. Blocks of data are
+    parsed by offset without slicing the rest of the block, only partial
+    trailing tuple is carried to the next block.
+    Format of tuple is |xxxx|yy|zzzzzzzz|
+        where:
+            x is time_t (UNIXTIME, 4 bytes)
+            y is length of z (two bytes)
+            z is device token
+    """
+    header = struct.Struct('!IH')
+
+    def __init__(self):
+        self.rest = ''
+
+    def feed(self, block):
+        """
+        Parse block of data and yield ( timestamp, deviceToken ) tuples.
+        """
+        if self.rest:
+            block = self.rest + block
+            
+        header = self.header
+        headerSize = header.size
+        blockLength = len(block)
+        offset = 0
+        
+        while blockLength - offset >= headerSize:
+            feedbackTime, tokenLength = header.unpack_from(block, offset)
+            start = offset + headerSize
+            end = start + tokenLength
+            if end > blockLength:
+                break
+            offset = end
+            yield (feedbackTime, block[start:end])
+            
+        self.rest = block[offset:]
+        
+    def done(self):
+        """
+        Return True if there is no partial tuple left.
+        """
+        return len(self.rest) == 0
+
+
+class APNSFeedbackColumns(object):
+    """
+    Compact columnar Feedback Service results: timestamps are kept in
+    array('l') column and deviceTokens in one contiguous bytearray
+    of tokenLength * N bytes. Results may be written to CSV, NDJSON
+    or binary file by one bulk operation.
+    """
+    __slots__ = ('tokenLength', 'timestamps', 'tokens')
+    
+    # binary file header: number of rows and length of token
+    binaryHeader = struct.Struct('!II')
+    # number of rows formatted at once by text writers
+    chunkRows = 4096
+    
+    def __init__(self, tokenLength = 32):
+        self.tokenLength = tokenLength
+        self.timestamps = array.array('l')
+        self.tokens = bytearray()
+        
+    def __len__(self):
+        return len(self.timestamps)
+        
+    def append(self, timestamp, token):
+        if len(token) != self.tokenLength:
+            raise APNSValueError, "Length of deviceToken should be %d bytes" % self.tokenLength
+        self.timestamps.append(timestamp)
+        self.tokens.extend(token)
+        return self
+        
+    def token(self, index):
+        tokenLength = self.tokenLength
+        return str(self.tokens[index * tokenLength:(index + 1) * tokenLength])
+        
+    def rows(self):
+        """
+        Iterate over ( timestamp, deviceToken ) of the rows.
+        """
+        for i in xrange(len(self)):
+            yield (self.timestamps[i], self.token(i))
+            
+    def dedupe(self):
+        """
+        Return new columns with one row per deviceToken which keeps
+        the newest timestamp. Rows are in order of first occurrence.
+        """
+        newest = {}
+        order = []
+        timestamps = self.timestamps
+        for i in xrange(len(self)):
+            token = self.token(i)
+            index = newest.get(token)
+            if index == None:
+                newest[token] = i
+                order.append(token)
+            elif timestamps[i] > timestamps[index]:
+                newest[token] = i
+                
+        result = APNSFeedbackColumns(self.tokenLength)
+        result.tokens = bytearray("".join(order))
+        result.timestamps = array.array('l', [timestamps[newest[t]] for t in order])
+        return result
+        
+    def numpy(self):
+        """
+        Return ( timestamps, tokens ) NumPy arrays which share memory
+        with the columns: int array and uint8 array of N x tokenLength.
+        Requires NumPy.
+        """
+        import numpy
+        timestamps = numpy.frombuffer(self.timestamps, dtype = 'l')
+        tokens = numpy.frombuffer(self.tokens, dtype = numpy.uint8).reshape(-1, self.tokenLength)
+        return timestamps, tokens
+        
+    def _writeText(self, fileobj, line):
+        hexTokens = binascii.hexlify(self.tokens)
+        hexLength = self.tokenLength * 2
+        timestamps = self.timestamps
+        
+        for start in xrange(0, len(self), self.chunkRows):
+            end = min(start + self.chunkRows, len(self))
+            fileobj.write("".join([line % (timestamps[i], hexTokens[i * hexLength:(i + 1) * hexLength]) \
+                                for i in xrange(start, end)]))
+                                
+    def write_csv(self, fileobj, header = True):
+        """
+        Write rows as CSV with timestamp and hex deviceToken columns.
+        """
+        if header:
+            fileobj.write("timestamp,token\r\n")
+        self._writeText(fileobj, "%d,%s\r\n")
+        
+    def write_ndjson(self, fileobj):
+        """
+        Write rows as newline delimited JSON objects.
+        """
+        self._writeText(fileobj, '{"timestamp":%d,"token":"%s"}\n')
+        
+    def write_binary(self, fileobj):
+        """
+        Write columns to binary file: header with number of rows and
+        length of token, big-endian 4 bytes timestamps and tokens.
+        """
+        timestamps = array.array('I', self.timestamps)
+        if sys.byteorder == 'little':
+            timestamps.byteswap()
+        fileobj.write(self.binaryHeader.pack(len(self), self.tokenLength))
+        fileobj.write(timestamps.tostring())
+        fileobj.write(self.tokens)
+        
+    @classmethod
+    def read_binary(cls, fileobj):
+        """
+        Load columns written by write_binary()
+        """
+        count, tokenLength = cls.binaryHeader.unpack(fileobj.read(cls.binaryHeader.size))
+        timestamps = array.array('I')
+        timestamps.fromstring(fileobj.read(count * timestamps.itemsize))
+        if sys.byteorder == 'little':
+            timestamps.byteswap()
+        
+        result = cls(tokenLength)
+        result.timestamps = array.array('l', timestamps)
+        result.tokens = bytearray(fileobj.read(count * tokenLength))
+        if len(result.tokens) != count * tokenLength:
+            raise APNSValueError, "Unexpected end of binary feedback file"
+        return result
+
 
 class APNSFeedbackWrapper(object):
     """
     This object wrap Apple Push Notification Feedback Service tuples.
     Object support for iterations and may work with routine cycles like for.
+    
+    In lazy mode iteration over the object reads tuples directly from
+    connection, so each tuple is available as soon as it is received
+    and tuples aren't collected in memory. Set convert_time to False
+    to get UNIX timestamps instead of datetime objects.
+    
+    Received tokens are added to the suppression index (see
+    APNSSuppressionIndex) if it is passed.
     """
     sandbox = True
     apnsHost = 'feedback.push.apple.com'
@@ -27,18 +214,20 @@ class APNSFeedbackWrapper(object):
     feedbacks = None
     connection = None
     testingParser = False
+    lazy = False
+    convertTime = True
+    suppression = None
     
     blockSize = 1024 # default size of SSL reply block is 1Kb
     feedbackHeaderSize = 6
     
-    enlargeRecursionLimit = lambda self: sys.setrecursionlimit(sys.getrecursionlimit() + 100)
-
     _currentTuple = 0
     _tuplesCount = 0
     
-    def __init__(self, certificate = None, sandbox = True, force_ssl_command = False, debug_ssl = False):
+    def __init__(self, certificate = None, sandbox = True, force_ssl_command = False, debug_ssl = False, \
+                    lazy = False, convert_time = True, suppression = None):
         self.debug_ssl = debug_ssl
-        self.force_ssl_command = False
+        self.force_ssl_command = force_ssl_command
         self.connection = APNSConnection(certificate = certificate, \
                             force_ssl_command = self.force_ssl_command, debug = self.debug_ssl)
                                 
@@ -46,8 +235,13 @@ class APNSFeedbackWrapper(object):
         self.feedbacks = []
         self._currentTuple = 0
         self._tuplesCount = 0
+        self.lazy = lazy
+        self.convertTime = convert_time
+        self.suppression = suppression
 
     def __iter__(self):
+        if self.lazy:
+            return self.stream(self.convertTime)
         return self
         
     def next(self):
@@ -58,19 +252,6 @@ class APNSFeedbackWrapper(object):
         self._currentTuple += 1
         return obj
         
-    def _parse_reply(self, reply):
-        flag = True
-        offset = 0
-        while(flag):
-            try:
-                feedbackTime, tokenLength = struct.unpack_from('!lh', reply, offset)
-                deviceToken = struct.unpack_from('%ds' % tokenLength, reply, offset + 6)[0]
-                offset += 6 + len(deviceToken)
-                
-                self._append(feedbackTime, deviceToken)                
-            except:
-                flag = False
-        
     def tuples(self):
         """
         This method return a list with all received deviceTokens:
@@ -79,96 +260,198 @@ class APNSFeedbackWrapper(object):
         return self.feedbacks
     
     def _append(self, fTime, token):
-        self.feedbacks.append((datetime.datetime.fromtimestamp(fTime), token))
+        if self.convertTime:
+            fTime = datetime.datetime.fromtimestamp(fTime)
+        self.feedbacks.append((fTime, token))
         self._tuplesCount = len(self.feedbacks)
     
-    def _parseHeader(self, Buff):
-        """
-        Parse header of Feedback Service tuple.
-        Format of Buff is |xxxx|yy|zzzzzzzz|
-            where:
-                x is time_t (UNIXTIME, long, 4 bytes)
-                y is length of z (two bytes)
-                z is device token
-        """
-        try:
-            feedbackTime, tokenLength = struct.unpack_from('!lh', Buff, 0)
-            if Buff >= self.feedbackHeaderSize + tokenLength:
-                recoursiveInvoke = lambda: self._parseTuple(feedbackTime, tokenLength, Buff[self.feedbackHeaderSize:])
-                
-                # enlarge recursion limit if it is exceeded                
-                try:
-                    return recoursiveInvoke()
-                except RuntimeError:
-                    self.enlargeRecursionLimit()
-                    return recoursiveInvoke()
-            else:
-                return Buff
-        except:
-            return Buff
-
-    def _parseTuple(self, tTime, tLen, Buff):
-        """
-        Get body by length tLen of current Feedback Service tuple.
-        If body length is equal to tLen than append new
-        tuple item and recoursive parse next item.
-        
-        """
-        try:
-            token = struct.unpack_from('!%ds' % tLen, Buff, 0)[0]
-            self._append(tTime, token)
-        except:
-            pass
-        
-        recurrenceInvoke = lambda: self._parseHeader(Buff[tLen:])
-        # enlarge recursion limit if it is exceeded
-        try:
-            return recurrenceInvoke()
-        except RuntimeError:
-            self.enlargeRecursionLimit()
-            return recurrenceInvoke()
-
     def _testFeedbackFile(self):
-        fh = open('feedbackSampleTuple.dat', 'r')
+        fh = open('feedbackSampleTuple.dat', 'rb')
         return fh
             
-    def receive(self):
+    def _receive(self):
         """
-        Receive Feedback tuples from APNS:
-            1) make connection to APNS server and receive
-            2) unpack feedback tuples to arrays            
+        Make connection to APNS server and yield ( timestamp, deviceToken )
+        tuples while they are received. Connection is closed when
+        generator is exhausted or closed.
         """
-                                
-        apnsConnection = self.connection
-                        
         if self.sandbox != True:
             apnsHost = self.apnsHost
         else:
             apnsHost = self.apnsSandboxHost
         
-        apnsConnection.connect(apnsHost, self.apnsPort)
+        # replace connection to similar I/O object but work
+        # with binary Feedback Service sample file
+        if self.testingParser:
+            source = self._testFeedbackFile()
+        else:
+            source = self.connection.connect(apnsHost, self.apnsPort)
         
-        tRest = None
+        parser = APNSFeedbackParser()
         blockSize = self.blockSize
+        suppression = self.suppression
         
-        # replace connectionContext to similar I/O function but work
-        # with binary Feedback Service sample file
-        if self.testingParser:
-            connectionContext = self._testFeedbackFile()
+        try:
+            replyBlock = source.read(blockSize)
+            while replyBlock:
+                for item in parser.feed(replyBlock):
+                    if suppression != None:
+                        suppression.add(item[1], item[0])
+                    yield item
+                replyBlock = source.read(blockSize)
+        finally:
+            source.close()
+    
+    def stream(self, convert_time = True):
+        """
+        Receive Feedback tuples from APNS lazily: each ( datetime, deviceToken )
+        tuple is yielded as soon as it is parsed. If convert_time is False
+        UNIX timestamp is yielded instead of datetime.
+        """
+        fromtimestamp = datetime.datetime.fromtimestamp
+        for feedbackTime, deviceToken in self._receive():
+            if convert_time:
+                feedbackTime = fromtimestamp(feedbackTime)
+            yield (feedbackTime, deviceToken)
+            
+    def receive(self, columnar = False):
+        """
+        Receive Feedback tuples from APNS:
+            1) make connection to APNS server and receive
+            2) unpack feedback tuples to arrays            
+        If columnar is True, tuples aren't appended to .feedbacks and
+        APNSFeedbackColumns is returned instead.
+        """
+        if columnar:
+            columns = APNSFeedbackColumns()
+            append = columns.append
+            for feedbackTime, deviceToken in self._receive():
+                append(feedbackTime, deviceToken)
+            return columns
+            
+        for feedbackTime, deviceToken in self._receive():
+            self._append(feedbackTime, deviceToken)
+            
+        return True
 
-        replyBlock = apnsConnection.read(blockSize)
 
-        while replyBlock:
-            if tRest and len(tRest) > 0:
-                # merge previous rest of replyBlock and new
-                replyBlock = struct.pack('!%ds%ds' % (len(tRest), len(replyBlock)), tRest, replyBlock)
-            tRest = self._parseHeader(replyBlock)
-            replyBlock = apnsConnection.read(blockSize)
-        
-        # close sample binary file
-        if self.testingParser:
-            connectionContext.close()
+class APNSFeedbackPoller(threading.Thread):
+    """
+    Background thread which receives Feedback Service tuples every
+    interval seconds by APNSFeedbackWrapper and passes new ones to the
+    callback or puts them to the queue (anything with .put() method).
+    
+    Tuples not newer than high-water mark (timestamp of the newest
+    tuple delivered by previous polls) are skipped, so only new tuples
+    are delivered even if the service repeats them. Save .highWaterMark and pass it
+    to the next poller as high_water_mark to keep it between runs.
+    
+    When connection fails poller retries after backoff seconds which
+    is doubled after each failure up to max_backoff.
+    """
+    interval = 3600
+    backoff = 1
+    maxBackoff = 600
+    highWaterMark = 0
+    
+    def __init__(self, wrapper = None, certificate = None, sandbox = True, interval = 3600, \
+                    callback = None, queue = None, convert_time = True, high_water_mark = 0, \
+                    backoff = 1, max_backoff = 600, on_error = None):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        
+        if wrapper == None:
+            wrapper = APNSFeedbackWrapper(certificate, sandbox)
+        if not isinstance(wrapper, APNSFeedbackWrapper):
+            raise APNSTypeError, "Unexpected argument type. Argument should be an instance of APNSFeedbackWrapper object"
+        if callback == None and queue == None:
+            raise APNSValueError, "Callback or queue should be set"
+        
+        self.wrapper = wrapper
+        self.interval = interval
+        self.callback = callback
+        self.queue = queue
+        self.convertTime = convert_time
+        self.highWaterMark = high_water_mark
+        self.backoff = backoff
+        self.maxBackoff = max_backoff
+        self.onError = on_error
+        
+        self.polls = 0
+        self.failures = 0
+        self.delivered = 0
+        self._markTokens = set()
+        self._stopped = threading.Event()
+        
+    def _deliver(self, item):
+        if self.callback:
+            self.callback(item)
+        if self.queue != None:
+            self.queue.put(item)
+        self.delivered += 1
+        
+    def poll(self):
+        """
+        Receive tuples once and deliver new ones. Return number of
+        delivered tuples.
+        """
+        delivered = self.delivered
+        fromtimestamp = datetime.datetime.fromtimestamp
+        
+        # tuples are compared with the mark of previous polls, because
+        # tuples of one response aren't sorted by time
+        mark = self.highWaterMark
+        markTokens = self._markTokens
+        newMark = mark
+        newTokens = set(markTokens)
+        
+        try:
+            for feedbackTime, deviceToken in self.wrapper.stream(convert_time = False):
+                if feedbackTime < mark:
+                    continue
+                if feedbackTime == mark and deviceToken in markTokens:
+                    # several tuples may have the same timestamp
+                    continue
+                
+                if feedbackTime > newMark:
+                    newMark = feedbackTime
+                    newTokens = set([deviceToken])
+                elif feedbackTime == newMark:
+                    newTokens.add(deviceToken)
+                
+                if self.convertTime:
+                    feedbackTime = fromtimestamp(feedbackTime)
+                self._deliver((feedbackTime, deviceToken))
+        finally:
+            # tuples delivered before an error shouldn't be delivered again
+            self.highWaterMark = newMark
+            self._markTokens = newTokens
             
-        apnsConnection.close()
-        return True        
+        self.polls += 1
+        return self.delivered - delivered
         
+    def _delay(self, failures):
+        if failures == 0:
+            return self.interval
+        return min(self.maxBackoff, self.backoff * 2 ** (failures - 1))
+        
+    def run(self):
+        failures = 0
+        while not self._stopped.isSet():
+            try:
+                self.poll()
+                failures = 0
+            except (socket.error, IOError, OSError, APNSConnectionError), e:
+                failures += 1
+                self.failures += 1
+                if self.onError:
+                    self.onError(e)
+            self._stopped.wait(self._delay(failures))
+            
+    def stop(self, wait = True):
+        """
+        Stop polling. Tuples of current poll are delivered first.
+        """
+        self._stopped.set()
+        if wait and self.isAlive():
+            self.join()
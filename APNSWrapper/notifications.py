@@ -10,17 +10,198 @@
 # limitations under the License.
 
 
+import time
+import random
 import struct
 import base64
+import socket
 import binascii
+import array
+import datetime
+import threading
+import collections
+from json.encoder import encode_basestring_ascii
 
 from __init__ import *
 from connection import *
 from apnsexceptions import *
-from utils import _doublequote
+from utils import _doublequote, _jsonString, _json
 
 NULL = 'null'
 
+# status codes of the error-response packet
+ERROR_RESPONSE_STATUS = {
+    0 : 'No errors encountered',
+    1 : 'Processing error',
+    2 : 'Missing device token',
+    3 : 'Missing topic',
+    4 : 'Missing payload',
+    5 : 'Invalid token size',
+    6 : 'Invalid topic size',
+    7 : 'Invalid payload size',
+    8 : 'Invalid token',
+    10 : 'Shutdown',
+    255 : 'None (unknown)'
+}
+
+ERROR_RESPONSE_LENGTH = 6
+
+PRIORITY_IMMEDIATE = 10
+PRIORITY_CONSERVE_POWER = 5
+
+# payload limits of the legacy binary interface and of the newer ones
+PAYLOAD_LENGTH_LEGACY = 256
+PAYLOAD_LENGTH_2K = 2048
+PAYLOAD_LENGTH_4K = 4096
+
+TOKEN_BINARY = 'binary'
+TOKEN_HEX = 'hex'
+TOKEN_BASE64 = 'base64'
+
+# precompiled structures of the binary frames keyed by (command, token length)
+_FRAME_STRUCTS = {}
+_FRAME_TRAILER = struct.Struct('!BHIBHI')                 # identifier and expiry items
+_FRAME_PRIORITY_TRAILER = struct.Struct('!BHIBHIBHB')     # identifier, expiry and priority items
+
+def _frameStruct(command, tokenLength):
+    """
+    Return precompiled structure of the frame part before payload.
+    """
+    key = (command, tokenLength)
+    head = _FRAME_STRUCTS.get(key)
+    if head == None:
+        if command == 2:
+            # command, frame length, token item, payload item header
+            head = struct.Struct('!BIBH%dsBH' % tokenLength)
+        elif command == 1:
+            # command, identifier, expiry, token, payload length
+            head = struct.Struct('!BIIH%dsH' % tokenLength)
+        else:
+            # command, token, payload length
+            head = struct.Struct('!BH%dsH' % tokenLength)
+        _FRAME_STRUCTS[key] = head
+    return head
+
+def _frameLength(command, tokenLength, payloadLength, priority = None):
+    """
+    Calculate length of the binary frame.
+    """
+    length = _frameStruct(command, tokenLength).size + payloadLength
+    if command == 2:
+        if priority == None:
+            return length + _FRAME_TRAILER.size
+        return length + _FRAME_PRIORITY_TRAILER.size
+    return length
+
+def _packFrame(buff, offset, command, token, payload, identifier = 0, expiry = 0, priority = None):
+    """
+    Pack binary frame into writable buffer (e.g. bytearray) at offset.
+    Return offset of the frame end.
+    Command 0 is simple format, command 1 is enhanced format with identifier
+    and expiry and command 2 is frame of items with optional priority.
+    """
+    tokenLength = len(token)
+    payloadLength = len(payload)
+    head = _frameStruct(command, tokenLength)
+    start = offset + head.size
+    end = start + payloadLength
+    
+    if command == 2:
+        if priority == None:
+            _FRAME_TRAILER.pack_into(buff, end, 3, 4, identifier, 4, 4, expiry)
+            frameEnd = end + _FRAME_TRAILER.size
+        else:
+            _FRAME_PRIORITY_TRAILER.pack_into(buff, end, 3, 4, identifier, 4, 4, expiry, 5, 1, priority)
+            frameEnd = end + _FRAME_PRIORITY_TRAILER.size
+        head.pack_into(buff, offset, 2, frameEnd - offset - 5, 1, tokenLength, token, 2, payloadLength)
+    elif command == 1:
+        head.pack_into(buff, offset, 1, identifier, expiry, tokenLength, token, payloadLength)
+        frameEnd = end
+    else:
+        head.pack_into(buff, offset, command, tokenLength, token, payloadLength)
+        frameEnd = end
+        
+    buff[start:end] = payload
+    return frameEnd
+
+_IDENTIFIER = struct.Struct('!I')
+
+def _frameOffsets(command, tokenLength, payloadLength):
+    """
+    Return offsets of deviceToken and identifier in the binary frame.
+    Identifier offset is None for simple format (command 0).
+    """
+    if command == 2:
+        # frame header, token item header, token, payload item header, payload, identifier item header
+        return (8, 8 + tokenLength + 3 + payloadLength + 3)
+    if command == 1:
+        return (_frameStruct(1, tokenLength).size - tokenLength - 2, 1)
+    return (_frameStruct(command, tokenLength).size - tokenLength - 2, None)
+
+def _decodeToken(token, tokenFormat = TOKEN_BINARY):
+    """
+    Decode deviceToken from hex or base64 string to binary format.
+    """
+    if tokenFormat == TOKEN_HEX:
+        return binascii.unhexlify(token.strip().strip('<>').replace(' ', '').replace('-', ''))
+    if tokenFormat == TOKEN_BASE64:
+        return base64.standard_b64decode(token)
+    return token
+
+def _frame(command, token, payload, identifier = 0, expiry = 0, priority = None):
+    """
+    Pack deviceToken and JSON payload to the APNS binary frame.
+    Use _packFrame() to pack many frames into one buffer.
+    """
+    tokenLength = len(token)
+    payloadLength = len(payload)
+    
+    if command == 2:
+        frameLength = _frameLength(2, tokenLength, payloadLength, priority) - 5
+        apnsPackFormat = "!BIBH" + str(tokenLength) + "sBH" + str(payloadLength) + "sBHIBHI"
+        if priority == None:
+            return struct.pack(apnsPackFormat, 
+                                command, frameLength, 
+                                1, tokenLength, token, 
+                                2, payloadLength, payload, 
+                                3, 4, identifier, 
+                                4, 4, expiry)
+        return struct.pack(apnsPackFormat + "BHB", 
+                                command, frameLength, 
+                                1, tokenLength, token, 
+                                2, payloadLength, payload, 
+                                3, 4, identifier, 
+                                4, 4, expiry, 
+                                5, 1, priority)
+    
+    if command == 1:
+        apnsPackFormat = "!BIIH" + str(tokenLength) + "sH" + str(payloadLength) + "s"
+        return struct.pack(apnsPackFormat, 
+                                command, 
+                                identifier, 
+                                expiry, 
+                                tokenLength, 
+                                token, 
+                                payloadLength, 
+                                payload)
+    
+    apnsPackFormat = "!BH" + str(tokenLength) + "sH" + str(payloadLength) + "s"
+    
+    return struct.pack(apnsPackFormat, 
+                                command, 
+                                tokenLength, 
+                                token, 
+                                payloadLength, 
+                                payload)
+
+def _timestamp(value):
+    """
+    Convert datetime or number to UNIX timestamp.
+    """
+    if isinstance(value, datetime.datetime):
+        return int(time.mktime(value.timetuple()))
+    return int(value)
+
 class APNSAlert(object):    
     """
     This is an object to generate properly APNS alert object with
@@ -36,7 +217,7 @@ class APNSAlert(object):
         """
         The text of the alert message.
         """
-        if alertBody and not isinstance(alertBody, str):
+        if alertBody and not isinstance(alertBody, basestring):
             raise APNSValueError, "Unexpected value of argument. It should be string or None."
                         
         self.alertBody = alertBody
@@ -46,7 +227,7 @@ class APNSAlert(object):
         """
         If a string is specified, displays an alert with two buttons.
         """
-        if alk and not isinstance(alk, str):
+        if alk and not isinstance(alk, basestring):
             raise APNSValueError, "Unexpected value of argument. It should be string or None."
         
         self.actionLocKey = alk
@@ -57,7 +238,7 @@ class APNSAlert(object):
         A key to an alert-message string in a Localizable.strings file for the current 
         localization (which is set by the user's language preference).
         """
-        if lk and not isinstance(lk, str):
+        if lk and not isinstance(lk, basestring):
             raise APNSValueError, "Unexcpected value of argument. It should be string or None"
         self.locKey = lk
         return self
@@ -70,28 +251,34 @@ class APNSAlert(object):
         if la and not isinstance(la, (list, tuple)):
             raise APNSValueError, "Unexpected type of argument. It should be list or tuple of strings"
             
-        self.locArgs = [ '"%s"' % str(x) for x in la ]
+        self.locArgs = [ isinstance(x, basestring) and x or str(x) for x in la or [] ]
         return self
         
-    def _build(self):
+    def _object(self):
         """
-        Build object to JSON Apple Push Notification Service string.
+        Build dictionary of the alert for the JSON encoder.
         """
-        
-        arguments = []
+        alert = {}
         if self.alertBody:
-            arguments.append('"body":"%s"' % _doublequote(self.alertBody))
+            alert['body'] = self.alertBody
 
         if self.actionLocKey:
-            arguments.append('"action-loc-key":"%s"' % _doublequote(self.actionLocKey))
+            # NULL means alert without the action button
+            alert['action-loc-key'] = if_else(self.actionLocKey == NULL, None, self.actionLocKey)
 
         if self.locKey:
-            arguments.append('"loc-key":"%s"' % _doublequote(self.locKey))
+            alert['loc-key'] = self.locKey
 
         if self.locArgs:
-            arguments.append('"loc-args":[%s]' % ",".join(self.locArgs))    
+            alert['loc-args'] = self.locArgs
         
-        return ",".join(arguments)
+        return alert
+        
+    def _build(self):
+        """
+        Build object to JSON Apple Push Notification Service string.
+        """
+        return _json(self._object())[1:-1]
     
 class APNSProperty(object):
     """
@@ -100,37 +287,46 @@ class APNSProperty(object):
     name = None
     data = None
     def __init__(self, name = None, data = None):
-        if not name or not isinstance(name, str) or len(name) == 0:
+        if not name or not isinstance(name, basestring) or len(name) == 0:
             raise APNSValueError, "Name of property argument should be a non-empry string"
             
-        if not isinstance(data, (int, str, list, tuple, float)):
-            raise APNSValueERror, "Data argument should be string, number, list of tuple"
+        if not isinstance(data, (int, long, basestring, list, tuple, float)):
+            raise APNSValueError, "Data argument should be string, number, list of tuple"
             
         self.name = name
         self.data = data
     
     
     def _build(self):        
-        arguments = []
-        name = '"%s":' % self.name
-        
-        if isinstance(self.data, (int, float)):
-            return "%s%s" % (name, str(self.data))
-            
-        if isinstance(self.data, str):
-            return '%s"%s"' % (name, _doublequote(self.data))
-        
-        if isinstance(self.data, (tuple, list)):
-            arguments = map(lambda x: if_else(isinstance(x, str), '"%s"' % _doublequote(str(x)), str(x)), self.data)
-            return "%s[%s]" % (name, ",".join(arguments))
-            
-        return '%s%s' % (name, NULL)
+        return "%s:%s" % (_jsonString(self.name), _json(self.data))
 
 class APNSNotificationWrapper(object):
     """
     This object wrap a list of APNS tuples. You should use
     .append method to add notifications to the list. By usint
     method .notify() all notification will send to the APNS server.
+    
+    In persistent mode connection to the APNS server stay opened
+    between .notify() calls and will be reopened only after an error
+    or when it was idle more than idle_timeout seconds.
+    
+    In enhanced mode notifications are sent in command 1 format with
+    identifiers. Background thread reads error-responses and frames
+    sent after the failed one are resent from the in-flight buffer
+    of in_flight last frames. If the failed frame is older than the
+    buffer, frames between it and the buffer can't be recovered.
+    
+    Notifications to tokens of the suppression index (APNSSuppressionIndex
+    filled by APNSFeedbackWrapper) are dropped before framing and passed
+    to on_suppressed callback with the token if it is set.
+    
+    Writes are paced by APNSPacer if it is passed: frames are written
+    by chunks of pacer.chunkSize bytes with rate limited by the pacer,
+    disconnects and error-responses are reported to it.
+    
+    If APNSSpool is passed as spool, .notify() appends encoded frames
+    to the spool before they are sent and commits them after each
+    write. Frames left by crashed sender are sent by .notify_spool().
     """
     sandbox = True
     apnsHost = 'gateway.push.apple.com'
@@ -139,21 +335,450 @@ class APNSNotificationWrapper(object):
     payloads = None
     connection = None
     debug_ssl = False
+    persistent = False
+    idleTimeout = 300
+    framesSent = 0
+    
+    enhanced = False
+    errorTimeout = 0.5
+    framesResent = 0
+    errorsUnrecoverable = 0
+    errorResponses = None
+    onError = None
+    
+    suppression = None
+    onSuppressed = None
+    framesSuppressed = 0
+    tokensInvalid = 0
+    
+    pacer = None
+    spool = None
     
     def __init__(self, certificate = None, sandbox = True, debug_ssl = False, \
-                    force_ssl_command = False):
+                    force_ssl_command = False, persistent = False, idle_timeout = 300, \
+                    enhanced = False, in_flight = 10000, error_timeout = 0.5, on_error = None, \
+                    suppression = None, on_suppressed = None, pacer = None, spool = None):
         self.debug_ssl = debug_ssl
-        self.force_ssl_command = False
+        self.force_ssl_command = force_ssl_command
         self.connection = APNSConnection(certificate = certificate, \
                             force_ssl_command = self.force_ssl_command, debug = self.debug_ssl)
         self.sandbox = sandbox
+        self.persistent = persistent
+        self.idleTimeout = idle_timeout
+        self.framesSent = 0
         self.payloads = []
-
+        
+        self.enhanced = enhanced
+        self.errorTimeout = error_timeout
+        self.onError = on_error
+        self.framesResent = 0
+        self.errorsUnrecoverable = 0
+        self.errorResponses = []
+        self._identifier = 0
+        self._inFlight = collections.deque(maxlen = in_flight)
+        self._lock = threading.RLock()
+        
+        self.suppression = suppression
+        self.onSuppressed = on_suppressed
+        self.framesSuppressed = 0
+        self.tokensInvalid = 0
+        self.pacer = pacer
+        self.spool = spool
         
     def append(self, payload = None):
         if not isinstance(payload, APNSNotification):
             raise APNSTypeError, "Unexpected argument type. Argument should be an instance of APNSNotification object"
         self.payloads.append(payload)
+    
+    def _host(self):
+        if self.sandbox != True:
+            return self.apnsHost
+        return self.apnsSandboxHost
+        
+    def connect(self):
+        """
+        Make connection to the APNS server if it isn't opened yet.
+        Connection which was idle too long or dropped by the server
+        will be reopened.
+        """
+        apnsConnection = self.connection
+        
+        if apnsConnection.connected:
+            idle = apnsConnection.idle()
+            # first write to the connection closed by the server doesn't
+            # fail, so frames written to it would be lost without error
+            if apnsConnection.alive() and \
+                    (self.idleTimeout == None or idle == None or idle < self.idleTimeout):
+                return apnsConnection
+            self.disconnect()
+
+        apnsConnection.connect(self._host(), self.apnsPort)
+        
+        if self.enhanced:
+            APNSErrorResponseReader(self, apnsConnection.handshakes).start()
+            
+        return apnsConnection
+        
+    def disconnect(self):
+        """
+        Close connection to the APNS server if it is opened.
+        """
+        if self.connection.connected:
+            self.connection.close()
+    
+    def statistics(self):
+        """
+        Return dictionary with number of TLS handshakes, frames and
+        bytes sent by the wrapper. It's useful to check that 
+        persistent connection is reused.
+        """
+        return {
+            'handshakes' : self.connection.handshakes,
+            'frames' : self.framesSent,
+            'bytes' : self.connection.bytesSent,
+            'resent' : self.framesResent,
+            'errors' : len(self.errorResponses),
+            'unrecoverable' : self.errorsUnrecoverable,
+            'suppressed' : self.framesSuppressed,
+            'invalid' : self.tokensInvalid,
+            'pacing' : self.pacer != None and self.pacer.statistics() or None
+        }
+    
+    def _write(self, buffers, frames = 1):
+        """
+        Write list of buffers (frames or chunks of frames) to the APNS
+        server without joining them. If reused connection was dropped
+        by the server it will be reopened and write repeated once.
+        Connection stays opened, caller should close it if necessary.
+        """
+        if self.pacer != None:
+            self.pacer.acquire(frames, sum([len(b) for b in buffers]))
+        
+        self._lock.acquire()
+        try:
+            handshakes = self.connection.handshakes
+            apnsConnection = self.connect()
+            reused = apnsConnection.handshakes == handshakes
+            
+            try:
+                apnsConnection.writev(buffers)
+            except (socket.error, IOError, OSError):
+                # frames after the failed one are resent by error-response handler,
+                # which reports the status to the pacer
+                errors = len(self.errorResponses)
+                if self.enhanced and self._readErrorResponse(apnsConnection.handshakes, self.errorTimeout) \
+                        and len(self.errorResponses) > errors:
+                    self.framesSent += frames
+                    return
+                if self.pacer != None:
+                    self.pacer.failure()
+                self.disconnect()
+                if not reused:
+                    raise
+                self.connect().writev(buffers)
+            
+            self.framesSent += frames
+        finally:
+            self._lock.release()
+    
+    def _send(self, entries):
+        """
+        Write list of (identifier, frame) entries produced by ._frame().
+        In enhanced mode frames are remembered in the in-flight buffer
+        right before write, so error-response handler never resends
+        frames which were not written yet.
+        """
+        if self.pacer == None:
+            return self._sendEntries(entries)
+        
+        # paced writes shouldn't be larger than chunk of the pacer
+        chunk = []
+        size = 0
+        for entry in entries:
+            chunk.append(entry)
+            size += len(entry[1])
+            if size >= self.pacer.chunkSize:
+                self._sendEntries(chunk)
+                chunk = []
+                size = 0
+        if len(chunk) > 0:
+            self._sendEntries(chunk)
+            
+    def _sendEntries(self, entries):
+        self._lock.acquire()
+        try:
+            if self.enhanced:
+                # error-response which dropped reused connection is handled
+                # before new frames are added to the in-flight buffer
+                if self.connection.connected:
+                    self._readErrorResponse(self.connection.handshakes)
+                self._inFlight.extend(entries)
+            self._write([frame for identifier, frame in entries], len(entries))
+        finally:
+            self._lock.release()
+    
+    def _readErrorResponse(self, handshakes, timeout = 0):
+        """
+        Read error-response from the connection opened by handshakes-th
+        handshake if it is available. Return True if connection was
+        dropped by the server.
+        """
+        self._lock.acquire()
+        try:
+            apnsConnection = self.connection
+            if apnsConnection.handshakes != handshakes or not apnsConnection.readable(timeout):
+                return False
+            
+            try:
+                data = apnsConnection.read(ERROR_RESPONSE_LENGTH, max(timeout, self.errorTimeout))
+            except (socket.error, IOError, OSError):
+                data = ''
+            if data == None:
+                # there was SSL protocol data only (e.g. session ticket)
+                return False
+            self.disconnect()
+            
+            if len(data) == ERROR_RESPONSE_LENGTH:
+                command, status, identifier = struct.unpack('!BBI', data)
+                self._errorResponse(status, identifier)
+            return True
+        finally:
+            self._lock.release()
+            
+    def _errorResponse(self, status, identifier):
+        """
+        Handle error-response: resend frames which were sent after
+        the frame with identifier. If the frame isn't in the in-flight
+        buffer any more whole buffer is resent and the error-response
+        is counted in errorsUnrecoverable.
+        """
+        self.errorResponses.append((status, identifier))
+        if self.pacer != None:
+            self.pacer.failure(status)
+        if self.onError:
+            self.onError(status, identifier)
+        
+        inFlight = list(self._inFlight)
+        self._inFlight.clear()
+        
+        for i in xrange(len(inFlight) - 1, -1, -1):
+            if inFlight[i][0] == identifier:
+                resend = inFlight[i + 1:]
+                break
+        else:
+            # frame is out of in-flight buffer: all buffered frames were
+            # sent after it and are resent, but frames between them are lost
+            self.errorsUnrecoverable += 1
+            resend = inFlight
+            
+        self._inFlight.extend(resend)
+        
+        if len(resend) > 0:
+            self.framesResent += len(resend)
+            self.framesSent -= len(resend)
+            self._write([frame for identifier, frame in resend], len(resend))
+    
+    def _finish(self):
+        """
+        Wait for late error-responses and close non-persistent connection.
+        """
+        if self.enhanced and self.connection.connected:
+            while self._readErrorResponse(self.connection.handshakes, self.errorTimeout):
+                pass
+        if not self.persistent:
+            self.disconnect()
+    
+    def _suppressed(self, token, item):
+        """
+        Return True if notification to the token should be dropped.
+        Dropped item is passed to onSuppressed callback.
+        """
+        if self.suppression == None or not self.suppression.suppressed(token):
+            return False
+        self.framesSuppressed += 1
+        if self.onSuppressed:
+            self.onSuppressed(token, item)
+        return True
+    
+    def _suppressedItem(self, item):
+        if isinstance(item, APNSNotification):
+            return self._suppressed(item.deviceToken, item)
+        if isinstance(item, (tuple, list)) and len(item) == 2:
+            return self._suppressed(item[0], item)
+        # let ._frame() raise an error
+        return False
+    
+    def _nextIdentifier(self):
+        self._identifier = (self._identifier + 1) & 0xFFFFFFFF
+        return self._identifier
+    
+    def _frame(self, item):
+        """
+        Encode item of notify_stream() to the binary frame.
+        Return (identifier, frame), identifier is None if wrapper
+        isn't in enhanced mode.
+        """
+        if isinstance(item, APNSNotification):
+            if self.enhanced:
+                if item.identifierValue == None:
+                    item.identifier(self._nextIdentifier())
+                return (item.identifierValue, item.payload(max(item._command(), 1)))
+            return (None, item.payload())
+        
+        if not isinstance(item, (tuple, list)) or len(item) != 2:
+            raise APNSTypeError, "Unexpected item type. Item should be an instance of APNSNotification object or (token, payload) pair"
+        
+        token, payload = item
+        if not token:
+            raise APNSUndefinedDeviceToken, "You forget to set deviceToken in your notification."
+        if len(payload) > APNSNotification.maxPayloadLength:
+            raise APNSPayloadLengthError, "Length of Payload more than %d bytes." % APNSNotification.maxPayloadLength
+        
+        if self.enhanced:
+            identifier = self._nextIdentifier()
+            return (identifier, _frame(1, token, payload, identifier))
+        
+        return (None, _frame(APNSNotification.command, token, payload))
+        
+    def notify_stream(self, iterable, chunk_size = 16384):
+        """
+        Send notifications from any iterable (generator, iterator, etc.)
+        of APNSNotification objects or (token, payload) pairs, where token
+        is binary deviceToken and payload is JSON string.
+        Frames are written by chunks of chunk_size bytes, so only one
+        chunk is kept in memory. Return number of sent frames.
+        """
+        if self.suppression != None:
+            iterable = (item for item in iterable if not self._suppressedItem(item))
+        return self._stream((self._frame(item) for item in iterable), chunk_size)
+        
+    def notify_batch(self, batch, chunk_size = 16384):
+        """
+        Send NotificationBatch by chunks of chunk_size bytes.
+        Return number of sent frames.
+        """
+        if not isinstance(batch, NotificationBatch):
+            raise APNSTypeError, "Unexpected argument type. Argument should be an instance of NotificationBatch object"
+        return self._stream(self._batchFrames(batch), chunk_size)
+        
+    def _batchFrames(self, batch):
+        suppression = self.suppression
+        for token, payload, identifier, expiry in batch.rows():
+            if suppression != None and self._suppressed(token, (token, payload)):
+                continue
+            if self.enhanced:
+                if identifier == 0:
+                    identifier = self._nextIdentifier()
+                yield (identifier, _frame(1, token, payload, identifier, expiry))
+            elif identifier or expiry:
+                yield (None, _frame(1, token, payload, identifier, expiry))
+            else:
+                yield (None, _frame(APNSNotification.command, token, payload))
+        
+    def _stream(self, entries, chunk_size):
+        """
+        Send (identifier, frame) entries by chunks of chunk_size bytes.
+        """
+        framesSent = self.framesSent
+        chunk = []
+        size = 0
+        
+        try:
+            for entry in entries:
+                chunk.append(entry)
+                size += len(entry[1])
+                
+                if size >= chunk_size:
+                    self._send(chunk)
+                    chunk = []
+                    size = 0
+                    
+            if len(chunk) > 0:
+                self._send(chunk)
+        finally:
+            self._finish()
+                
+        return self.framesSent - framesSent
+        
+    def broadcast(self, notification, tokens, token_format = TOKEN_BINARY, chunk_size = 16384, \
+                    on_invalid = None):
+        """
+        Send the same notification to many deviceTokens. Payload is built
+        once and frames are produced by splicing each token into reusable
+        chunk buffer of prebuilt frames. Tokens may be iterable of binary,
+        hex (token_format = TOKEN_HEX) or base64 (TOKEN_BASE64) strings.
+        Token of notification itself is ignored. Return number of sent frames.
+        
+        Malformed tokens (can't be decoded or have wrong length) are
+        skipped, counted in tokensInvalid and passed to on_invalid
+        callback with their index in tokens.
+        """
+        if not isinstance(notification, APNSNotification):
+            raise APNSTypeError, "Unexpected argument type. Argument should be an instance of APNSNotification object"
+        if token_format not in (TOKEN_BINARY, TOKEN_HEX, TOKEN_BASE64):
+            raise APNSValueError, "Unexpected token format %s" % str(token_format)
+        
+        payload = notification._build()
+        command = notification._command()
+        if self.enhanced:
+            command = max(command, 1)
+        priority = notification.priorityValue
+        tokenLength = notification.deviceTokenLength
+        frameLength = _frameLength(command, tokenLength, len(payload), priority)
+        tokenOffset, identifierOffset = _frameOffsets(command, tokenLength, len(payload))
+        
+        # chunk of prebuilt frames, only tokens and identifiers are changed
+        count = max(1, chunk_size // frameLength)
+        chunk = bytearray(count * frameLength)
+        for i in xrange(count):
+            _packFrame(chunk, i * frameLength, command, '\0' * tokenLength, payload, \
+                        0, notification.expiryValue or 0, priority)
+        view = memoryview(chunk)
+        
+        framesSent = self.framesSent
+        suppression = self.suppression
+        entries = []
+        offset = 0
+        
+        try:
+            for index, value in enumerate(tokens):
+                try:
+                    token = _decodeToken(value, token_format)
+                except (TypeError, ValueError, AttributeError, binascii.Error):
+                    token = None
+                if token == None or len(token) != tokenLength:
+                    self.tokensInvalid += 1
+                    if on_invalid:
+                        on_invalid(index, value)
+                    continue
+                if suppression != None and self._suppressed(token, notification):
+                    continue
+                
+                start = offset + tokenOffset
+                chunk[start:start + tokenLength] = token
+                if self.enhanced:
+                    identifier = self._nextIdentifier()
+                    _IDENTIFIER.pack_into(chunk, offset + identifierOffset, identifier)
+                    entries.append((identifier, view[offset:offset + frameLength].tobytes()))
+                offset += frameLength
+                
+                if offset == len(chunk):
+                    self._sendChunk(view[:offset], count, entries)
+                    entries = []
+                    offset = 0
+                    
+            if offset > 0:
+                self._sendChunk(view[:offset], offset // frameLength, entries)
+        finally:
+            self._finish()
+            
+        return self.framesSent - framesSent
+        
+    def _sendChunk(self, view, frames, entries):
+        if self.enhanced:
+            self._send(entries)
+        else:
+            self._write([view], frames)
         
     def notify(self):
         """
@@ -161,36 +786,87 @@ class APNSNotificationWrapper(object):
             1) prepare all internal variables to APNS Payout JSON
             2) make connection to APNS server and send notification
         """
-        payloads = [o.payload() for o in self.payloads]
-        payloadsLen = sum([len(p) for p in payloads])        
-        messages = []
-        offset = 0
+        payloads = self.payloads
+        if self.suppression != None:
+            payloads = [o for o in payloads if not self._suppressed(o.deviceToken, o)]
+        entries = [self._frame(o) for o in payloads]
         
-        if len(payloads) == 0:
+        if len(entries) == 0:
+            self.payloads = []
             return False
         
-        for p in payloads:
-            plen = len(p)
-            messages.append(struct.pack('%ds' % plen, p))
-            offset += plen
-
-        # TODO: make it more correctly
-        message = "".join(messages)
+        if self.spool != None:
+            # frames are durable now, they will be sent even after crash
+            self.spool.extend(entries)
+            self.payloads = []
+            self.notify_spool()
+            return True
         
-        apnsConnection = self.connection
-                        
-        if self.sandbox != True:
-            apnsHost = self.apnsHost
-        else:
-            apnsHost = self.apnsSandboxHost
+        try:
+            self._send(entries)
+        finally:
+            self._finish()
         
-        apnsConnection.connect(apnsHost, self.apnsPort)
-
-        apnsConnection.write(message)
-
-        apnsConnection.close()
+        # sent notifications shouldn't be sent again by next .notify()
+        self.payloads = []
         
         return True
+    
+    def notify_spool(self, chunk_size = 16384):
+        """
+        Send uncommitted frames of the spool by chunks of chunk_size
+        bytes from segments which aren't leased by other senders.
+        Offset is committed after each chunk is written, so only the
+        chunk written at the moment of crash may be sent twice.
+        Return number of sent frames.
+        """
+        if self.spool == None:
+            raise APNSValueError, "Spool of the wrapper isn't set"
+        
+        framesSent = self.framesSent
+        try:
+            while True:
+                lease = self.spool.lease()
+                if lease == None:
+                    break
+                try:
+                    if self.enhanced:
+                        for offset, entries in lease.chunks(chunk_size):
+                            # identifiers of the new frames shouldn't repeat spooled ones
+                            self._identifier = max(self._identifier, entries[-1][0] or 0)
+                            self._send(entries)
+                            lease.commit(offset)
+                    else:
+                        # frames of the record are written as one block
+                        for offset, count, buffers in lease.blocks(chunk_size):
+                            self._write(buffers, count)
+                            lease.commit(offset)
+                finally:
+                    lease.release()
+        finally:
+            self._finish()
+        
+        return self.framesSent - framesSent
+        
+class APNSErrorResponseReader(threading.Thread):
+    """
+    Background thread which wait for error-response on the wrapper
+    connection opened by handshakes-th handshake. Thread stops when
+    this connection is closed.
+    """
+    interval = 0.5
+    
+    def __init__(self, wrapper, handshakes):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.wrapper = wrapper
+        self.handshakes = handshakes
+        
+    def run(self):
+        apnsConnection = self.wrapper.connection
+        while apnsConnection.connected and apnsConnection.handshakes == self.handshakes:
+            if apnsConnection.readable(self.interval):
+                self.wrapper._readErrorResponse(self.handshakes)
         
 class APNSNotification(object):
     """
@@ -204,9 +880,15 @@ class APNSNotification(object):
     alert = None
     
     deviceToken = None
+    identifierValue = None
+    expiryValue = None
+    priorityValue = None
     
     maxPayloadLength = 256
     deviceTokenLength = 32
+    
+    fitting = False
+    ellipsis = u'\u2026'
 
     properties = None
     
@@ -219,6 +901,9 @@ class APNSNotification(object):
         self.soundValue = None
         self.alertObject = None
         self.deviceToken = None        
+        self.identifierValue = None
+        self.expiryValue = None
+        self.priorityValue = None
 
     
     def token(self, token):
@@ -246,6 +931,48 @@ class APNSNotification(object):
         return self
         
         
+    def identifier(self, identifier = None):
+        """
+        Set notification identifier (32 bit unsigned number) which will be
+        returned in error-response. Notification with identifier is sent
+        in enhanced format.
+        """
+        if identifier == None:
+            self.identifierValue = None
+            return self
+        if not isinstance(identifier, (int, long)) or identifier < 0 or identifier > 0xFFFFFFFF:
+            raise APNSValueError, "Identifier must be a 32 bit unsigned number"
+        self.identifierValue = identifier
+        return self
+        
+    def expiry(self, expiry = None):
+        """
+        Set date (datetime or UNIX timestamp) after which APNS will not try
+        to deliver notification. Notification with expiry is sent in
+        enhanced format.
+        """
+        if expiry == None:
+            self.expiryValue = None
+            return self
+        if not isinstance(expiry, (int, long, datetime.datetime)):
+            raise APNSValueError, "Expiry must be a datetime or UNIX timestamp"
+        self.expiryValue = _timestamp(expiry)
+        return self
+        
+    def priority(self, priority = None):
+        """
+        Set notification priority: PRIORITY_IMMEDIATE (10) or
+        PRIORITY_CONSERVE_POWER (5) for low-priority bulk notifications.
+        Notification with priority is sent in frame format (command 2).
+        """
+        if priority == None:
+            self.priorityValue = None
+            return self
+        if priority not in (PRIORITY_IMMEDIATE, PRIORITY_CONSERVE_POWER):
+            raise APNSValueError, "Priority must be %d or %d" % (PRIORITY_IMMEDIATE, PRIORITY_CONSERVE_POWER)
+        self.priorityValue = priority
+        return self
+        
     def badge(self, num = None):
         """
         Add badge to the notification. If argument is None (by default it is None)
@@ -274,7 +1001,7 @@ class APNSNotification(object):
         """
         Add an alert to the Wrapper. It should be string or APNSAlert object instance.
         """
-        if not isinstance(alert, str) and not isinstance(alert, APNSAlert):
+        if not isinstance(alert, basestring) and not isinstance(alert, APNSAlert):
             raise APNSTypeError, "Wrong type of alert argument. Argument should be String or an instance of APNSAlert object"
         self.alertObject = alert
         return self
@@ -289,63 +1016,291 @@ class APNSNotification(object):
             self.properties.append(prop)
         return self
     
+    def fit(self, max_payload_length = None, ellipsis = u'\u2026'):
+        """
+        Enable fitting mode: if payload is longer than max_payload_length
+        bytes (PAYLOAD_LENGTH_LEGACY, PAYLOAD_LENGTH_2K, PAYLOAD_LENGTH_4K
+        or maxPayloadLength if it's None) alert body or the last loc-arg
+        is truncated and ended by ellipsis instead of an error.
+        """
+        if max_payload_length != None:
+            if not isinstance(max_payload_length, int) or max_payload_length <= 0:
+                raise APNSValueError, "Maximum length of payload should be a positive number"
+            self.maxPayloadLength = max_payload_length
+        self.fitting = True
+        self.ellipsis = ellipsis
+        return self
+        
     def clearProperties(self):
         """
         Clear list of properties.
         """
-        self.properties = None    
+        self.properties = []
         
-    def _build(self):
+    def _object(self):
         """
-        Build all notifications items to one string.
+        Build dictionary of the payload for the JSON encoder.
         """
-        keys = []
-        apsKeys = []
+        aps = {}
         if self.soundValue:
-            apsKeys.append('"sound":"%s"' % _doublequote(self.soundValue))
+            aps['sound'] = self.soundValue
             
         if self.badgeValue:
-            apsKeys.append('"badge":%d' % int(self.badgeValue))
-        
-        if self.alertObject != None:
-            alertArgument = ""
-            if isinstance(self.alertObject, str):
-                alertArgument = _doublequote(self.alertObject)
-                apsKeys.append('"alert":"%s"' % alertArgument)
-            elif isinstance(self.alertObject, APNSAlert):
-                alertArgument = self.alertObject._build()
-                apsKeys.append('"alert":{%s}' % alertArgument)
+            aps['badge'] = int(self.badgeValue)
         
-        keys.append('"aps":{%s}' % ",".join(apsKeys))
+        if isinstance(self.alertObject, APNSAlert):
+            aps['alert'] = self.alertObject._object()
+        elif self.alertObject != None:
+            aps['alert'] = self.alertObject
         
-        # prepare properties
+        payload = {'aps' : aps}
         for property in self.properties:
-            keys.append(property._build())
+            payload[property.name] = property.data
+        return payload
+        
+    def _build(self):
+        """
+        Build payload to compact UTF-8 JSON string by the encoder set by
+        set_json_encoder(). Length of payload is checked in bytes.
+        """
+        payload = _json(self._object())
         
-        payload = "{%s}" % ",".join(keys)
+        if len(payload) > self.maxPayloadLength and self.fitting:
+            return self._fit()
         
         if len(payload) > self.maxPayloadLength:
             raise APNSPayloadLengthError, "Length of Payload more than %d bytes." % self.maxPayloadLength
 
         return payload
             
-    def payload(self):
+    def _fit(self):
+        """
+        Build payload with alert body or the last loc-arg truncated to
+        fit into maxPayloadLength bytes.
+        """
+        payload = self._object()
+        alert = payload['aps'].get('alert')
+        if isinstance(alert, dict) and alert.get('body'):
+            container, key = alert, 'body'
+        elif isinstance(alert, dict) and alert.get('loc-args'):
+            alert['loc-args'] = list(alert['loc-args'])
+            container, key = alert['loc-args'], -1
+        elif alert:
+            container, key = payload['aps'], 'alert'
+        else:
+            raise APNSPayloadLengthError, "Length of Payload more than %d bytes." % self.maxPayloadLength
+        
+        text = container[key]
+        if not isinstance(text, unicode):
+            try:
+                text = text.decode('utf-8')
+            except UnicodeDecodeError:
+                raise APNSValueError, "String should be unicode or UTF-8 encoded"
+        
+        # the rest of payload is serialized once with marker in place of text
+        while True:
+            marker = 'APNSFIT%d' % random.randint(10 ** 8, 10 ** 9 - 1)
+            container[key] = marker
+            parts = _json(payload).split('"%s"' % marker)
+            if len(parts) == 2:
+                break
+        head, tail = parts
+        
+        ellipsis = _doublequote(self.ellipsis)
+        budget = self.maxPayloadLength - len(head) - len(tail) - len(ellipsis) - 2
+        if budget < 0:
+            raise APNSPayloadLengthError, "Length of Payload more than %d bytes." % self.maxPayloadLength
+        
+        # binary search of the longest prefix (in characters, so it's
+        # always cut on UTF-8 boundary) which fits into the budget,
+        # each character takes from 1 (ASCII) to 6 (\u00XX) bytes
+        low = min(len(text), budget // 6)
+        high = min(len(text), budget)
+        if len(encode_basestring_ascii(text)) - 2 == len(text):
+            # neither escapes nor multibyte characters
+            low = high
+        while low < high:
+            middle = (low + high + 1) // 2
+            if len(_jsonString(text[:middle])) - 2 <= budget:
+                low = middle
+            else:
+                high = middle - 1
+        
+        # don't split surrogate pair on narrow unicode builds
+        if low > 0 and u'\ud800' <= text[low - 1] <= u'\udbff':
+            low -= 1
+        
+        return '%s"%s%s"%s' % (head, _doublequote(text[:low]), ellipsis, tail)
+        
+    def _command(self):
+        """
+        Choose the simplest binary format which holds all notification fields.
+        """
+        if self.priorityValue != None:
+            return 2
+        if self.identifierValue != None or self.expiryValue != None:
+            return 1
+        return self.command
+            
+    def payload(self, command = None):
+        """
+        Build notification message in binary format. Enhanced format (command 1)
+        is used if notification has identifier or expiry and frame format
+        (command 2) is used if notification has priority.
+        """
         if self.deviceToken == None:
             raise APNSUndefinedDeviceToken, "You forget to set deviceToken in your notification."
+        
+        if command == None:
+            command = self._command()
+                
+        return _frame(command, self.deviceToken, self._build(), \
+                        self.identifierValue or 0, self.expiryValue or 0, self.priorityValue)
+
+
+class APNSFrameEncoder(object):
+    """
+    Encode many notifications into one preallocated bytearray. Headers
+    are packed by precompiled structures, so there is no format string
+    building for each notification. Buffer is reused between .encode()
+    calls and grows if it is necessary.
+    
+    If command is None, format of each notification is chosen
+    like APNSNotification.payload() does.
+    """
+    
+    command = None
+    buffer = None
+    
+    def __init__(self, command = None, size = 65536):
+        if command not in (None, 0, 1, 2):
+            raise APNSValueError, "Unexpected command %s" % str(command)
+        self.command = command
+        self.buffer = bytearray(size)
+        
+    def _fields(self, item):
+        if isinstance(item, APNSNotification):
+            if item.deviceToken == None:
+                raise APNSUndefinedDeviceToken, "You forget to set deviceToken in your notification."
+            command = self.command
+            if command == None:
+                command = item._command()
+            return (command, item.deviceToken, item._build(), \
+                        item.identifierValue or 0, item.expiryValue or 0, item.priorityValue)
             
-        payload = self._build()
-        payloadLength = len(payload)
-        tokenLength = len(self.deviceToken)
-        tokenFormat = "s" * tokenLength
-        payloadFormat = "s" * payloadLength
+        if not isinstance(item, (tuple, list)) or len(item) != 2:
+            raise APNSTypeError, "Unexpected item type. Item should be an instance of APNSNotification object or (token, payload) pair"
         
-        apnsPackFormat = "!BH" + str(tokenLength) + "sH" + str(payloadLength) + "s"
+        token, payload = item
+        if len(payload) > APNSNotification.maxPayloadLength:
+            raise APNSPayloadLengthError, "Length of Payload more than %d bytes." % APNSNotification.maxPayloadLength
+        return (self.command or APNSNotification.command, token, payload, 0, 0, None)
         
-        # build notification message in binary format
-        return struct.pack(apnsPackFormat, 
-                                    self.command, 
-                                    tokenLength, 
-                                    self.deviceToken, 
-                                    payloadLength, 
-                                    payload)
+    def encode(self, items):
+        """
+        Encode list of APNSNotification objects or (token, payload) pairs.
+        Return memoryview of the encoded part of buffer. It is valid
+        until next call of .encode()
+        """
+        frames = map(self._fields, items)
+        
+        size = 0
+        for command, token, payload, identifier, expiry, priority in frames:
+            size += _frameLength(command, len(token), len(payload), priority)
+            
+        if len(self.buffer) < size:
+            self.buffer = bytearray(size)
+            
+        buff = self.buffer
+        offset = 0
+        for command, token, payload, identifier, expiry, priority in frames:
+            offset = _packFrame(buff, offset, command, token, payload, identifier, expiry, priority)
+            
+        return memoryview(buff)[:offset]
+
+
+class NotificationBatch(object):
+    """
+    Compact columnar representation of many notifications. Tokens are
+    kept in one bytearray, payloads are interned in the table and
+    per-row badge, expiry and identifier are kept in array columns.
+    Payload may be JSON string, APNSNotification (it is built once) or
+    APNSPayloadTemplate with only 'badge' slot, which is rendered with
+    the badge of the row. Use APNSNotificationWrapper.notify_batch()
+    to send it.
+    """
+    __slots__ = ('tokenLength', 'tokens', 'payloads', 'payloadIndexes', \
+                    'badges', 'expiries', 'identifiers', '_interned')
+    
+    NO_BADGE = -1
     
+    def __init__(self, tokenLength = 32):
+        self.tokenLength = tokenLength
+        self.tokens = bytearray()
+        self.payloads = []
+        self.payloadIndexes = array.array('I')
+        self.badges = array.array('i')
+        self.expiries = array.array('I')
+        self.identifiers = array.array('I')
+        self._interned = {}
+        
+    def __len__(self):
+        return len(self.payloadIndexes)
+        
+    def _intern(self, payload):
+        if isinstance(payload, APNSNotification):
+            payload = payload._build()
+        elif not isinstance(payload, str) and tuple(getattr(payload, 'slots', ())) != ('badge',):
+            raise APNSTypeError, "Payload should be JSON string, APNSNotification or APNSPayloadTemplate with badge slot"
+        
+        key = payload
+        if not isinstance(payload, str):
+            key = id(payload)
+        
+        index = self._interned.get(key)
+        if index == None:
+            index = len(self.payloads)
+            self.payloads.append(payload)
+            self._interned[key] = index
+        return index
+        
+    def append(self, token, payload, badge = None, expiry = None, identifier = None):
+        """
+        Add row. Badge is used only with APNSPayloadTemplate payloads.
+        """
+        if len(token) != self.tokenLength:
+            raise APNSValueError, "Length of deviceToken should be %d bytes" % self.tokenLength
+        
+        index = self._intern(payload)
+        if (badge != None) == isinstance(self.payloads[index], str):
+            raise APNSValueError, "Badge of the row should be set only for APNSPayloadTemplate payload"
+        
+        self.tokens.extend(token)
+        self.payloadIndexes.append(index)
+        self.badges.append(badge == None and self.NO_BADGE or badge)
+        self.expiries.append(expiry and _timestamp(expiry) or 0)
+        self.identifiers.append(identifier or 0)
+        return self
+        
+    def rows(self):
+        """
+        Iterate over (token, payload, identifier, expiry) of the rows.
+        """
+        tokens = self.tokens
+        tokenLength = self.tokenLength
+        payloads = self.payloads
+        
+        for i in xrange(len(self)):
+            payload = payloads[self.payloadIndexes[i]]
+            if not isinstance(payload, str):
+                payload = payload.render(self.badges[i])
+            yield (str(tokens[i * tokenLength:(i + 1) * tokenLength]), payload, \
+                    self.identifiers[i], self.expiries[i])
+                    
+    def nbytes(self):
+        """
+        Return approximate number of bytes used by the batch columns
+        (without interned payloads).
+        """
+        columns = (self.payloadIndexes, self.badges, self.expiries, self.identifiers)
+        return len(self.tokens) + sum([len(c) * c.itemsize for c in columns])
@@ -0,0 +1,191 @@
+# Copyright 2009 Max Klymyshyn, Sonettic
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#    http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import time
+import threading
+
+from apnsexceptions import *
+
+# error-response statuses caused by the notification itself (missing or
+# invalid token, topic or payload), they don't mean the gateway is overloaded
+NOTIFICATION_STATUSES = (2, 3, 4, 5, 6, 7, 8)
+
+class APNSTokenBucket(object):
+    """
+    Token bucket with rate units per second and capacity of burst
+    units. Request larger than the capacity is allowed, the bucket
+    goes to debt and next requests wait until it is paid.
+    """
+
+    def __init__(self, rate, burst = None):
+        if rate <= 0:
+            raise APNSValueError, "Rate should be a positive number"
+        self.rate = float(rate)
+        self.burst = float(burst or rate)
+        self.tokens = self.burst
+        self.timestamp = time.time()
+        self._lock = threading.Lock()
+
+    def reserve(self, amount):
+        """
+        Take amount of tokens and return number of seconds caller
+        should wait before it uses them.
+        """
+        self._lock.acquire()
+        try:
+            now = time.time()
+            self.tokens = min(self.burst, self.tokens + (now - self.timestamp) * self.rate)
+            self.timestamp = now
+            self.tokens -= amount
+            if self.tokens >= 0:
+                return 0
+            return -self.tokens / self.rate
+        finally:
+            self._lock.release()
+
+
+class APNSPacer(object):
+    """
+    Limit of frames and bytes per second of writes to the gateway.
+    Pacer of the connection may have parent pacer which limits all
+    connections together:
+
+        total = APNSPacer(frames_per_second = 20000)
+        pacer = APNSPacer(frames_per_second = 5000, parent = total)
+        wrapper = APNSNotificationWrapper(certificate, pacer = pacer)
+
+    In adaptive mode rates are multiplied by decrease after each
+    disconnect or error-response which isn't caused by notification
+    itself and grow by increase * configured rate every second without
+    errors until they reach configured rates (AIMD).
+    """
+
+    chunkSize = 16384
+    adaptive = True
+    decrease = 0.5
+    increase = 0.05
+    minimum = 0.05
+
+    def __init__(self, frames_per_second = None, bytes_per_second = None, parent = None, \
+                    chunk_size = 16384, adaptive = True, decrease = 0.5, increase = 0.05, \
+                    minimum = 0.05):
+        self.framesPerSecond = frames_per_second
+        self.bytesPerSecond = bytes_per_second
+        self.parent = parent
+        self.chunkSize = chunk_size
+        self.adaptive = adaptive
+        self.decrease = decrease
+        self.increase = increase
+        self.minimum = minimum
+
+        self._buckets = []
+        self._frameBucket = None
+        self._byteBucket = None
+        if frames_per_second:
+            self._frameBucket = APNSTokenBucket(frames_per_second)
+        if bytes_per_second:
+            self._byteBucket = APNSTokenBucket(bytes_per_second)
+
+        # current share of the configured rates
+        self.scale = 1.0
+        self.decreases = 0
+        self.frames = 0
+        self.bytes = 0
+        self.waited = 0.0
+        self.started = None
+        self._adjusted = time.time()
+        self._lock = threading.Lock()
+
+    def _setScale(self, scale):
+        self.scale = max(self.minimum, min(1.0, scale))
+        if self._frameBucket != None:
+            self._frameBucket.rate = self.framesPerSecond * self.scale
+        if self._byteBucket != None:
+            self._byteBucket.rate = self.bytesPerSecond * self.scale
+
+    def _grow(self, now):
+        """
+        Additive increase for every second without errors.
+        """
+        elapsed = now - self._adjusted
+        if elapsed < 1 or self.scale >= 1.0:
+            return
+        self._adjusted = now
+        self._setScale(self.scale + self.increase * int(elapsed))
+
+    def delay(self, frames, nbytes):
+        """
+        Reserve frames and bytes and return number of seconds to wait.
+        """
+        self._lock.acquire()
+        try:
+            now = time.time()
+            if self.started == None:
+                self.started = now
+            if self.adaptive:
+                self._grow(now)
+            self.frames += frames
+            self.bytes += nbytes
+        finally:
+            self._lock.release()
+
+        delay = 0
+        if self._frameBucket != None:
+            delay = max(delay, self._frameBucket.reserve(frames))
+        if self._byteBucket != None:
+            delay = max(delay, self._byteBucket.reserve(nbytes))
+        if self.parent != None:
+            delay = max(delay, self.parent.delay(frames, nbytes))
+        return delay
+
+    def acquire(self, frames, nbytes):
+        """
+        Wait until frames and bytes may be written.
+        """
+        delay = self.delay(frames, nbytes)
+        if delay > 0:
+            self.waited += delay
+            time.sleep(delay)
+
+    def failure(self, status = None):
+        """
+        Report disconnect (status is None) or error-response status.
+        """
+        if self.parent != None:
+            self.parent.failure(status)
+        if not self.adaptive or status in NOTIFICATION_STATUSES:
+            return
+        self._lock.acquire()
+        try:
+            self.decreases += 1
+            self._adjusted = time.time()
+            self._setScale(self.scale * self.decrease)
+        finally:
+            self._lock.release()
+
+    def statistics(self):
+        """
+        Return achieved throughput and current limits.
+        """
+        elapsed = 0
+        if self.started != None:
+            elapsed = time.time() - self.started
+        return {
+            'frames' : self.frames,
+            'bytes' : self.bytes,
+            'seconds' : elapsed,
+            'waited' : self.waited,
+            'throughput' : elapsed and self.frames / elapsed or 0,
+            'bandwidth' : elapsed and self.bytes / elapsed or 0,
+            'frames_limit' : self._frameBucket and self._frameBucket.rate,
+            'bytes_limit' : self._byteBucket and self._byteBucket.rate,
+            'decreases' : self.decreases
+        }
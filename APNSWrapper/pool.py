@@ -0,0 +1,300 @@
+# Copyright 2009 Max Klymyshyn, Sonettic
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#    http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import Queue
+import socket
+import threading
+
+from connection import *
+from apnsexceptions import *
+import notifications
+import pacing
+
+ROUND_ROBIN = 'round-robin'
+LEAST_BACKLOG = 'least-backlog'
+
+class APNSPoolWorker(threading.Thread):
+    """
+    Worker thread which own one APNSConnection and send frames
+    from its own queue. Queued frames are collected up to bufferSize
+    bytes and written by one vectored write.
+    """
+
+    def __init__(self, pool, connection):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.pool = pool
+        self.connection = connection
+        self.queue = Queue.Queue(pool.queueSize)
+        self.framesSent = 0
+        self.errors = 0
+        self.pacer = pool._pacer()
+
+    def backlog(self):
+        return self.queue.qsize()
+
+    def _connect(self):
+        connection = self.connection
+        if connection.connected:
+            return connection
+        return connection.connect(self.pool._host(), self.pool.apnsPort)
+
+    def _check(self):
+        """
+        Reopen dropped or idle connection.
+        """
+        connection = self.connection
+        if not connection.connected:
+            return
+        idle = connection.idle()
+        if not connection.alive() or \
+                (self.pool.idleTimeout != None and idle != None and idle >= self.pool.idleTimeout):
+            connection.close()
+
+    def _write(self, frames):
+        handshakes = self.connection.handshakes
+        try:
+            self._connect().writev(frames)
+        except (socket.error, IOError, OSError):
+            if self.connection.connected:
+                self.connection.close()
+            # disconnect is reported once even if the next write fails too
+            if self.pacer != None:
+                self.pacer.failure()
+            if self.connection.handshakes != handshakes:
+                raise
+            # reused connection was dropped, try once again with new one
+            self._connect().writev(frames)
+
+    def run(self):
+        queue = self.queue
+        bufferSize = self.pool.bufferSize
+
+        while True:
+            try:
+                frame = queue.get(True, self.pool.healthCheckInterval)
+            except Queue.Empty:
+                self._check()
+                continue
+
+            stop = frame == None
+            frames = []
+            size = 0
+            if not stop:
+                frames.append(frame)
+                size = len(frame)
+
+            # coalesce already queued frames to the one write
+            while not stop and size < bufferSize:
+                try:
+                    frame = queue.get_nowait()
+                except Queue.Empty:
+                    break
+                if frame == None:
+                    stop = True
+                    break
+                frames.append(frame)
+                size += len(frame)
+
+            try:
+                try:
+                    if len(frames) > 0:
+                        if self.pacer != None:
+                            self.pacer.acquire(len(frames), size)
+                        self._write(frames)
+                        self.framesSent += len(frames)
+                except Exception, e:
+                    # any error (e.g. failed certificate verification)
+                    # fails only this batch, worker keeps running
+                    self.errors += 1
+                    if self.connection.connected:
+                        self.connection.close()
+                    self.pool._error(self, frames, e)
+            finally:
+                for i in xrange(len(frames) + int(stop)):
+                    queue.task_done()
+
+            if stop:
+                break
+
+        if self.connection.connected:
+            self.connection.close()
+
+
+class APNSConnectionPool(object):
+    """
+    Pool of parallel connections to the APNS server. Frames are
+    dispatched to the worker threads (one per connection) by
+    round-robin or least-backlog strategy.
+
+    Frames which can't be sent are passed to the onError callback
+    with the worker and exception or collected into .failed list.
+    
+    Writes of all connections are limited by APNSPacer passed as pacer
+    and writes of each connection by connection_frames_per_second and
+    connection_bytes_per_second.
+    """
+
+    sandbox = True
+    apnsHost = 'gateway.push.apple.com'
+    apnsSandboxHost = 'gateway.sandbox.push.apple.com'
+    apnsPort = 2195
+
+    size = 4
+    bufferSize = 16384
+    queueSize = 10000
+    strategy = ROUND_ROBIN
+    healthCheckInterval = 30
+    idleTimeout = 300
+
+    workers = None
+    failed = None
+    onError = None
+    pacer = None
+
+    def __init__(self, certificate = None, sandbox = True, size = 4, \
+                    buffer_size = 16384, queue_size = 10000, strategy = ROUND_ROBIN, \
+                    health_check_interval = 30, idle_timeout = 300, \
+                    force_ssl_command = False, debug_ssl = False, on_error = None, \
+                    pacer = None, connection_frames_per_second = None, \
+                    connection_bytes_per_second = None):
+        if strategy not in (ROUND_ROBIN, LEAST_BACKLOG):
+            raise APNSValueError, "Unexpected dispatch strategy %s" % str(strategy)
+        if not isinstance(size, int) or size < 1:
+            raise APNSValueError, "Size of the pool should be a positive number"
+
+        self.certificate = certificate
+        self.sandbox = sandbox
+        self.size = size
+        self.bufferSize = buffer_size
+        self.queueSize = queue_size
+        self.strategy = strategy
+        self.healthCheckInterval = health_check_interval
+        self.idleTimeout = idle_timeout
+        self.force_ssl_command = force_ssl_command
+        self.debug_ssl = debug_ssl
+        self.onError = on_error
+        self.pacer = pacer
+        self.connectionFramesPerSecond = connection_frames_per_second
+        self.connectionBytesPerSecond = connection_bytes_per_second
+        self.workers = []
+        self.failed = []
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def _host(self):
+        if self.sandbox != True:
+            return self.apnsHost
+        return self.apnsSandboxHost
+
+    def _connection(self):
+        return APNSConnection(certificate = self.certificate, \
+                    force_ssl_command = self.force_ssl_command, debug = self.debug_ssl)
+
+    def _pacer(self):
+        """
+        Return pacer for the new worker.
+        """
+        if self.connectionFramesPerSecond == None and self.connectionBytesPerSecond == None:
+            return self.pacer
+        return pacing.APNSPacer(self.connectionFramesPerSecond, self.connectionBytesPerSecond, \
+                    parent = self.pacer)
+
+    def _error(self, worker, frames, exception):
+        if self.onError:
+            self.onError(worker, frames, exception)
+        else:
+            self._lock.acquire()
+            try:
+                self.failed.extend(frames)
+            finally:
+                self._lock.release()
+
+    def start(self):
+        """
+        Start worker threads. It is called implicitly by first .append()
+        """
+        if len(self.workers) > 0:
+            return self
+        # producers may call the first .write() at once
+        self._lock.acquire()
+        try:
+            if len(self.workers) > 0:
+                return self
+            workers = []
+            for i in xrange(self.size):
+                worker = APNSPoolWorker(self, self._connection())
+                worker.start()
+                workers.append(worker)
+            self.workers = workers
+        finally:
+            self._lock.release()
+        return self
+
+    def _worker(self):
+        if self.strategy == LEAST_BACKLOG:
+            return min(self.workers, key = lambda w: w.backlog())
+
+        self._lock.acquire()
+        try:
+            worker = self.workers[self._next % len(self.workers)]
+            self._next += 1
+        finally:
+            self._lock.release()
+        return worker
+
+    def write(self, frame):
+        """
+        Queue already encoded binary frame. Blocks when queue of
+        the selected worker is full.
+        """
+        self.start()
+        self._worker().queue.put(frame)
+
+    def append(self, notification = None):
+        """
+        Queue APNSNotification to send by one of the pool connections.
+        """
+        if not isinstance(notification, notifications.APNSNotification):
+            raise APNSTypeError, "Unexpected argument type. Argument should be an instance of APNSNotification object"
+        self.write(notification.payload())
+
+    def join(self):
+        """
+        Wait until all queued frames will be sent.
+        """
+        for worker in self.workers:
+            worker.queue.join()
+
+    def close(self):
+        """
+        Send queued frames, stop worker threads and close connections.
+        """
+        for worker in self.workers:
+            worker.queue.put(None)
+        for worker in self.workers:
+            worker.join()
+        # next .start() creates new workers
+        self.workers = []
+
+    def statistics(self):
+        """
+        Return aggregated statistics of the pool connections.
+        """
+        return {
+            'connections' : len(self.workers),
+            'handshakes' : sum([w.connection.handshakes for w in self.workers]),
+            'frames' : sum([w.framesSent for w in self.workers]),
+            'bytes' : sum([w.connection.bytesSent for w in self.workers]),
+            'errors' : sum([w.errors for w in self.workers]),
+            'backlog' : sum([w.backlog() for w in self.workers]),
+            'pacing' : self.pacer != None and self.pacer.statistics() or None
+        }
@@ -0,0 +1,373 @@
+# Copyright 2009 Max Klymyshyn, Sonettic
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#    http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import time
+import mmap
+import Queue
+import socket
+import struct
+import multiprocessing
+
+from connection import *
+from apnsexceptions import *
+import notifications
+
+# ring header: head (written by producer) and tail (written by consumer)
+_RING_HEADER = struct.Struct('QQ')
+_HEAD = struct.Struct('Q')
+# record header: length of the block of frames and number of frames
+_RING_RECORD = struct.Struct('II')
+# record which means "skip to the beginning of the ring"
+_RING_PADDING = 0xFFFFFFFF
+
+class APNSFrameRing(object):
+    """
+    Single producer, single consumer ring buffer of frame blocks in
+    the anonymous shared memory. Ring should be created before fork,
+    consumer is signalled by the semaphore after each put().
+    """
+
+    capacity = 4 * 1024 * 1024
+    # how long full ring is polled by producer
+    pollInterval = 0.0005
+
+    def __init__(self, capacity = 4 * 1024 * 1024, semaphore = None):
+        self.capacity = capacity
+        self.semaphore = semaphore or multiprocessing.Semaphore(0)
+        self.map = mmap.mmap(-1, _RING_HEADER.size + capacity)
+
+    def _positions(self):
+        return _RING_HEADER.unpack_from(self.map, 0)
+
+    def put(self, block, count):
+        """
+        Append block of count frames, waits while ring is full.
+        Record with count 0 is the end of the stream, its block is
+        error message of the producer.
+        """
+        length = _RING_RECORD.size + len(block)
+        if length > self.capacity // 2:
+            raise APNSValueError, "Block of frames is larger than half of the ring"
+
+        data = self.map
+        capacity = self.capacity
+        head = self._positions()[0]
+        position = head % capacity
+        # record is always contiguous, tail of the ring is skipped
+        skip = 0
+        if position + length > capacity:
+            skip = capacity - position
+
+        while head + skip + length - self._positions()[1] > capacity:
+            time.sleep(self.pollInterval)
+
+        if skip > 0:
+            if skip >= _RING_RECORD.size:
+                _RING_RECORD.pack_into(data, _RING_HEADER.size + position, _RING_PADDING, 0)
+            head += skip
+            position = 0
+
+        start = _RING_HEADER.size + position
+        _RING_RECORD.pack_into(data, start, len(block), count)
+        data[start + _RING_RECORD.size:start + length] = block
+        _HEAD.pack_into(data, 0, head + length)
+        self.semaphore.release()
+
+    def get(self):
+        """
+        Return (block, count) of the next record or None if ring is
+        empty. Doesn't wait for the semaphore.
+        """
+        data = self.map
+        capacity = self.capacity
+        head, tail = self._positions()
+        while tail < head:
+            position = tail % capacity
+            if capacity - position < _RING_RECORD.size:
+                tail += capacity - position
+                continue
+            start = _RING_HEADER.size + position
+            length, count = _RING_RECORD.unpack_from(data, start)
+            if length == _RING_PADDING:
+                tail += capacity - position
+                continue
+            end = start + _RING_RECORD.size + length
+            block = data[start + _RING_RECORD.size:end]
+            _HEAD.pack_into(data, _HEAD.size, tail + _RING_RECORD.size + length)
+            return block, count
+        _HEAD.pack_into(data, _HEAD.size, tail)
+        return None
+
+
+class APNSProcessPool(object):
+    """
+    Sender which uses several processes to avoid the GIL. Encoder
+    processes build frames (payload JSON and struct packing) and put
+    them by blocks of buffer_size bytes to shared memory rings, sender
+    processes read blocks from the rings and write them to their own
+    connections_per_sender connections in round-robin order:
+
+        pool = APNSProcessPool(certificate, encoders = 4, senders = 2)
+        result = pool.send(users, build = lambda user: notificationFor(user))
+        pool.close()
+
+    Encoder i encodes every i-th item, items aren't pickled because
+    encoders are forked by each .send() call. Items should be a sequence
+    (list, tuple, etc.): generator or cursor can't be shared by forked
+    processes, so read rows into a list first. build(item) should return
+    APNSNotification, (token, payload) pair or encoded frame. Sender
+    processes are forked by .start() and keep connections opened
+    between .send() calls.
+    """
+
+    sandbox = True
+    apnsHost = 'gateway.push.apple.com'
+    apnsSandboxHost = 'gateway.sandbox.push.apple.com'
+    apnsPort = 2195
+
+    encoders = 4
+    senders = 2
+    connectionsPerSender = 1
+    bufferSize = 16384
+    ringSize = 4 * 1024 * 1024
+
+    def __init__(self, certificate = None, sandbox = True, encoders = 4, senders = 2, \
+                    connections_per_sender = 1, buffer_size = 16384, ring_size = 4 * 1024 * 1024, \
+                    force_ssl_command = False, debug_ssl = False):
+        if not isinstance(encoders, int) or encoders < 1:
+            raise APNSValueError, "Number of encoders should be a positive number"
+        if not isinstance(senders, int) or senders < 1 or senders > encoders:
+            raise APNSValueError, "Number of senders should be from 1 to number of encoders"
+        if buffer_size * 4 > ring_size:
+            raise APNSValueError, "Size of the ring should be at least four buffers"
+
+        self.certificate = certificate
+        self.sandbox = sandbox
+        self.encoders = encoders
+        self.senders = senders
+        self.connectionsPerSender = connections_per_sender
+        self.bufferSize = buffer_size
+        self.ringSize = ring_size
+        self.force_ssl_command = force_ssl_command
+        self.debug_ssl = debug_ssl
+
+        self._processes = []
+        self._rings = None
+        self._results = None
+        self._stopped = None
+
+    def _host(self):
+        if self.sandbox != True:
+            return self.apnsHost
+        return self.apnsSandboxHost
+
+    def start(self):
+        """
+        Create rings and fork sender processes. It is called implicitly
+        by the first .send()
+        """
+        if len(self._processes) > 0:
+            return self
+
+        # each sender reads rings of encoders i, i + senders, ...
+        semaphores = [multiprocessing.Semaphore(0) for i in xrange(self.senders)]
+        self._rings = [APNSFrameRing(self.ringSize, semaphores[i % self.senders]) \
+                        for i in xrange(self.encoders)]
+        self._results = multiprocessing.Queue()
+        self._stopped = multiprocessing.Event()
+
+        for i in xrange(self.senders):
+            process = multiprocessing.Process(target = self._sender, args = (i,))
+            process.daemon = True
+            process.start()
+            self._processes.append(process)
+        return self
+
+    def _connection(self):
+        return APNSConnection(certificate = self.certificate, \
+                    force_ssl_command = self.force_ssl_command, debug = self.debug_ssl)
+
+    def _frame(self, item):
+        if isinstance(item, notifications.APNSNotification):
+            return item.payload()
+        if isinstance(item, (tuple, list)) and len(item) == 2:
+            token, payload = item
+            if len(payload) > notifications.APNSNotification.maxPayloadLength:
+                raise APNSPayloadLengthError, "Length of Payload more than %d bytes." % \
+                            notifications.APNSNotification.maxPayloadLength
+            return notifications._frame(notifications.APNSNotification.command, token, payload)
+        if isinstance(item, str):
+            return item
+        raise APNSTypeError, "Unexpected item type. Item should be an instance of APNSNotification object, (token, payload) pair or frame"
+
+    def _encoder(self, index, items, build):
+        """
+        Body of the encoder process. Items which can't be built or
+        encoded are skipped and reported by (index, error) pairs.
+        """
+        ring = self._rings[index]
+        bufferSize = self.bufferSize
+        frame = self._frame
+        frames = []
+        size = 0
+        invalid = []
+        error = ''
+        try:
+            try:
+                for i in xrange(index, len(items), self.encoders):
+                    # bad item shouldn't stop encoding of the rest
+                    try:
+                        item = items[i]
+                        if build != None:
+                            item = build(item)
+                        data = frame(item)
+                    except Exception, e:
+                        invalid.append((i, "%s: %s" % (e.__class__.__name__, e)))
+                        continue
+                    frames.append(data)
+                    size += len(data)
+                    if size >= bufferSize:
+                        ring.put("".join(frames), len(frames))
+                        frames = []
+                        size = 0
+            except Exception, e:
+                error = "%s: %s" % (e.__class__.__name__, e)
+        finally:
+            # frames encoded before an error are sent too
+            if len(frames) > 0:
+                ring.put("".join(frames), len(frames))
+            self._results.put(('encoder', index, invalid))
+            ring.put(error[:1024], 0)
+
+    def _write(self, connection, block):
+        handshakes = connection.handshakes
+        try:
+            if not connection.connected:
+                connection.connect(self._host(), self.apnsPort)
+            connection.writev([block])
+        except (socket.error, IOError, OSError):
+            if connection.connected:
+                connection.close()
+            if connection.handshakes != handshakes:
+                raise
+            # reused connection was dropped, try once again with new one
+            connection.connect(self._host(), self.apnsPort)
+            connection.writev([block])
+
+    def _sender(self, index):
+        """
+        Body of the sender process.
+        """
+        rings = [(i, r) for i, r in enumerate(self._rings) if i % self.senders == index]
+        semaphore = rings[0][1].semaphore
+        connections = [self._connection() for i in xrange(self.connectionsPerSender)]
+        sent = dict([(i, 0) for i, r in rings])
+        failed = dict([(i, 0) for i, r in rings])
+        turn = 0
+
+        while True:
+            if not semaphore.acquire(True, 1):
+                if self._stopped.is_set():
+                    break
+                continue
+            for ringIndex, ring in rings:
+                record = ring.get()
+                if record != None:
+                    break
+            else:
+                continue
+
+            block, count = record
+            if count == 0:
+                # end of the stream of the encoder
+                self._results.put(('sender', ringIndex, sent[ringIndex], failed[ringIndex], block))
+                sent[ringIndex] = 0
+                failed[ringIndex] = 0
+                continue
+
+            connection = connections[turn % len(connections)]
+            turn += 1
+            try:
+                self._write(connection, block)
+                sent[ringIndex] += count
+            except Exception:
+                # any error (e.g. failed certificate verification) fails
+                # only this block, sender keeps reading the rings
+                if connection.connected:
+                    connection.close()
+                failed[ringIndex] += count
+
+        for connection in connections:
+            if connection.connected:
+                connection.close()
+
+    def send(self, items, build = None):
+        """
+        Encode and send sequence of items by encoder and sender
+        processes. Waits until all frames are written, only one .send()
+        may run at once. Return dictionary with number of sent and
+        failed frames, errors of encoders, time in seconds and list
+        of (index, error) of items which couldn't be built or encoded
+        and were not sent ('invalid').
+        """
+        if not hasattr(items, '__len__') or not hasattr(items, '__getitem__'):
+            raise APNSTypeError, "Unexpected argument type. Items should be a sequence, e.g. list"
+        self.start()
+        started = time.time()
+        encoders = [multiprocessing.Process(target = self._encoder, args = (i, items, build)) \
+                        for i in xrange(self.encoders)]
+        for process in encoders:
+            process.daemon = True
+            process.start()
+
+        result = {'frames' : 0, 'failed' : 0, 'errors' : [], 'invalid' : []}
+        # each encoder reports invalid items and its sender reports end of the stream
+        done = 0
+        while done < 2 * self.encoders:
+            try:
+                message = self._results.get(True, 1)
+            except Queue.Empty:
+                if len([p for p in self._processes if not p.is_alive()]) > 0:
+                    raise APNSConnectionError, "Sender process is terminated"
+                # encoder killed e.g. by OOM killer never sends end of the stream
+                if len([p for p in encoders if p.exitcode not in (None, 0)]) > 0:
+                    for process in encoders:
+                        if process.is_alive():
+                            process.terminate()
+                        process.join()
+                    raise APNSConnectionError, "Encoder process is terminated"
+                continue
+            done += 1
+            if message[0] == 'encoder':
+                result['invalid'].extend(message[2])
+                continue
+            kind, ringIndex, sent, failed, error = message
+            result['frames'] += sent
+            result['failed'] += failed
+            if error:
+                result['errors'].append(error)
+
+        for process in encoders:
+            process.join()
+        result['invalid'].sort()
+        result['seconds'] = time.time() - started
+        return result
+
+    def close(self):
+        """
+        Stop sender processes and close their connections.
+        """
+        if len(self._processes) == 0:
+            return
+        self._stopped.set()
+        for process in self._processes:
+            process.join()
+        self._processes = []
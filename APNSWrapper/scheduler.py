@@ -0,0 +1,331 @@
+# Copyright 2009 Max Klymyshyn, Sonettic
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#    http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import time
+import array
+import socket
+import datetime
+import threading
+import collections
+
+from apnsexceptions import *
+import notifications
+
+CLASS_TRANSACTIONAL = 0
+CLASS_DEFAULT = 1
+CLASS_BULK = 2
+
+class APNSLatencyHistogram(object):
+    """
+    Histogram of queue latencies with power of two buckets in
+    milliseconds: <1ms, <2ms, <4ms ... <65536ms and the rest.
+    """
+
+    bounds = [2 ** i for i in xrange(17)]
+
+    def __init__(self):
+        self.counts = array.array('L', [0] * (len(self.bounds) + 1))
+        self.count = 0
+        self.total = 0.0
+        self.maximum = 0.0
+
+    def add(self, seconds):
+        milliseconds = seconds * 1000
+        index = 0
+        bounds = self.bounds
+        while index < len(bounds) and milliseconds >= bounds[index]:
+            index += 1
+        self.counts[index] += 1
+        self.count += 1
+        self.total += seconds
+        self.maximum = max(self.maximum, seconds)
+
+    def percentile(self, percent):
+        """
+        Return upper bound in seconds of the bucket which contains
+        percentile or None if histogram is empty.
+        """
+        if self.count == 0:
+            return None
+        rank = self.count * percent / 100.0
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count > 0:
+                if index == len(self.bounds):
+                    return self.maximum
+                return self.bounds[index] / 1000.0
+        return self.maximum
+
+    def statistics(self):
+        return {
+            'count' : self.count,
+            'mean' : self.count and self.total / self.count or 0,
+            'max' : self.maximum,
+            'p50' : self.percentile(50),
+            'p99' : self.percentile(99)
+        }
+
+
+class APNSScheduler(object):
+    """
+    Priority queues in front of APNSNotificationWrapper. Notification
+    is queued with its class (CLASS_TRANSACTIONAL, CLASS_DEFAULT,
+    CLASS_BULK or any number less than classes, lower number is more
+    important) and optional deadline. Frames are written by chunks of
+    chunk_size bytes and each chunk is taken from the most important
+    non-empty class, so transactional notification queued during
+    campaign is sent right after the current chunk of bulk ones.
+
+    Notifications which weren't sent until their deadline are dropped
+    before encoding and passed to on_expired callback. Notifications
+    to tokens suppressed by the wrapper are dropped like by .notify().
+    Notifications which can't be encoded (e.g. too long payload) or
+    whose chunk can't be written are counted as failed and passed to
+    on_error callback with the exception. Queue latency of sent
+    notifications is collected to histogram of each class.
+
+    Call .flush() to send queued notifications or .start() to send
+    them by background thread while they are queued. Background thread
+    finishes writes (waits for late error-responses and closes
+    non-persistent connection) only after it was idle idleInterval
+    seconds or when it is stopped.
+    """
+
+    classes = 3
+    chunkSize = 16384
+    onExpired = None
+    onError = None
+    idleInterval = 1
+
+    def __init__(self, wrapper, classes = 3, chunk_size = 16384, on_expired = None, on_error = None):
+        if not isinstance(wrapper, notifications.APNSNotificationWrapper):
+            raise APNSTypeError, "Unexpected argument type. Argument should be an instance of APNSNotificationWrapper object"
+        self.wrapper = wrapper
+        self.classes = classes
+        self.chunkSize = chunk_size
+        self.onExpired = on_expired
+        self.onError = on_error
+
+        self.queues = [collections.deque() for i in xrange(classes)]
+        self.histograms = [APNSLatencyHistogram() for i in xrange(classes)]
+        self.sent = [0] * classes
+        self.expired = [0] * classes
+        self.failed = [0] * classes
+
+        self._frameSize = 100
+        self._thread = None
+        self._stopped = False
+        self._sending = False
+        self._condition = threading.Condition(threading.Lock())
+
+    def __len__(self):
+        return sum([len(q) for q in self.queues])
+
+    def append(self, notification, priority_class = CLASS_DEFAULT, deadline = None):
+        """
+        Queue notification. Deadline is datetime or UNIX timestamp.
+        """
+        if not isinstance(notification, notifications.APNSNotification):
+            raise APNSTypeError, "Unexpected argument type. Argument should be an instance of APNSNotification object"
+        if not isinstance(priority_class, int) or priority_class < 0 or priority_class >= self.classes:
+            raise APNSValueError, "Priority class should be a number from 0 to %d" % (self.classes - 1)
+        if not notification.deviceToken:
+            raise APNSUndefinedDeviceToken, "You forget to set deviceToken in your notification."
+        if isinstance(deadline, datetime.datetime):
+            deadline = time.mktime(deadline.timetuple())
+
+        self._condition.acquire()
+        try:
+            self.queues[priority_class].append((time.time(), deadline, notification))
+            self._condition.notifyAll()
+        finally:
+            self._condition.release()
+
+    def _take(self):
+        """
+        Take chunk of notifications from the most important non-empty
+        class. Return (class, items, expired notifications).
+        Called with the lock held.
+        """
+        now = time.time()
+        expired = []
+        for priorityClass, queue in enumerate(self.queues):
+            items = []
+            size = 0
+            # notifications are encoded out of the lock, so size of
+            # the chunk is estimated by average size of sent frames
+            while len(queue) > 0 and size < self.chunkSize:
+                item = queue.popleft()
+                if item[1] != None and item[1] < now:
+                    self.expired[priorityClass] += 1
+                    expired.append(item[2])
+                    continue
+                items.append(item)
+                size += self._frameSize
+            if len(items) > 0 or len(expired) > 0:
+                return priorityClass, items, expired
+        return None, [], expired
+
+    def _sendChunk(self):
+        """
+        Send one chunk. Return False if all queues are empty.
+        """
+        self._condition.acquire()
+        try:
+            priorityClass, items, expired = self._take()
+            if priorityClass == None and len(expired) == 0:
+                return False
+            self._sending = True
+        finally:
+            self._condition.release()
+
+        try:
+            if self.onExpired:
+                for notification in expired:
+                    self.onExpired(notification)
+            if len(items) > 0:
+                wrapper = self.wrapper
+                entries = []
+                valid = []
+                for item in items:
+                    # notifications to tokens of the suppression index are dropped
+                    if wrapper._suppressedItem(item[2]):
+                        continue
+                    # bad notification shouldn't break the chunk
+                    try:
+                        entries.append(wrapper._frame(item[2]))
+                    except Exception, e:
+                        self.failed[priorityClass] += 1
+                        if self.onError:
+                            self.onError(item[2], e)
+                        continue
+                    valid.append(item)
+                items = valid
+                if len(entries) > 0:
+                    self._frameSize = sum([len(e[1]) for e in entries]) // len(entries)
+                    try:
+                        wrapper._send(entries)
+                    except (socket.error, IOError, OSError, APNSConnectionError), e:
+                        # notifications are already taken from the queue
+                        self.failed[priorityClass] += len(items)
+                        if self.onError:
+                            for item in items:
+                                self.onError(item[2], e)
+                        raise
+                now = time.time()
+                histogram = self.histograms[priorityClass]
+                for item in items:
+                    histogram.add(now - item[0])
+                self.sent[priorityClass] += len(items)
+        finally:
+            self._condition.acquire()
+            self._sending = False
+            self._condition.notifyAll()
+            self._condition.release()
+        return True
+
+    def flush(self):
+        """
+        Send all queued notifications. Return number of sent ones.
+        """
+        sent = sum(self.sent)
+        try:
+            while self._sendChunk():
+                pass
+        finally:
+            self.wrapper._finish()
+        return sum(self.sent) - sent
+
+    def _run(self):
+        # were notifications written after the last ._finish()
+        written = False
+        while True:
+            self._condition.acquire()
+            try:
+                if len(self) == 0 and not self._stopped:
+                    self._condition.wait(written and self.idleInterval or None)
+                idle = len(self) == 0
+                stopped = self._stopped
+            finally:
+                self._condition.release()
+
+            if not idle:
+                written = True
+                try:
+                    while self._sendChunk():
+                        pass
+                except (socket.error, IOError, OSError, APNSConnectionError):
+                    # notifications of failed chunk are passed to on_error,
+                    # next chunks will be sent by new connection
+                    pass
+                continue
+
+            if written:
+                written = False
+                try:
+                    self.wrapper._finish()
+                except (socket.error, IOError, OSError, APNSConnectionError):
+                    pass
+            if stopped:
+                break
+
+    def start(self):
+        """
+        Start background thread which sends queued notifications.
+        """
+        if self._thread == None:
+            self._stopped = False
+            self._thread = threading.Thread(target = self._run)
+            self._thread.daemon = True
+            self._thread.start()
+        return self
+
+    def join(self):
+        """
+        Wait until queued notifications are sent by background thread.
+        """
+        self._condition.acquire()
+        try:
+            while len(self) > 0 or self._sending:
+                if self._thread != None and not self._thread.is_alive():
+                    raise APNSConnectionError, "Scheduler thread is terminated"
+                self._condition.wait(1)
+        finally:
+            self._condition.release()
+
+    def close(self):
+        """
+        Send queued notifications and stop background thread.
+        """
+        if self._thread == None:
+            return
+        self._condition.acquire()
+        try:
+            self._stopped = True
+            self._condition.notifyAll()
+        finally:
+            self._condition.release()
+        self._thread.join()
+        self._thread = None
+
+    def statistics(self):
+        """
+        Return number of sent, expired, failed and queued notifications and
+        queue latency of each class.
+        """
+        return dict([(priorityClass, {
+                    'sent' : self.sent[priorityClass],
+                    'expired' : self.expired[priorityClass],
+                    'failed' : self.failed[priorityClass],
+                    'queued' : len(self.queues[priorityClass]),
+                    'latency' : self.histograms[priorityClass].statistics()
+                }) for priorityClass in xrange(self.classes)])
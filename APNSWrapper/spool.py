@@ -0,0 +1,466 @@
+# Copyright 2009 Max Klymyshyn, Sonettic
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#    http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import zlib
+import mmap
+import errno
+import fcntl
+import struct
+import threading
+
+from apnsexceptions import *
+
+SPOOL_MAGIC = 'APSP'
+SPOOL_VERSION = 1
+
+# segment header: magic, version, sealed flag, committed offset
+_HEADER = struct.Struct('!4sHHQ')
+_SEALED_FLAG = 6
+_COMMITTED_OFFSET = 8
+# record header: length of the body, number of frames, crc32 of the body.
+# Body is index of (identifier, length) of each frame and frames themselves.
+_RECORD = struct.Struct('!III')
+_INDEX_ITEM = 8
+
+def _checksum(data):
+    return zlib.crc32(data) & 0xFFFFFFFF
+
+
+class _APNSSpoolSegment(object):
+    """
+    Memory-mapped segment file of the spool.
+    """
+
+    def __init__(self, path, size = None):
+        self.path = path
+        if size != None:
+            self.fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_EXCL, 0644)
+        else:
+            self.fd = os.open(path, os.O_RDWR)
+        try:
+            if size != None:
+                # new segment, file is sparse and filled by zeros
+                os.ftruncate(self.fd, size)
+                self.map = mmap.mmap(self.fd, size)
+                _HEADER.pack_into(self.map, 0, SPOOL_MAGIC, SPOOL_VERSION, 0, _HEADER.size)
+            else:
+                self.map = mmap.mmap(self.fd, os.fstat(self.fd).st_size)
+                magic, version, sealed, committed = _HEADER.unpack_from(self.map, 0)
+                if magic != SPOOL_MAGIC or version != SPOOL_VERSION:
+                    self.map.close()
+                    raise APNSValueError, "File %s isn't a spool segment" % path
+        except:
+            os.close(self.fd)
+            raise
+
+    def sealed(self):
+        return _HEADER.unpack_from(self.map, 0)[2] != 0
+
+    def seal(self):
+        # only the flag is written, committed offset belongs to the reader
+        struct.pack_into('!H', self.map, _SEALED_FLAG, 1)
+
+    def committed(self):
+        return struct.unpack_from('!Q', self.map, _COMMITTED_OFFSET)[0]
+
+    def commit(self, offset):
+        struct.pack_into('!Q', self.map, _COMMITTED_OFFSET, offset)
+
+    def records(self, offset):
+        """
+        Yield (end offset, count, index offset, frames) of valid records
+        after offset. Zero length or wrong checksum is the end of data.
+        """
+        data = self.map
+        size = len(data)
+        unpack = _RECORD.unpack_from
+        headerSize = _RECORD.size
+        while offset + headerSize <= size:
+            length, count, checksum = unpack(data, offset)
+            start = offset + headerSize
+            end = start + length
+            if length == 0 or end > size or count * _INDEX_ITEM > length:
+                return
+            if zlib.crc32(buffer(data, start, length)) & 0xFFFFFFFF != checksum:
+                return
+            yield end, count, start, data[start + count * _INDEX_ITEM:end]
+            offset = end
+
+    def end(self, offset):
+        for offset, count, index, frames in self.records(offset):
+            pass
+        return offset
+
+    def entries(self, index, count, frames):
+        """
+        Split frames of the record into (identifier, frame) pairs.
+        """
+        items = struct.unpack_from('!%dI' % (count * 2), self.map, index)
+        entries = []
+        position = 0
+        for i in xrange(0, count * 2, 2):
+            length = items[i + 1]
+            entries.append((items[i] or None, frames[position:position + length]))
+            position += length
+        return entries
+
+    def flush(self):
+        self.map.flush()
+
+    def close(self):
+        self.map.close()
+        os.close(self.fd)
+
+
+class APNSSpoolLease(object):
+    """
+    Exclusive lease of one spool segment returned by APNSSpool.lease().
+    Frames after the committed offset are read by .chunks() and the
+    offset is moved by .commit() after they are sent.
+    """
+
+    def __init__(self, spool, segment, lockFile):
+        self.spool = spool
+        self.segment = segment
+        self.path = segment.path
+        self._lockFile = lockFile
+
+    def committed(self):
+        return self.segment.committed()
+
+    def pending(self):
+        """
+        Return number of uncommitted frames.
+        """
+        return sum([r[1] for r in self.segment.records(self.segment.committed())])
+
+    def _records(self, chunkSize):
+        """
+        Yield (offset, count, records) of uncommitted records by chunks
+        of about chunkSize bytes of frames.
+        """
+        records = []
+        count = 0
+        size = 0
+        offset = self.segment.committed()
+        for offset, frames, index, data in self.segment.records(offset):
+            records.append((index, frames, data))
+            count += frames
+            size += len(data)
+            if size >= chunkSize:
+                yield offset, count, records
+                records = []
+                count = 0
+                size = 0
+        if count > 0:
+            yield offset, count, records
+
+    def blocks(self, chunk_size = 16384):
+        """
+        Yield (offset, count, buffers) of uncommitted frames, buffers
+        is list of contiguous blocks of count frames and offset should
+        be committed after they are sent.
+        """
+        for offset, count, records in self._records(chunk_size):
+            yield offset, count, [r[2] for r in records]
+
+    def chunks(self, chunk_size = 16384):
+        """
+        Yield (offset, entries) of uncommitted frames like .blocks(),
+        entries are (identifier, frame) pairs. Identifier is None if
+        it wasn't set when frame was spooled.
+        """
+        segment = self.segment
+        for offset, count, records in self._records(chunk_size):
+            entries = []
+            for index, frames, data in records:
+                entries.extend(segment.entries(index, frames, data))
+            yield offset, entries
+
+    def commit(self, offset):
+        """
+        Mark frames up to offset as sent.
+        """
+        self.segment.commit(offset)
+        if self.spool.sync:
+            self.segment.flush()
+
+    def release(self):
+        """
+        Release the lease. Sealed segment with all frames committed
+        is removed.
+        """
+        if self.segment == None:
+            return
+        segment = self.segment
+        self.segment = None
+        try:
+            if segment.sealed() and segment.end(segment.committed()) == segment.committed():
+                try:
+                    os.unlink(segment.path)
+                except OSError:
+                    pass
+        finally:
+            segment.close()
+            # lock is released by close
+            self._lockFile.close()
+
+
+class APNSSpool(object):
+    """
+    Durable queue of encoded frames in the directory path. Frames are
+    appended to memory-mapped segment files of segment_size bytes by
+    records of up to recordSize bytes. Record is kept with identifiers
+    of its frames and crc32, so torn records are ignored. Segment
+    header contains committed offset: frames before it were sent and
+    won't be sent again after restart.
+
+        spool = APNSSpool('/var/spool/apns')
+        wrapper = APNSNotificationWrapper(certificate, spool = spool)
+        wrapper.append(notification)
+        wrapper.notify()        # frames are spooled and then sent
+        wrapper.notify_spool()  # after restart: send the rest
+
+    Only one process may append frames, but many sender processes may
+    read the spool: each of them takes exclusive lease (flock) of one
+    segment by .lease(). Frames are written to the page cache, which
+    survives crash of the process, pass sync = True to flush segment
+    to the disk after each append and commit.
+    """
+
+    segmentSize = 16 * 1024 * 1024
+    recordSize = 16384
+    sync = False
+    path = None
+
+    def __init__(self, path, segment_size = 16 * 1024 * 1024, sync = False):
+        if segment_size < _HEADER.size + _RECORD.size:
+            raise APNSValueError, "Segment size is too small"
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self.path = path
+        self.segmentSize = segment_size
+        self.sync = sync
+        self.framesSpooled = 0
+
+        self._writer = None
+        self._writerLock = None
+        self._offset = 0
+        self._lock = threading.Lock()
+
+    def _segmentPath(self, number):
+        return os.path.join(self.path, '%010d.spool' % number)
+
+    def segments(self):
+        """
+        Return sorted list of segment numbers.
+        """
+        numbers = []
+        for name in os.listdir(self.path):
+            if name.endswith('.spool') and name[:-6].isdigit():
+                numbers.append(int(name[:-6]))
+        numbers.sort()
+        return numbers
+
+    def _newSegment(self):
+        """
+        Seal current segment and start the next one. Called with the
+        lock held.
+        """
+        number = 0
+        segments = self.segments()
+        if len(segments) > 0:
+            number = segments[-1] + 1
+        if self._writer != None:
+            self._writer.seal()
+            self._writer.close()
+        self._writer = _APNSSpoolSegment(self._segmentPath(number), self.segmentSize)
+        self._offset = _HEADER.size
+
+    def _open(self):
+        """
+        Take the writer lock. Segments left by previous writer are
+        sealed, new frames are always appended to the new segment.
+        Called with the lock held.
+        """
+        lockFile = open(os.path.join(self.path, 'writer.lock'), 'a')
+        try:
+            fcntl.flock(lockFile.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError, e:
+            lockFile.close()
+            if e.errno in (errno.EAGAIN, errno.EACCES):
+                raise APNSValueError, "Spool %s is used by another writer" % self.path
+            raise
+        self._writerLock = lockFile
+
+        for number in self.segments():
+            try:
+                segment = _APNSSpoolSegment(self._segmentPath(number))
+            except (OSError, IOError):
+                # removed by reader
+                continue
+            try:
+                segment.seal()
+            finally:
+                segment.close()
+        self._newSegment()
+
+    def append(self, frame, identifier = None):
+        """
+        Append encoded frame, e.g. APNSNotification.payload()
+        """
+        self.extend([(identifier, frame)])
+
+    def extend(self, frames):
+        """
+        Append list of encoded frames or (identifier, frame) pairs.
+        """
+        items = []
+        for frame in frames:
+            identifier = 0
+            if isinstance(frame, tuple):
+                identifier, frame = frame
+            if type(frame) is not str:
+                # memoryview or bytearray, e.g. from APNSFrameEncoder.encode()
+                frame = memoryview(frame).tobytes()
+            if _HEADER.size + _RECORD.size + _INDEX_ITEM + len(frame) > self.segmentSize:
+                raise APNSValueError, "Frame is larger than spool segment"
+            items.append((identifier or 0, frame))
+
+        self._lock.acquire()
+        try:
+            if self._writerLock == None:
+                self._open()
+            start = 0
+            while start < len(items):
+                start = self._write(items, start)
+            self.framesSpooled += len(items)
+        finally:
+            self._lock.release()
+
+    def _write(self, items, start):
+        """
+        Write items from start which fit into the current segment by
+        records of about recordSize bytes of frames. Return index of
+        the first item which wasn't written. Called with the lock held.
+        """
+        available = self.segmentSize - self._offset
+        data = []
+        size = 0
+        position = start
+        while position < len(items):
+            first = position
+            index = []
+            frames = []
+            framesSize = 0
+            recordSize = _RECORD.size
+            while position < len(items) and framesSize < self.recordSize:
+                identifier, frame = items[position]
+                if size + recordSize + _INDEX_ITEM + len(frame) > available:
+                    break
+                index.append(identifier)
+                index.append(len(frame))
+                frames.append(frame)
+                framesSize += len(frame)
+                recordSize += _INDEX_ITEM + len(frame)
+                position += 1
+            if position == first:
+                break
+
+            count = position - first
+            body = struct.pack('!%dI' % (count * 2), *index) + "".join(frames)
+            data.append(_RECORD.pack(len(body), count, _checksum(body)))
+            data.append(body)
+            size += recordSize
+
+        if position == start:
+            self._newSegment()
+            return start
+
+        # header of the first record is written last, so readers
+        # never see incomplete records
+        data = "".join(data)
+        offset = self._offset
+        segmentMap = self._writer.map
+        segmentMap[offset + _RECORD.size:offset + size] = data[_RECORD.size:]
+        segmentMap[offset:offset + _RECORD.size] = data[:_RECORD.size]
+        self._offset += size
+        if self.sync:
+            self._writer.flush()
+        return position
+
+    def lease(self):
+        """
+        Take exclusive lease of the first segment with uncommitted
+        frames which isn't leased by other process or thread. Return
+        APNSSpoolLease or None. Fully sent sealed segments are removed.
+        """
+        for number in self.segments():
+            path = self._segmentPath(number)
+            try:
+                lockFile = open(path, 'r')
+            except IOError:
+                continue
+            try:
+                fcntl.flock(lockFile.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                lockFile.close()
+                continue
+
+            try:
+                segment = _APNSSpoolSegment(path)
+            except (OSError, IOError, APNSValueError):
+                lockFile.close()
+                continue
+            if not os.path.exists(path):
+                # removed while lock was taken
+                segment.close()
+                lockFile.close()
+                continue
+
+            lease = APNSSpoolLease(self, segment, lockFile)
+            if segment.end(segment.committed()) > segment.committed():
+                return lease
+            lease.release()
+        return None
+
+    def pending(self):
+        """
+        Return number of uncommitted frames in all segments.
+        """
+        count = 0
+        for number in self.segments():
+            try:
+                segment = _APNSSpoolSegment(self._segmentPath(number))
+            except (OSError, IOError, APNSValueError):
+                continue
+            try:
+                count += sum([r[1] for r in segment.records(segment.committed())])
+            finally:
+                segment.close()
+        return count
+
+    def close(self):
+        """
+        Release the writer lock. Frames appended later go to the new
+        segment.
+        """
+        self._lock.acquire()
+        try:
+            if self._writer != None:
+                self._writer.close()
+                self._writer = None
+            if self._writerLock != None:
+                self._writerLock.close()
+                self._writerLock = None
+        finally:
+            self._lock.release()
@@ -0,0 +1,292 @@
+# Copyright 2009 Max Klymyshyn, Sonettic
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#    http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import array
+import bisect
+import threading
+
+from apnsexceptions import *
+from feedback import APNSFeedbackColumns
+import notifications
+
+class _TokenKeys(object):
+    """
+    Read-only sequence view of the sorted token string for bisect.
+    """
+    def __init__(self, tokens, tokenLength):
+        self.tokens = tokens
+        self.tokenLength = tokenLength
+
+    def __len__(self):
+        return len(self.tokens) // self.tokenLength
+
+    def __getitem__(self, index):
+        tokenLength = self.tokenLength
+        return self.tokens[index * tokenLength:(index + 1) * tokenLength]
+
+
+class APNSSuppressionIndex(object):
+    """
+    Set of deviceTokens reported by the Feedback Service with time of
+    the report. Tokens are kept sorted in one string with parallel
+    array('l') of timestamps and found by bisect. New and removed tokens
+    are collected in the pending table and merged by one pass.
+
+    Pass the same index to APNSFeedbackWrapper (it's filled by received
+    tuples) and APNSNotificationWrapper (notifications to suppressed
+    tokens are dropped before framing). Token which was registered by
+    the application after the feedback report isn't suppressed, see
+    .register(). Index is saved to and loaded from the path.
+    """
+
+    tokenLength = 32
+    mergeThreshold = 4096
+    path = None
+
+    def __init__(self, path = None, tokenLength = 32):
+        self.path = path
+        self.tokenLength = tokenLength
+        self.tokens = ''
+        self.timestamps = array.array('l')
+        self._pending = {}
+        self._lock = threading.Lock()
+
+        if path != None and os.path.exists(path):
+            self.load(path)
+
+    def __len__(self):
+        self._lock.acquire()
+        try:
+            self._merge()
+            return len(self.timestamps)
+        finally:
+            self._lock.release()
+
+    def __contains__(self, token):
+        return self.timestamp(token) != None
+
+    def _find(self, token):
+        # inlined bisect, it's the hot path of every sent notification
+        tokens = self.tokens
+        tokenLength = self.tokenLength
+        low = 0
+        high = len(tokens) // tokenLength
+        while low < high:
+            middle = (low + high) // 2
+            start = middle * tokenLength
+            key = tokens[start:start + tokenLength]
+            if key < token:
+                low = middle + 1
+            elif key > token:
+                high = middle
+            else:
+                return middle
+        return -1
+
+    def _lookup(self, token):
+        if token in self._pending:
+            return self._pending[token]
+        index = self._find(token)
+        if index < 0:
+            return None
+        return self.timestamps[index]
+
+    def _set(self, token, timestamp):
+        self._pending[token] = timestamp
+        if len(self._pending) >= self.mergeThreshold:
+            self._merge()
+
+    def _merge(self):
+        """
+        Merge pending tokens into sorted columns: old rows between
+        pending tokens are copied by slices.
+        """
+        if len(self._pending) == 0:
+            return
+
+        tokenLength = self.tokenLength
+        keys = _TokenKeys(self.tokens, tokenLength)
+        count = len(keys)
+        tokens = []
+        timestamps = array.array('l')
+        previous = 0
+
+        for token in sorted(self._pending):
+            index = bisect.bisect_left(keys, token, previous)
+            tokens.append(self.tokens[previous * tokenLength:index * tokenLength])
+            timestamps.extend(self.timestamps[previous:index])
+
+            timestamp = self._pending[token]
+            if timestamp != None:
+                tokens.append(token)
+                timestamps.append(timestamp)
+
+            previous = index
+            if index < count and keys[index] == token:
+                previous += 1
+
+        tokens.append(self.tokens[previous * tokenLength:])
+        timestamps.extend(self.timestamps[previous:])
+
+        self.tokens = "".join(tokens)
+        self.timestamps = timestamps
+        self._pending = {}
+
+    def timestamp(self, token):
+        """
+        Return UNIX timestamp of the feedback report for the token
+        or None if token isn't suppressed.
+        """
+        self._lock.acquire()
+        try:
+            return self._lookup(token)
+        finally:
+            self._lock.release()
+
+    def suppressed(self, token, registered = None):
+        """
+        Return True if notifications to the token should be dropped.
+        Token registered (datetime or timestamp) after the feedback
+        report isn't suppressed.
+        """
+        timestamp = self.timestamp(token)
+        if timestamp == None:
+            return False
+        return registered == None or notifications._timestamp(registered) < timestamp
+
+    def add(self, token, timestamp):
+        """
+        Suppress token reported by the Feedback Service at timestamp
+        (datetime or UNIX timestamp). The newest report is kept.
+        """
+        if len(token) != self.tokenLength:
+            raise APNSValueError, "Length of deviceToken should be %d bytes" % self.tokenLength
+
+        timestamp = notifications._timestamp(timestamp)
+        self._lock.acquire()
+        try:
+            current = self._lookup(token)
+            if current == None or timestamp > current:
+                self._set(token, timestamp)
+        finally:
+            self._lock.release()
+        return self
+
+    def update(self, feedback):
+        """
+        Add tokens from APNSFeedbackWrapper, APNSFeedbackColumns or any
+        iterable of ( time, deviceToken ) tuples.
+        """
+        if isinstance(feedback, APNSFeedbackColumns):
+            feedback = feedback.rows()
+        elif hasattr(feedback, 'tuples'):
+            feedback = feedback.tuples()
+
+        # tokens are collected to the pending table and merged once
+        tokenLength = self.tokenLength
+        timestamp = notifications._timestamp
+        self._lock.acquire()
+        try:
+            pending = self._pending
+            for feedbackTime, deviceToken in feedback:
+                if len(deviceToken) != tokenLength:
+                    raise APNSValueError, "Length of deviceToken should be %d bytes" % tokenLength
+                feedbackTime = timestamp(feedbackTime)
+                current = self._lookup(deviceToken)
+                if current == None or feedbackTime > current:
+                    pending[deviceToken] = feedbackTime
+            self._merge()
+        finally:
+            self._lock.release()
+        return self
+
+    def register(self, token, timestamp = None):
+        """
+        Application registered token again at timestamp (now if it's
+        None). Token is removed if registration is newer than report.
+        """
+        self._lock.acquire()
+        try:
+            current = self._lookup(token)
+            if current != None and (timestamp == None or notifications._timestamp(timestamp) >= current):
+                self._set(token, None)
+        finally:
+            self._lock.release()
+        return self
+
+    def discard(self, token):
+        """
+        Remove token from the index.
+        """
+        self._lock.acquire()
+        try:
+            if self._lookup(token) != None:
+                self._set(token, None)
+        finally:
+            self._lock.release()
+        return self
+
+    def nbytes(self):
+        """
+        Return number of bytes used by the sorted columns.
+        """
+        return len(self.tokens) + len(self.timestamps) * self.timestamps.itemsize
+
+    def save(self, path = None):
+        """
+        Write index to the file in APNSFeedbackColumns binary format.
+        File is replaced atomically.
+        """
+        path = path or self.path
+        if path == None:
+            raise APNSValueError, "Path of the suppression index file isn't set"
+
+        self._lock.acquire()
+        try:
+            self._merge()
+            columns = APNSFeedbackColumns(self.tokenLength)
+            columns.tokens = bytearray(self.tokens)
+            columns.timestamps = self.timestamps
+
+            temporary = path + '.tmp'
+            fh = open(temporary, 'wb')
+            try:
+                columns.write_binary(fh)
+            finally:
+                fh.close()
+            os.rename(temporary, path)
+        finally:
+            self._lock.release()
+        return self
+
+    def load(self, path = None):
+        """
+        Replace content of the index by file written by .save()
+        """
+        path = path or self.path
+        fh = open(path, 'rb')
+        try:
+            columns = APNSFeedbackColumns.read_binary(fh)
+        finally:
+            fh.close()
+
+        if columns.tokenLength != self.tokenLength:
+            raise APNSValueError, "Length of deviceToken in the file should be %d bytes" % self.tokenLength
+
+        self._lock.acquire()
+        try:
+            self.tokens = str(columns.tokens)
+            self.timestamps = columns.timestamps
+            self._pending = {}
+        finally:
+            self._lock.release()
+        return self
@@ -0,0 +1,167 @@
+# Copyright 2009 Max Klymyshyn, Sonettic
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#    http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import copy
+import random
+
+from apnsexceptions import *
+from utils import _jsonString, _json
+import notifications
+
+SLOT_BADGE = 'badge'
+SLOT_SOUND = 'sound'
+SLOT_ALERT = 'alert'
+SLOT_LOC_ARGS = 'loc-args'
+
+class APNSPayloadTemplate(object):
+    """
+    Payload compiled from APNSNotification once. Static JSON fragments
+    are precomputed and only values of slots are substituted for
+    each device:
+
+        template = APNSPayloadTemplate(notification, ('badge', 'loc-args'))
+        payload = template.render(3, ["John"])
+        frame = template.frame(deviceToken, 3, ["John"])
+
+    Slot is 'badge', 'sound', 'alert' (string alert or body of APNSAlert),
+    'loc-args' (list of strings) or name of custom APNSProperty.
+    Values of .render() are in the order of slots.
+    """
+
+    slots = None
+    fragments = None
+    staticLength = 0
+    maxPayloadLength = 256
+
+    def __init__(self, notification, slots = ()):
+        if not isinstance(notification, notifications.APNSNotification):
+            raise APNSTypeError, "Unexpected argument type. Argument should be an instance of APNSNotification object"
+
+        self.slots = tuple(slots)
+        self.command = notification.command
+        self.maxPayloadLength = notification.maxPayloadLength
+        self._compile(notification)
+
+    def _marker(self, used):
+        """
+        Generate unique string marker which is never changed by escaping.
+        """
+        while True:
+            marker = 'APNSSLOT%d' % random.randint(10 ** 8, 10 ** 9 - 1)
+            if marker not in used:
+                return marker
+
+    def _compile(self, notification):
+        # build copy of notification where values of slots are replaced by markers
+        template = copy.copy(notification)
+        template.properties = list(notification.properties or [])
+        if isinstance(notification.alertObject, notifications.APNSAlert):
+            template.alertObject = copy.copy(notification.alertObject)
+
+        source = notification._build()
+        markers = []
+        numbers = {}
+
+        for slot in self.slots:
+            marker = self._marker(source + "".join(markers))
+            if slot == SLOT_BADGE:
+                number = int(marker[len('APNSSLOT'):])
+                template.badgeValue = number
+                numbers[marker] = str(number)
+            elif slot == SLOT_SOUND:
+                template.soundValue = marker
+            elif slot == SLOT_ALERT:
+                if isinstance(template.alertObject, notifications.APNSAlert):
+                    template.alertObject.alertBody = marker
+                else:
+                    template.alertObject = marker
+            elif slot == SLOT_LOC_ARGS:
+                if not isinstance(template.alertObject, notifications.APNSAlert):
+                    raise APNSValueError, "Slot loc-args requires APNSAlert in the notification"
+                template.alertObject.locArgs = [marker]
+            else:
+                for i, prop in enumerate(template.properties):
+                    if prop.name == slot:
+                        template.properties[i] = notifications.APNSProperty(slot, marker)
+                        break
+                else:
+                    raise APNSValueError, "Unknown slot %s" % str(slot)
+            markers.append(marker)
+
+        # don't limit length of payload with markers
+        template.maxPayloadLength = 2 ** 31
+        payload = template._build()
+
+        # split payload by markers in the order of their positions (JSON
+        # encoder doesn't keep order of keys), string values are splitted
+        # with their quotes
+        positions = []
+        for index, marker in enumerate(markers):
+            quoted = numbers.get(marker, '"%s"' % marker)
+            if payload.count(quoted) != 1:
+                raise APNSValueError, "Can't compile slot of payload template"
+            positions.append((payload.index(quoted), len(quoted), index))
+        positions.sort()
+
+        fragments = []
+        offset = 0
+        for position, length, index in positions:
+            fragments.append(payload[offset:position])
+            offset = position + length
+        fragments.append(payload[offset:])
+
+        self.fragments = fragments
+        self.staticLength = sum([len(f) for f in fragments])
+        self._order = [index for position, length, index in positions]
+        self._encoders = [self._encoder(self.slots[index]) for index in self._order]
+        self._tails = fragments[1:]
+
+    def _encoder(self, slot):
+        """
+        Return function which convert slot value to the JSON.
+        """
+        if slot == SLOT_BADGE:
+            return lambda value: '%d' % value
+        if slot == SLOT_LOC_ARGS:
+            return lambda value: ",".join([_jsonString(isinstance(x, basestring) and x or str(x)) for x in value])
+        if slot in (SLOT_SOUND, SLOT_ALERT):
+            return _jsonString
+        return _json
+
+    def budget(self):
+        """
+        Return number of bytes available for values of slots.
+        """
+        return self.maxPayloadLength - self.staticLength
+
+    def render(self, *values):
+        """
+        Build JSON payload with values of slots.
+        """
+        if len(values) != len(self.slots):
+            raise APNSValueError, "Template expects %d values" % len(self.slots)
+
+        parts = [self.fragments[0]]
+        for encoder, index, fragment in zip(self._encoders, self._order, self._tails):
+            parts.append(encoder(values[index]))
+            parts.append(fragment)
+        payload = "".join(parts)
+
+        if len(payload) > self.maxPayloadLength:
+            raise APNSPayloadLengthError, "Length of Payload more than %d bytes." % self.maxPayloadLength
+
+        return payload
+
+    def frame(self, token, *values):
+        """
+        Build binary frame for deviceToken with values of slots.
+        """
+        return notifications._frame(self.command, token, self.render(*values))
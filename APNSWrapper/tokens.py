@@ -0,0 +1,131 @@
+# Copyright 2009 Max Klymyshyn, Sonettic
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#    http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Bulk deviceToken codec. Whole column of hex or base64 tokens is decoded
+into one contiguous buffer of tokenLength * N bytes. Malformed tokens
+are not raised as exceptions but reported by mask: bytearray with 1 for
+each malformed row. Tokens may be str or unicode, rows of other types
+(e.g. None) are malformed. Rows of malformed tokens are filled by zero
+bytes, so row i of the buffer always corresponds to the token i.
+"""
+
+import string
+import base64
+import binascii
+
+DEVICE_TOKEN_LENGTH = 32
+
+_BASE64_ALPHABET = string.ascii_letters + string.digits + '+/='
+_HEX_GARBAGE = ' <>-\t\r\n'
+
+def _ascii(token):
+    """
+    Return token as ASCII str or None if it can't be a token.
+    """
+    if isinstance(token, unicode):
+        try:
+            return token.encode('ascii')
+        except UnicodeError:
+            return None
+    if isinstance(token, str):
+        return token
+    if isinstance(token, (bytearray, memoryview, buffer)):
+        return str(memoryview(token).tobytes())
+    return None
+
+def _normalize(tokens):
+    """
+    Return list of ASCII str tokens, unicode rows (e.g. returned by
+    database drivers) are encoded, non-string rows are replaced by None.
+    """
+    tokens = list(tokens)
+    if len(set(map(type, tokens)) - set([str])) > 0:
+        tokens = map(_ascii, tokens)
+    return tokens
+
+def _decode_rows(tokens, decode, tokenLength):
+    """
+    Decode tokens one by one, it's used when fast path failed.
+    """
+    rows = []
+    mask = bytearray(len(tokens))
+    empty = '\0' * tokenLength
+    for i, token in enumerate(tokens):
+        row = None
+        if token != None:
+            try:
+                row = decode(token)
+            except (TypeError, ValueError, binascii.Error):
+                pass
+        if row == None or len(row) != tokenLength:
+            mask[i] = 1
+            row = empty
+        rows.append(row)
+    return "".join(rows), mask
+
+def _hex_row(token):
+    token = token.translate(None, _HEX_GARBAGE)
+    return binascii.unhexlify(token)
+
+def _base64_row(token):
+    if token.strip().translate(None, _BASE64_ALPHABET):
+        return None
+    return base64.standard_b64decode(token)
+
+def decode_hex_tokens(tokens, tokenLength = DEVICE_TOKEN_LENGTH):
+    """
+    Decode list of hex tokens. Return tuple (buffer, mask).
+    Xcode console form like <740f4707 bebcf74f ...> is accepted.
+    """
+    tokens = _normalize(tokens)
+    hexLength = tokenLength * 2
+
+    # fast path: clean tokens are decoded by one unhexlify call
+    if None not in tokens and len(set(map(len, tokens)) - set([hexLength])) == 0:
+        try:
+            return binascii.unhexlify("".join(tokens)), bytearray(len(tokens))
+        except (TypeError, binascii.Error):
+            pass
+
+    return _decode_rows(tokens, _hex_row, tokenLength)
+
+def decode_base64_tokens(tokens, tokenLength = DEVICE_TOKEN_LENGTH):
+    """
+    Decode list of base64 tokens. Return tuple (buffer, mask).
+    """
+    tokens = _normalize(tokens)
+    encodedLength = (tokenLength + 2) // 3 * 4
+
+    # fast path: decode every token by C function and check all of them at once
+    if None not in tokens and len(set(map(len, tokens)) - set([encodedLength])) == 0:
+        joined = "".join(tokens)
+        if not joined.translate(None, _BASE64_ALPHABET):
+            rows = map(binascii.a2b_base64, tokens)
+            if len(set(map(len, rows)) - set([tokenLength])) == 0:
+                return "".join(rows), bytearray(len(tokens))
+
+    return _decode_rows(tokens, _base64_row, tokenLength)
+
+def invalid_indexes(mask):
+    """
+    Return list of indexes of malformed tokens.
+    """
+    return [i for i, bad in enumerate(mask) if bad]
+
+def iter_tokens(buffer, mask = None, tokenLength = DEVICE_TOKEN_LENGTH):
+    """
+    Iterate over binary tokens of the buffer skipping malformed rows.
+    Result may be passed to APNSNotificationWrapper.broadcast()
+    """
+    for i in xrange(len(buffer) // tokenLength):
+        if mask == None or not mask[i]:
+            yield buffer[i * tokenLength:(i + 1) * tokenLength]
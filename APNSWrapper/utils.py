@@ -11,13 +11,117 @@
 
 
 import os
+import re
 import sys
+import json
+from json.encoder import encode_basestring, encode_basestring_ascii
+
+from apnsexceptions import *
+
+JSON_STDLIB = 'json'
+JSON_SIMPLEJSON = 'simplejson'
+JSON_UJSON = 'ujson'
+
+# escaped backslash or run of \\uXXXX escapes
+_ESCAPES = re.compile(r'\\\\|(?:\\u[0-9a-fA-F]{4})+')
+_CONTROL = re.compile(u'[\x00-\x1f]')
+
+def _unescapeMatch(match):
+    data = match.group(0)
+    if data == '\\\\':
+        return data
+    # control characters should stay escaped, surrogate pairs are
+    # joined by UTF-8 codec
+    text = _CONTROL.sub(lambda m: u'\\u%04x' % ord(m.group(0)), data.decode('unicode_escape'))
+    return text.encode('utf-8')
+
+def _unescape(data):
+    """
+    Replace \\uXXXX escapes of non-ASCII characters in JSON produced
+    by ASCII encoder with UTF-8 encoded characters.
+    """
+    return _ESCAPES.sub(_unescapeMatch, data)
+
+def _utf8(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
+def _jsonString(value):
+    """
+    Return JSON string literal of unicode or UTF-8 string as UTF-8 bytes.
+    Quotes, backslashes and control characters are escaped, non-ASCII
+    characters are kept as is, so they take 2-4 bytes instead of 6-12.
+    """
+    try:
+        # escaping in C, the rest is done only for non-ASCII strings
+        data = encode_basestring_ascii(value)
+        if '\\u' in data:
+            data = _utf8(encode_basestring(value))
+        return data
+    except UnicodeDecodeError:
+        raise APNSValueError, "String should be unicode or UTF-8 encoded"
 
 def _doublequote(str):
     """
-    Replace double quotes if it's necessary
+    Escape string to put it between double quotes of JSON string.
+    """
+    return _jsonString(str)[1:-1]
+
+def json_encoder(name = JSON_STDLIB):
+    """
+    Return function which serialize payload object to compact UTF-8
+    JSON by the stdlib json (JSON_STDLIB), simplejson (JSON_SIMPLEJSON)
+    or ujson (JSON_UJSON) library.
+    """
+    if name == JSON_STDLIB:
+        asciiEncoder = json.JSONEncoder(separators = (',', ':'))
+        def encode(value):
+            # ASCII encoder is implemented in C and decodes UTF-8 strings
+            # itself, non-ASCII characters are unescaped in its output
+            # (encoder with ensure_ascii = False can't mix str and unicode)
+            data = asciiEncoder.encode(value)
+            if '\\u' in data:
+                data = _unescape(data)
+            return data
+        return encode
+
+    try:
+        if name == JSON_SIMPLEJSON:
+            import simplejson
+            encoder = simplejson.JSONEncoder(ensure_ascii = False, separators = (',', ':'))
+            return lambda value: _utf8(encoder.encode(value))
+        if name == JSON_UJSON:
+            import ujson
+            options = {'ensure_ascii' : False}
+            try:
+                # "/" is escaped by default, it's one byte more for each slash
+                ujson.dumps('', escape_forward_slashes = False)
+                options['escape_forward_slashes'] = False
+            except TypeError:
+                pass
+            return lambda value: _utf8(ujson.dumps(value, **options))
+    except ImportError:
+        raise APNSValueError, "JSON library %s isn't installed" % name
+    raise APNSValueError, "Unknown JSON library %s" % str(name)
+
+_jsonEncode = json_encoder(JSON_STDLIB)
+
+def _json(value):
+    try:
+        return _jsonEncode(value)
+    except UnicodeDecodeError:
+        raise APNSValueError, "String should be unicode or UTF-8 encoded"
+
+def set_json_encoder(encoder = JSON_STDLIB):
+    """
+    Set JSON library name (see json_encoder()) or function used to
+    serialize payloads of all notifications.
     """
-    return str.replace('"', '\\"')
+    global _jsonEncode
+    if not callable(encoder):
+        encoder = json_encoder(encoder)
+    _jsonEncode = encoder
         
 def if_else(condition, a, b):
     """
@@ -0,0 +1,213 @@
+#!/usr/bin/env python2.6
+#
+#  benchmark.py
+#  wrapper
+#
+#  Microbenchmarks of the payload encoding and parsing paths.
+#  It doesn't connect to the APNS, run it as: python benchmark.py
+#  Pass PEM file with certificate and private key to measure
+#  APNSProcessPool through the local TLS sink:
+#      python benchmark.py certificate.pem
+#
+
+import os
+import sys
+import ssl
+import time
+import socket
+import timeit
+import resource
+import multiprocessing
+
+from APNSWrapper import *
+
+token = '0/w68oJxIYlFpDDC/4eeo/bpt/44JTzZ6ZEXEgVvU6c='
+
+def measure(title, function, number = 100000):
+    """
+    Print average time of one function call in microseconds.
+    """
+    seconds = timeit.timeit(function, number = number)
+    print "%-50s %8.2f us" % (title, seconds * 1000000 / number)
+
+def alertNotification(badge = 1, arg = "arg"):
+    alert = APNSAlert()
+    alert.body("Very important alert message")
+    alert.loc_key("ALERTMSG")
+    alert.loc_args(["arg1", arg])
+
+    message = APNSNotification()
+    message.tokenBase64(token)
+    message.badge(badge)
+    message.sound("default")
+    message.alert(alert)
+    message.appendProperty(APNSProperty("acme", (1, "custom string argument")))
+    return message
+
+def benchmarkTemplate():
+    """
+    Per-notification encode cost of APNSNotification._build() against
+    the compiled APNSPayloadTemplate with badge and loc-args slots.
+    """
+    message = alertNotification()
+    template = APNSPayloadTemplate(message, ('badge', 'loc-args'))
+
+    measure("APNSNotification() + _build()", lambda: alertNotification(7, "John")._build())
+    measure("APNSNotification._build()", lambda: message.badge(7)._build())
+    measure("APNSPayloadTemplate.render()", lambda: template.render(7, ["arg1", "John"]))
+
+def legacyQuote(value):
+    return value.replace('"', '\\"')
+
+def legacyAlert(alert):
+    arguments = []
+    if alert.alertBody:
+        arguments.append('"body":"%s"' % legacyQuote(alert.alertBody))
+    if alert.locKey:
+        arguments.append('"loc-key":"%s"' % legacyQuote(alert.locKey))
+    if alert.locArgs:
+        arguments.append('"loc-args":[%s]' % ",".join(['"%s"' % x for x in alert.locArgs]))
+    return ",".join(arguments)
+
+def legacyProperty(prop):
+    arguments = map(lambda x: if_else(isinstance(x, str), '"%s"' % legacyQuote(str(x)), str(x)), prop.data)
+    return '"%s":[%s]' % (prop.name, ",".join(arguments))
+
+def legacyBuild(message):
+    """
+    Hand-formatted payload builder of the version 0.4 (only quotes are
+    escaped) for comparison with JSON encoders.
+    """
+    apsKeys = []
+    if message.soundValue:
+        apsKeys.append('"sound":"%s"' % legacyQuote(message.soundValue))
+    if message.badgeValue:
+        apsKeys.append('"badge":%d' % int(message.badgeValue))
+    if isinstance(message.alertObject, str):
+        apsKeys.append('"alert":"%s"' % legacyQuote(message.alertObject))
+    elif message.alertObject != None:
+        apsKeys.append('"alert":{%s}' % legacyAlert(message.alertObject))
+    keys = ['"aps":{%s}' % ",".join(apsKeys)]
+    for prop in message.properties:
+        keys.append(legacyProperty(prop))
+    payload = "{%s}" % ",".join(keys)
+    if len(payload) > message.maxPayloadLength:
+        raise APNSPayloadLengthError, "Length of Payload more than %d bytes." % message.maxPayloadLength
+    return payload
+
+def benchmarkJSON():
+    """
+    Payload serialization by the legacy builder and by each installed
+    JSON library.
+    """
+    message = alertNotification(7, "John")
+    measure("legacy hand-formatted builder", lambda: legacyBuild(message))
+    for name in (JSON_STDLIB, JSON_SIMPLEJSON, JSON_UJSON):
+        try:
+            set_json_encoder(name)
+        except APNSValueError:
+            continue
+        measure("APNSNotification._build() with %s" % name, message._build)
+    set_json_encoder(JSON_STDLIB)
+
+    message.alert(APNSAlert().body(u"\u041f\u0440\u0438\u0432\u0435\u0442").loc_key("ALERTMSG").loc_args(["arg1", "John"]))
+    measure("APNSNotification._build() with non-ASCII body", message._build)
+
+    message = APNSNotification().tokenBase64(token).badge(1).alert("Very important alert message " * 20).fit()
+    measure("APNSNotification._build() fitted to 256 bytes", message._build, 10000)
+
+def maxRSS():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def benchmarkBatchMemory(count = 200000):
+    """
+    Memory per notification of the NotificationBatch against list of
+    APNSNotification objects. Growth of the max RSS is measured, so
+    batch is built first and both structures are kept alive.
+    """
+    template = APNSPayloadTemplate(APNSNotification().badge(1).alert("Sale"), ('badge',))
+
+    start = maxRSS()
+    batch = NotificationBatch()
+    for i in xrange(count):
+        batch.append(os.urandom(32), template, badge = i % 50)
+    batchRSS = maxRSS()
+
+    notifications = [APNSNotification().token(os.urandom(32)).badge(i % 50).alert("Sale") \
+                        for i in xrange(count)]
+    objectsRSS = maxRSS()
+
+    print "%-50s %8.1f bytes" % ("NotificationBatch row", float(batchRSS - start) / count)
+    print "%-50s %8.1f bytes" % ("APNSNotification object", float(objectsRSS - batchRSS) / count)
+
+def benchmarkFeedbackParser(count = 1000000, blockSize = 16384):
+    """
+    Parse Feedback Service sample replicated to count tuples by blocks.
+    """
+    sample = open(os.path.join('DataSamples', 'feedbackSampleTuple.dat'), 'rb').read()
+    tuples = len(sample) // 38
+    data = sample * (count // tuples)
+    blocks = [data[i:i + blockSize] for i in xrange(0, len(data), blockSize)]
+
+    def parse():
+        parser = APNSFeedbackParser()
+        parsed = 0
+        for block in blocks:
+            for item in parser.feed(block):
+                parsed += 1
+        return parsed
+
+    seconds = timeit.timeit(parse, number = 1)
+    print "%-50s %8.2f s (%d tuples)" % ("APNSFeedbackParser", seconds, len(data) // 38)
+
+def sink(certificate, listener):
+    """
+    TLS server which reads and drops everything, one process per connection.
+    """
+    while True:
+        connection, address = listener.accept()
+        if os.fork() == 0:
+            try:
+                stream = ssl.wrap_socket(connection, certfile = certificate, server_side = True)
+                while stream.recv(65536):
+                    pass
+            except (socket.error, ssl.SSLError):
+                pass
+            os._exit(0)
+        connection.close()
+
+def sinkNotification(i):
+    return APNSNotification().token(os.urandom(32)).badge(i % 50).alert("Hello %d" % i)
+
+def benchmarkProcessPool(certificate, count = 200000):
+    """
+    Frames per second of APNSProcessPool with 1 .. cpu_count encoders
+    (and one sender per two encoders) through the local TLS sink.
+    """
+    listener = socket.socket()
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(64)
+    server = multiprocessing.Process(target = sink, args = (certificate, listener))
+    server.daemon = True
+    server.start()
+    # sink uses the client certificate, it can't be verified
+    set_ssl_verification(False)
+
+    for encoders in xrange(1, multiprocessing.cpu_count() + 1):
+        pool = APNSProcessPool(certificate, encoders = encoders, senders = max(1, encoders // 2))
+        pool.apnsSandboxHost, pool.apnsPort = listener.getsockname()
+        result = pool.send(xrange(count), build = sinkNotification)
+        pool.close()
+        print "%-50s %8.0f frames/s" % ("APNSProcessPool, %d encoders" % encoders, \
+                    result['frames'] / result['seconds'])
+
+    server.terminate()
+
+if __name__ == "__main__":
+    benchmarkTemplate()
+    benchmarkJSON()
+    benchmarkBatchMemory()
+    benchmarkFeedbackParser()
+    if len(sys.argv) > 1:
+        benchmarkProcessPool(sys.argv[1])
@@ -0,0 +1,778 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  test_offline.py
+#  wrapper
+#
+#  Regression tests which don't need certificate and APNS gateway.
+#  Run: python test_offline.py
+#
+
+import os
+import json
+import random
+import base64
+import binascii
+import datetime
+import shutil
+import socket
+import struct
+import tempfile
+import threading
+import time
+import unittest
+import StringIO
+
+from APNSWrapper import *
+from APNSWrapper.utils import _json
+from APNSWrapper import tokens
+
+# connections are never opened, any existing file passes certificate check
+CERTIFICATE = os.path.abspath(__file__)
+SAMPLE = os.path.join(os.path.dirname(CERTIFICATE), 'DataSamples', 'feedbackSampleTuple.dat')
+TOKEN = ''.join([chr(i) for i in xrange(32)])
+
+def feedbackData(tuples):
+    return "".join([struct.pack('!IH', t, len(token)) + token for t, token in tuples])
+
+
+class SampleFeedbackWrapper(APNSFeedbackWrapper):
+    """
+    Feedback wrapper which reads responses from the list of strings.
+    """
+    testingParser = True
+
+    def __init__(self, responses, **kwargs):
+        APNSFeedbackWrapper.__init__(self, CERTIFICATE, **kwargs)
+        self.responses = list(responses)
+
+    def _testFeedbackFile(self):
+        return StringIO.StringIO(self.responses.pop(0))
+
+
+class StubConnection(object):
+    """
+    Connection which records written buffers instead of sending them.
+    connect() raises connectError if it is set, writev() raises
+    exceptions from writeErrors list one by one. errorResponse becomes
+    readable when writev() fails, like error-response sent by the
+    gateway before it closes connection.
+    """
+
+    def __init__(self, connectError = None):
+        self.connectError = connectError
+        self.writeErrors = []
+        self.errorResponse = None
+        self.responses = []
+        self.written = []
+        self.connected = False
+        self.dropped = False
+        self.handshakes = 0
+        self.bytesSent = 0
+        self.lastActivity = None
+
+    def connect(self, host = None, port = None):
+        if self.connectError != None:
+            raise self.connectError
+        self.connected = True
+        self.dropped = False
+        self.handshakes += 1
+        self.lastActivity = time.time()
+        return self
+
+    def writev(self, buffers):
+        if len(self.writeErrors) > 0:
+            if self.errorResponse != None:
+                self.responses.append(self.errorResponse)
+                self.errorResponse = None
+            raise self.writeErrors.pop(0)
+        for data in buffers:
+            data = memoryview(data).tobytes()
+            self.written.append(data)
+            self.bytesSent += len(data)
+        self.lastActivity = time.time()
+
+    def alive(self):
+        return self.connected and not self.dropped
+
+    def readable(self, timeout = 0):
+        if self.connected and len(self.responses) > 0:
+            return True
+        time.sleep(min(timeout, 0.01))
+        return False
+
+    def read(self, blockSize = 1024, timeout = None):
+        if len(self.responses) == 0:
+            return ''
+        return self.responses.pop(0)
+
+    def idle(self):
+        if self.lastActivity == None:
+            return None
+        return time.time() - self.lastActivity
+
+    def close(self):
+        self.connected = False
+
+
+def finishes(function, timeout = 5):
+    """
+    Call function in a thread, return False if it is still running
+    after timeout seconds.
+    """
+    thread = threading.Thread(target = function)
+    thread.daemon = True
+    thread.start()
+    thread.join(timeout)
+    return not thread.is_alive()
+
+
+class JSONTest(unittest.TestCase):
+
+    def testCompactUTF8(self):
+        data = _json({'a' : u'caf\xe9', 'b' : 1})
+        self.assertEqual(data, '{"a":"caf\xc3\xa9","b":1}')
+
+    def testMixedStrAndUnicode(self):
+        message = APNSNotification().token('a' * 32).alert('caf\xc3\xa9')
+        message.appendProperty(APNSProperty('k', u'x'))
+        payload = message._build()
+        self.assertEqual(payload, '{"aps":{"alert":"caf\xc3\xa9"},"k":"x"}')
+
+    def testEscapes(self):
+        value = {'a' : [u'\U0001F600 \xe9\n\x01', 'caf\xc3\xa9 \\ "q"', '\\u00e9', u'\\\xe9']}
+        data = _json(value)
+        self.assertEqual(json.loads(data), json.loads(json.dumps(value)))
+        # control characters and backslashes stay escaped
+        self.assertTrue('\\n\\u0001' in data)
+        self.assertTrue('"\\\\u00e9"' in data)
+        self.assertTrue('\xf0\x9f\x98\x80 \xc3\xa9' in data)
+
+    def testInvalidUTF8(self):
+        self.assertRaises(APNSValueError, _json, {'a' : '\xff'})
+
+    def testNull(self):
+        alert = APNSAlert().body('text').action_loc_key()
+        message = APNSNotification().token('a' * 32).alert(alert)
+        self.assertEqual(json.loads(message._build())['aps']['alert']['action-loc-key'], None)
+
+
+class FrameTest(unittest.TestCase):
+
+    payload = '{"aps":{"badge":3}}'
+
+    def notification(self):
+        return APNSNotification().token(TOKEN).badge(3)
+
+    def testSimpleFormat(self):
+        frame = self.notification().payload()
+        self.assertEqual(frame, '\0\0\x20' + TOKEN + '\0\x13' + self.payload)
+
+    def testEnhancedFormat(self):
+        expiry = datetime.datetime.fromtimestamp(1300000000)
+        frame = self.notification().identifier(7).expiry(expiry).payload()
+        self.assertEqual(frame, struct.pack('!BIIH', 1, 7, 1300000000, 32) + TOKEN + \
+                            '\0\x13' + self.payload)
+
+    def testFrameFormat(self):
+        frame = self.notification().identifier(7).priority(PRIORITY_IMMEDIATE).payload()
+        items = struct.pack('!BH', 1, 32) + TOKEN + struct.pack('!BH', 2, 19) + self.payload + \
+                    struct.pack('!BHIBHIBHB', 3, 4, 7, 4, 4, 0, 5, 1, 10)
+        self.assertEqual(frame, struct.pack('!BI', 2, len(items)) + items)
+
+    def testEncoder(self):
+        notifications = [self.notification(), self.notification().identifier(9), \
+                            self.notification().priority(PRIORITY_CONSERVE_POWER)]
+        frames = APNSFrameEncoder(size = 16).encode(notifications + [(TOKEN, self.payload)])
+        expected = "".join([n.payload() for n in notifications]) + notifications[0].payload()
+        self.assertEqual(frames.tobytes(), expected)
+
+
+class TemplateTest(unittest.TestCase):
+
+    def testTemplate(self):
+        alert = APNSAlert().loc_key('GREETING').loc_args(['x'])
+        notification = APNSNotification().token(TOKEN).badge(1).alert(alert)
+        notification.appendProperty(APNSProperty('id', 0))
+        template = APNSPayloadTemplate(notification, (SLOT_BADGE, SLOT_LOC_ARGS, 'id'))
+        for badge, args, identifier in [(5, [u'J\xfcrgen', '"q"'], 42), (12, ['a\\b'], 'x')]:
+            notification.badge(badge).alertObject.loc_args(args)
+            notification.properties[0].data = identifier
+            self.assertEqual(template.render(badge, args, identifier), notification._build())
+            self.assertEqual(template.frame(TOKEN, badge, args, identifier), notification.payload())
+
+
+class FitTest(unittest.TestCase):
+
+    alphabet = u'abc xyz\xe9\u044f\u4e2d\U0001F600"\\\n\x01/'
+
+    def text(self, length):
+        return u''.join([random.choice(self.alphabet) for i in xrange(length)])
+
+    def check(self, notification, limit, text):
+        payload = notification._build()
+        self.assertTrue(len(payload) <= limit)
+        alert = json.loads(payload)['aps']['alert']
+        if isinstance(alert, dict):
+            alert = alert.get('body') or alert['loc-args'][-1]
+        self.assertTrue(alert.endswith(u'\u2026'))
+        prefix = alert[:-1]
+        self.assertTrue(text.startswith(prefix))
+        return prefix
+
+    def testLongestPrefix(self):
+        random.seed(1)
+        for limit in (PAYLOAD_LENGTH_LEGACY, PAYLOAD_LENGTH_2K, PAYLOAD_LENGTH_4K):
+            for i in xrange(20):
+                text = self.text(random.randint(limit // 4, limit * 2))
+                notification = APNSNotification().token(TOKEN).badge(1).alert(text)
+                if len(_json(notification._object())) <= limit:
+                    continue
+                prefix = self.check(notification.fit(limit), limit, text)
+                # one more character doesn't fit
+                longer = APNSNotification().token(TOKEN).badge(1).alert(text[:len(prefix) + 1] + u'\u2026')
+                longer.maxPayloadLength = limit
+                self.assertRaises(APNSPayloadLengthError, longer._build)
+
+    def testAlertObject(self):
+        text = self.text(1000)
+        alert = APNSAlert().body(text.encode('utf-8'))
+        self.check(APNSNotification().token(TOKEN).alert(alert).fit(), 256, text)
+        alert = APNSAlert().loc_key('KEY').loc_args(['first', text])
+        self.check(APNSNotification().token(TOKEN).alert(alert).fit(), 256, text)
+
+    def testNoRoom(self):
+        notification = APNSNotification().token(TOKEN).alert('text').fit(10)
+        self.assertRaises(APNSPayloadLengthError, notification._build)
+
+
+class FeedbackParserTest(unittest.TestCase):
+
+    def setUp(self):
+        self.data = open(SAMPLE, 'rb').read()
+
+    def testSample(self):
+        parser = APNSFeedbackParser()
+        tuples = list(parser.feed(self.data))
+        self.assertEqual(len(tuples), 11)
+        self.assertTrue(parser.done())
+        self.assertEqual(feedbackData(tuples), self.data)
+
+    def testBlocks(self):
+        expected = list(APNSFeedbackParser().feed(self.data))
+        for blockSize in (1, 5, 37, 38, 39, 1024):
+            parser = APNSFeedbackParser()
+            tuples = []
+            for offset in xrange(0, len(self.data), blockSize):
+                tuples.extend(parser.feed(self.data[offset:offset + blockSize]))
+            self.assertEqual(tuples, expected)
+            self.assertTrue(parser.done())
+
+    def testWrapper(self):
+        expected = list(APNSFeedbackParser().feed(self.data))
+        wrapper = SampleFeedbackWrapper([self.data] * 3, convert_time = False)
+        wrapper.receive()
+        self.assertEqual(wrapper.tuples(), expected)
+        self.assertEqual(list(wrapper.stream(convert_time = False)), expected)
+
+        columns = wrapper.receive(columnar = True)
+        binary = StringIO.StringIO()
+        columns.write_binary(binary)
+        binary.seek(0)
+        self.assertEqual(list(APNSFeedbackColumns.read_binary(binary).rows()), expected)
+
+
+class TokensTest(unittest.TestCase):
+
+    token = ''.join([chr(i) for i in xrange(32)])
+
+    def testHex(self):
+        hexToken = binascii.hexlify(self.token)
+        xcode = '<%s>' % ' '.join([hexToken[i:i + 8] for i in xrange(0, 64, 8)])
+        buffer, mask = tokens.decode_hex_tokens([hexToken, unicode(xcode), 'zz' * 32, None, u'\xe9' * 64])
+        self.assertEqual(tokens.invalid_indexes(mask), [2, 3, 4])
+        self.assertEqual(buffer[:64], self.token * 2)
+        self.assertEqual(buffer[64:], '\0' * 96)
+
+    def testBase64(self):
+        encoded = base64.standard_b64encode(self.token)
+        buffer, mask = tokens.decode_base64_tokens([unicode(encoded), encoded, None, 42, encoded[:-4]])
+        self.assertEqual(tokens.invalid_indexes(mask), [2, 3, 4])
+        self.assertEqual(list(tokens.iter_tokens(buffer, mask)), [self.token, self.token])
+
+    def testFastPath(self):
+        encoded = base64.standard_b64encode(self.token)
+        buffer, mask = tokens.decode_base64_tokens([unicode(encoded)] * 3)
+        self.assertEqual((buffer, tokens.invalid_indexes(mask)), (self.token * 3, []))
+
+
+class SuppressionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def testMerge(self):
+        random.seed(2)
+        tokens = [''.join([chr(random.randint(0, 255)) for i in xrange(32)]) for j in xrange(200)]
+        index = APNSSuppressionIndex()
+        # pending tokens are merged often
+        index.mergeThreshold = 7
+        expected = {}
+        for i in xrange(2000):
+            token = random.choice(tokens)
+            timestamp = random.randint(1000, 2000)
+            operation = random.randint(0, 3)
+            if operation == 0:
+                index.add(token, timestamp)
+                expected[token] = max(timestamp, expected.get(token, 0))
+            elif operation == 1:
+                feedback = [(random.randint(1000, 2000), t) for t in random.sample(tokens, 10)]
+                index.update(feedback)
+                for feedbackTime, t in feedback:
+                    expected[t] = max(feedbackTime, expected.get(t, 0))
+            elif operation == 2:
+                index.register(token, timestamp)
+                if expected.get(token, timestamp + 1) <= timestamp:
+                    del expected[token]
+            else:
+                index.discard(token)
+                expected.pop(token, None)
+
+        self.assertEqual(len(index), len(expected))
+        self.assertEqual(index.tokens, "".join(sorted(expected)))
+        self.assertEqual(list(index.timestamps), [expected[t] for t in sorted(expected)])
+        for token in tokens:
+            self.assertEqual(index.timestamp(token), expected.get(token))
+            self.assertEqual(index.suppressed(token, 999), token in expected)
+
+        path = os.path.join(self.path, 'suppression')
+        index.save(path)
+        loaded = APNSSuppressionIndex(path)
+        self.assertEqual((loaded.tokens, loaded.timestamps), (index.tokens, index.timestamps))
+
+
+class FeedbackPollerTest(unittest.TestCase):
+
+    def testUnsortedResponse(self):
+        a, b, c, d = ['a' * 32, 'b' * 32, 'c' * 32, 'd' * 32]
+        wrapper = SampleFeedbackWrapper([
+                    feedbackData([(100, a), (50, b), (100, c)]),
+                    feedbackData([(100, a), (99, b), (100, d), (101, c)])
+                ])
+        delivered = []
+        poller = APNSFeedbackPoller(wrapper, callback = delivered.append, convert_time = False)
+        self.assertEqual(poller.poll(), 3)
+        self.assertEqual(delivered, [(100, a), (50, b), (100, c)])
+        self.assertEqual(poller.highWaterMark, 100)
+        # older tuples and tuples with the mark seen before are skipped
+        self.assertEqual(poller.poll(), 2)
+        self.assertEqual(delivered[3:], [(100, d), (101, c)])
+        self.assertEqual(poller.highWaterMark, 101)
+
+
+class SpoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def testResume(self):
+        spool = APNSSpool(self.path)
+        spool.recordSize = 100
+        frames = [(i + 1, 'frame %d' % i) for i in xrange(100)]
+        spool.extend(frames)
+
+        lease = spool.lease()
+        offset, entries = lease.chunks(200).next()
+        lease.commit(offset)
+        # sender crashed before the next commit
+        lease.release()
+        spool.close()
+
+        # restarted writer seals the segment, new frames go to the next one
+        spool = APNSSpool(self.path)
+        spool.append('new', 1000)
+        self.assertEqual(spool.pending(), 100 - len(entries) + 1)
+        resent = []
+        while True:
+            lease = spool.lease()
+            if lease == None:
+                break
+            for offset, chunk in lease.chunks():
+                resent.extend(chunk)
+                lease.commit(offset)
+            lease.release()
+        self.assertEqual(entries + resent, frames + [(1000, 'new')])
+        # fully sent sealed segment is removed
+        self.assertEqual(len(spool.segments()), 1)
+        spool.close()
+
+    def testTornRecord(self):
+        spool = APNSSpool(self.path)
+        spool.recordSize = 1
+        spool.extend(['frame %d' % i for i in xrange(10)])
+        spool.close()
+
+        # the last record is damaged, e.g. by crash during write
+        path = os.path.join(self.path, '%010d.spool' % spool.segments()[0])
+        segment = open(path, 'r+b')
+        data = segment.read()
+        segment.seek(data.index('frame 9'))
+        segment.write('FRAME')
+        segment.close()
+
+        lease = APNSSpool(self.path).lease()
+        self.assertEqual(lease.pending(), 9)
+        lease.release()
+
+    def testMemoryviewFrame(self):
+        frames = APNSFrameEncoder().encode([('a' * 32, '{"aps":{"badge":1}}')])
+        spool = APNSSpool(self.path)
+        spool.extend([(7, frames), bytearray('frame')])
+        spool.close()
+
+        lease = APNSSpool(self.path).lease()
+        entries = [e for offset, chunk in lease.chunks() for e in chunk]
+        lease.release()
+        self.assertEqual(entries, [(7, frames.tobytes()), (None, 'frame')])
+
+
+class WrapperTest(unittest.TestCase):
+
+    def notify(self, wrapper, badge):
+        wrapper.append(APNSNotification().token(TOKEN).badge(badge))
+        wrapper.notify()
+
+    def testPersistent(self):
+        wrapper = APNSNotificationWrapper(CERTIFICATE, persistent = True)
+        wrapper.connection = StubConnection()
+        self.notify(wrapper, 1)
+        self.notify(wrapper, 2)
+        self.assertEqual(wrapper.statistics()['handshakes'], 1)
+        # gateway closed connection while it was idle
+        wrapper.connection.dropped = True
+        self.notify(wrapper, 3)
+        self.assertEqual(wrapper.statistics()['handshakes'], 2)
+        self.assertEqual(len(wrapper.connection.written), 3)
+
+
+class EnhancedTest(unittest.TestCase):
+
+    def setUp(self):
+        self.wrapper = APNSNotificationWrapper(CERTIFICATE, persistent = True, enhanced = True, \
+                            in_flight = 5, error_timeout = 0.05)
+        self.connection = self.wrapper.connection = StubConnection()
+
+    def tearDown(self):
+        # stops error-response reader
+        self.wrapper.disconnect()
+
+    def notify(self, count):
+        for i in xrange(count):
+            self.wrapper.append(APNSNotification().token(TOKEN).badge(1))
+        self.wrapper.notify()
+
+    def identifiers(self):
+        return [struct.unpack_from('!BI', frame)[1] for frame in self.connection.written]
+
+    def fail(self, identifier):
+        # gateway reports the frame and closes connection on the next write
+        self.connection.errorResponse = struct.pack('!BBI', 8, 8, identifier)
+        self.connection.writeErrors = [socket.error("broken pipe")]
+
+    def testResend(self):
+        self.notify(10)
+        self.fail(9)
+        self.notify(1)
+        # frames written after the failed one are resent by new connection
+        self.assertEqual(self.identifiers(), range(1, 11) + [10, 11])
+        statistics = self.wrapper.statistics()
+        self.assertEqual(statistics['handshakes'], 2)
+        self.assertEqual((statistics['frames'], statistics['resent']), (11, 2))
+        self.assertEqual((statistics['errors'], statistics['unrecoverable']), (1, 0))
+        self.assertEqual(self.wrapper.errorResponses, [(8, 9)])
+
+    def testFailedFrameLeftBuffer(self):
+        self.notify(10)
+        self.fail(3)
+        self.notify(1)
+        # whole in-flight buffer is resent
+        self.assertEqual(self.identifiers(), range(1, 11) + range(7, 12))
+        statistics = self.wrapper.statistics()
+        self.assertEqual((statistics['resent'], statistics['unrecoverable']), (5, 1))
+
+
+class PacerTest(unittest.TestCase):
+
+    def testTokenBucket(self):
+        bucket = APNSTokenBucket(100, burst = 10)
+        self.assertEqual(bucket.reserve(10), 0)
+        # bucket goes to debt, the caller waits until it is paid
+        self.assertAlmostEqual(bucket.reserve(5), 0.05, 2)
+        self.assertAlmostEqual(bucket.reserve(100), 1.05, 2)
+        time.sleep(0.1)
+        self.assertAlmostEqual(bucket.reserve(0), 0.95, 1)
+
+    def testRate(self):
+        pacer = APNSPacer(frames_per_second = 1000, bytes_per_second = 10000)
+        started = time.time()
+        for i in xrange(10):
+            pacer.acquire(10, 1200)
+        # burst of 10000 bytes, then 2000 bytes at 10000 per second
+        self.assertTrue(0.18 <= time.time() - started < 0.5)
+        self.assertEqual(pacer.statistics()['frames'], 100)
+
+    def testAdaptive(self):
+        parent = APNSPacer(frames_per_second = 1000)
+        pacer = APNSPacer(frames_per_second = 100, parent = parent, increase = 0.25)
+        pacer.failure()
+        # error-response caused by the notification doesn't slow down
+        pacer.failure(8)
+        self.assertEqual((pacer.scale, parent.scale), (0.5, 0.5))
+        self.assertEqual(pacer.statistics()['frames_limit'], 50)
+        # additive increase for every second without errors
+        pacer._adjusted -= 1
+        pacer.delay(1, 0)
+        self.assertEqual(pacer.scale, 0.75)
+        for i in xrange(10):
+            pacer.failure()
+        self.assertEqual(pacer.scale, pacer.minimum)
+
+
+class PoolTest(unittest.TestCase):
+
+    def testConnectError(self):
+        pool = APNSConnectionPool(CERTIFICATE, size = 2)
+        pool._connection = lambda: StubConnection(APNSConnectionError("certificate isn't valid"))
+        for i in xrange(10):
+            pool.write('frame %d' % i)
+        self.assertTrue(finishes(pool.join))
+        self.assertEqual(sorted(pool.failed), sorted(['frame %d' % i for i in xrange(10)]))
+        # workers are still running
+        self.assertEqual(len([w for w in pool.workers if w.is_alive()]), 2)
+        pool.close()
+
+    def testOutageCountedOnce(self):
+        pacer = APNSPacer(frames_per_second = 100000)
+        pool = APNSConnectionPool(CERTIFICATE, size = 1, pacer = pacer)
+        connection = StubConnection()
+        pool._connection = lambda: connection
+        pool.write('first')
+        pool.join()
+        # reused connection is dropped and the retry fails too
+        connection.writeErrors = [socket.error("broken pipe"), socket.error("connection refused")]
+        pool.write('second')
+        pool.join()
+        pool.close()
+        self.assertEqual((connection.written, pool.failed), (['first'], ['second']))
+        self.assertEqual(pacer.statistics()['decreases'], 1)
+
+    def testConcurrentStart(self):
+        pool = APNSConnectionPool(CERTIFICATE, size = 2)
+        def connection():
+            # makes the race between first writes likely
+            time.sleep(0.01)
+            return StubConnection()
+        pool._connection = connection
+        producers = [threading.Thread(target = pool.write, args = ('frame',)) for i in xrange(8)]
+        for producer in producers:
+            producer.start()
+        for producer in producers:
+            producer.join()
+        pool.join()
+        self.assertEqual(len(pool.workers), 2)
+        self.assertEqual(pool.statistics()['frames'], 8)
+        pool.close()
+
+
+class DispatcherTest(unittest.TestCase):
+
+    def testConnectError(self):
+        dispatcher = APNSDispatcher(workers = 2)
+        dispatcher.register('bad', CERTIFICATE).register('good', CERTIFICATE)
+        connections = []
+        def connection(tenant):
+            if tenant.name == 'bad':
+                return StubConnection(APNSConnectionError("certificate isn't valid"))
+            connections.append(StubConnection())
+            return connections[-1]
+        dispatcher._connection = connection
+        for i in xrange(5):
+            dispatcher.write('bad', 'bad %d' % i)
+            dispatcher.write('good', 'good %d' % i)
+        self.assertTrue(finishes(dispatcher.join))
+        self.assertEqual(sorted(dispatcher.failed), [('bad', 'bad %d' % i) for i in xrange(5)])
+        self.assertEqual(sorted([f for c in connections for f in c.written]), \
+                            ['good %d' % i for i in xrange(5)])
+        statistics = dispatcher.statistics()['tenants']
+        self.assertEqual((statistics['bad']['errors'] > 0, statistics['good']['frames']), (True, 5))
+        dispatcher.close()
+
+    def testWriteError(self):
+        failed = []
+        dispatcher = APNSDispatcher(workers = 1, \
+                        on_error = lambda name, frames, e: failed.append((name, frames)))
+        dispatcher.register('app', CERTIFICATE)
+        connection = StubConnection()
+        dispatcher._connection = lambda tenant: connection
+        dispatcher.write('app', 'first')
+        dispatcher.join()
+        # dropped connection is reopened once
+        connection.writeErrors = [socket.error("broken pipe")]
+        dispatcher.write('app', 'second')
+        dispatcher.join()
+        self.assertEqual((connection.written, connection.handshakes), (['first', 'second'], 2))
+        # write fails after reconnect too
+        connection.writeErrors = [socket.error("broken pipe"), socket.error("connection refused")]
+        dispatcher.write('app', 'third')
+        self.assertTrue(finishes(dispatcher.join))
+        self.assertEqual((failed, dispatcher.failed), ([('app', ['third'])], []))
+        statistics = dispatcher.statistics()
+        self.assertEqual((statistics['connections'], statistics['frames']), (0, 2))
+        self.assertEqual(statistics['tenants']['app']['errors'], 1)
+        # next frame opens connection again
+        dispatcher.write('app', 'fourth')
+        dispatcher.close()
+        self.assertEqual(connection.written[-1], 'fourth')
+
+    def testConcurrentStart(self):
+        dispatcher = APNSDispatcher(workers = 2)
+        dispatcher.register('app', CERTIFICATE)
+        dispatcher._connection = lambda tenant: StubConnection()
+        producers = [threading.Thread(target = dispatcher.write, args = ('app', 'frame')) \
+                        for i in xrange(8)]
+        for producer in producers:
+            producer.start()
+        for producer in producers:
+            producer.join()
+        dispatcher.join()
+        self.assertEqual(len(dispatcher._threads), 2)
+        self.assertEqual(dispatcher.statistics()['frames'], 8)
+        dispatcher.close()
+
+
+class FrameRingTest(unittest.TestCase):
+
+    def check(self, ring, maxLength, records):
+        """
+        Put and get random blocks keeping at most records in the ring,
+        so the next put never waits for the consumer.
+        """
+        pending = []
+        for i in xrange(500):
+            block = chr(65 + i % 26) * random.randint(0, maxLength)
+            ring.put(block, i + 1)
+            pending.append((block, i + 1))
+            if len(pending) == records:
+                self.assertEqual(ring.get(), pending.pop(0))
+        while len(pending) > 0:
+            self.assertEqual(ring.get(), pending.pop(0))
+        self.assertEqual(ring.get(), None)
+
+    def testWrapAround(self):
+        random.seed(3)
+        ring = APNSFrameRing(capacity = 128)
+        # records up to half of the ring hit its end at every offset
+        self.check(ring, 56, 1)
+        self.check(ring, 24, 3)
+        head, tail = ring._positions()
+        self.assertEqual(head, tail)
+        self.assertTrue(head > 100 * ring.capacity)
+
+    def testTooLarge(self):
+        ring = APNSFrameRing(capacity = 128)
+        self.assertRaises(APNSValueError, ring.put, 'x' * 64, 1)
+
+
+class ProcessPoolTest(unittest.TestCase):
+
+    def testConnectError(self):
+        pool = APNSProcessPool(CERTIFICATE, encoders = 2, senders = 1, \
+                    buffer_size = 64, ring_size = 4096)
+        pool._connection = lambda: StubConnection(APNSConnectionError("certificate isn't valid"))
+        try:
+            result = pool.send(['frame %d' % i for i in xrange(20)])
+            self.assertEqual((result['frames'], result['failed']), (0, 20))
+            # sender process is still running
+            self.assertEqual(pool.send(['frame'])['failed'], 1)
+        finally:
+            pool.close()
+
+    def testInvalidItems(self):
+        pool = APNSProcessPool(CERTIFICATE, encoders = 2, senders = 1, \
+                    buffer_size = 64, ring_size = 4096)
+        pool._connection = lambda: StubConnection()
+        items = [(TOKEN, '{"aps":{"badge":%d}}' % i) for i in xrange(100)]
+        items[37] = (TOKEN, 'x' * 300)
+        items[60] = 42
+        try:
+            result = pool.send(items)
+        finally:
+            pool.close()
+        self.assertEqual((result['frames'], result['failed']), (98, 0))
+        self.assertEqual([index for index, error in result['invalid']], [37, 60])
+        self.assertTrue(result['invalid'][0][1].startswith('APNSPayloadLengthError'))
+
+
+class SchedulerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.wrapper = APNSNotificationWrapper(CERTIFICATE, persistent = True)
+        self.wrapper.connection = StubConnection()
+
+    def notification(self, badge):
+        return APNSNotification().token(TOKEN).badge(badge)
+
+    def badges(self):
+        return [json.loads(frame[37:])['aps']['badge'] for frame in self.wrapper.connection.written]
+
+    def testLanes(self):
+        expired = []
+        scheduler = APNSScheduler(self.wrapper, chunk_size = 100, on_expired = expired.append)
+        for i in xrange(3):
+            scheduler.append(self.notification(20 + i), CLASS_BULK)
+        scheduler.append(self.notification(10), CLASS_DEFAULT)
+        scheduler.append(self.notification(11), CLASS_DEFAULT, deadline = time.time() - 1)
+        scheduler.append(self.notification(1), CLASS_TRANSACTIONAL)
+        self.assertEqual(scheduler.flush(), 5)
+        self.assertEqual(self.badges(), [1, 10, 20, 21, 22])
+        self.assertEqual([n.badgeValue for n in expired], [11])
+        statistics = scheduler.statistics()
+        self.assertEqual([statistics[c]['sent'] for c in xrange(3)], [1, 1, 3])
+        self.assertEqual(statistics[CLASS_BULK]['latency']['count'], 3)
+
+    def testWriteError(self):
+        failed = []
+        scheduler = APNSScheduler(self.wrapper, on_error = lambda n, e: failed.append(n.badgeValue))
+        self.wrapper.connection.writeErrors = [socket.error("connection reset")]
+        for i in xrange(3):
+            scheduler.append(self.notification(i + 1))
+        self.assertRaises(socket.error, scheduler.flush)
+        self.assertEqual(failed, [1, 2, 3])
+        self.assertEqual(scheduler.statistics()[CLASS_DEFAULT]['failed'], 3)
+
+    def testFinishWhenIdle(self):
+        finished = []
+        self.wrapper._finish = lambda: finished.append(len(self.wrapper.connection.written))
+        scheduler = APNSScheduler(self.wrapper)
+        scheduler.idleInterval = 0.2
+        scheduler.start()
+        for i in xrange(3):
+            scheduler.append(self.notification(i + 1), CLASS_TRANSACTIONAL)
+            scheduler.join()
+        # connection isn't finished after each transactional push
+        self.assertEqual(finished, [])
+        time.sleep(0.5)
+        self.assertEqual(finished, [3])
+        scheduler.append(self.notification(4))
+        scheduler.close()
+        self.assertEqual(finished, [3, 4])
+
+
+if __name__ == "__main__":
+    unittest.main()